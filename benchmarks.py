@@ -0,0 +1,299 @@
+from datetime import date, timedelta
+from itertools import count
+from pathlib import Path
+from time import perf_counter
+from types import GeneratorType
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import tracemalloc
+import zipfile
+
+from classes import AddressBook, Record
+import notes
+
+
+RED = "\033[91m"
+GREEN = "\033[92m"
+BLUE = "\033[94m"
+RESET = "\033[0m"
+
+SEED = 2023
+CONTACT_SIZES = (1000, 10000)
+NOTE_SIZES = (1000, 10000)
+FILE_SIZES = (1000,)
+# timed calls of a query benchmark and of a heavy one (save, load, sort...)
+QUERIES = 200
+REPEAT = 5
+# slower by more than this is reported as a regression by --compare
+THRESHOLD = 0.10
+
+WORDS = ("anna", "bohdan", "olena", "ivan", "petro", "maria", "oleh", "sofia", "taras", "iryna",
+         "project", "meeting", "release", "budget", "report", "travel", "family", "doctor",
+         "birthday", "shopping", "garden", "invoice", "contract", "holiday", "review")
+TAGS = ("work", "home", "urgent", "done", "idea", "family", "money", "travel")
+EXTENSIONS = (".jpg", ".png", ".mp3", ".ogg", ".txt", ".docx", ".pdf", ".xlsx", ".mp4", ".mkv",
+              ".py", ".xyz", "")
+
+
+def make_book(size: int, seed=SEED) -> AddressBook:
+    '''
+    size contacts with one or two phones; most have an email and a birthday
+    '''
+    rnd = random.Random(seed + size)
+    book = AddressBook()
+    first_day = date(1950, 1, 1)
+    for i in range(size):
+        record = Record(f"{rnd.choice(WORDS).title()} {rnd.choice(WORDS).title()} {i}")
+        for _ in range(rnd.randint(1, 2)):
+            record.add_phone(f"{rnd.randrange(10**10):010d}")
+        if rnd.random() < 0.8:
+            record.add_email(f"user{i}@{rnd.choice(WORDS)}.com")
+        if rnd.random() < 0.7:
+            birthday = first_day + timedelta(days=rnd.randrange(365 * 50))
+            record.add_birthday(birthday.strftime("%d.%m.%Y"))
+        book.add_record(record)
+    return book
+
+def make_notes(size: int, filename: str, seed=SEED) -> None:
+    '''
+    Open a new note store in filename and fill it with size notes
+    '''
+    rnd = random.Random(seed + size)
+    notes.load_notes(filename)
+    with notes.batch():
+        for _ in range(size):
+            record = notes.NoteRecord(" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(5, 40))))
+            record.add_tags(rnd.sample(TAGS, rnd.randint(0, 3)))
+            notes.add_record(record)
+
+def make_tree(root: Path, size: int, seed=SEED) -> None:
+    '''
+    size files with mixed extensions in nested folders, every tenth a
+    duplicate of an earlier one, plus zip and tar.gz archives
+    '''
+    rnd = random.Random(seed + size)
+    folders = [root]
+    for i in range(max(1, size // 50)):
+        folder = rnd.choice(folders) / f"{rnd.choice(WORDS)} {i}"
+        folder.mkdir()
+        folders.append(folder)
+    contents = []
+    for i in range(size):
+        if contents and rnd.random() < 0.1:
+            content = rnd.choice(contents)
+        else:
+            content = rnd.randbytes(rnd.randint(100, 20000))
+            contents.append(content)
+        name = f"{rnd.choice(WORDS)} {i}{rnd.choice(EXTENSIONS)}"
+        (rnd.choice(folders) / name).write_bytes(content)
+    for i in range(max(1, size // 100)):
+        members = [(f"{rnd.choice(WORDS)}{j}.txt", rnd.randbytes(500)) for j in range(3)]
+        folder = rnd.choice(folders)
+        if i % 2:
+            with zipfile.ZipFile(folder / f"archive {i}.zip", "w") as archive:
+                for name, content in members:
+                    archive.writestr(name, content)
+        else:
+            with tarfile.open(folder / f"archive {i}.tar.gz", "w:gz") as archive:
+                for name, content in members:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(content)
+                    archive.addfile(info, io.BytesIO(content))
+
+
+def _percentile(ordered: list, q: float) -> float:
+    # nearest rank
+    return ordered[min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))]
+
+def measure(func, repeat: int, setup=None) -> dict:
+    '''
+    Time repeat calls of func(i) (or func(setup()) with setup, which is
+    not timed), then trace the memory of one more call.
+    '''
+    arg = setup() if setup else 0
+    # warm up: lazy indexes, caches
+    func(arg)
+    latencies = []
+    for i in range(repeat):
+        arg = setup() if setup else i
+        start = perf_counter()
+        func(arg)
+        latencies.append(perf_counter() - start)
+    arg = setup() if setup else repeat
+    tracemalloc.start()
+    try:
+        func(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    latencies.sort()
+    total = sum(latencies)
+    return {"runs": repeat,
+            "ops_per_sec": repeat / total if total else 0.0,
+            "mean_ms": total / repeat * 1000,
+            "p50_ms": _percentile(latencies, 0.50) * 1000,
+            "p95_ms": _percentile(latencies, 0.95) * 1000,
+            "p99_ms": _percentile(latencies, 0.99) * 1000,
+            "max_ms": latencies[-1] * 1000,
+            "peak_kb": peak / 1024}
+
+
+def _consume(result) -> None:
+    if isinstance(result, GeneratorType):
+        for _ in result:
+            pass
+
+def bench_contacts(size: int, tmp: Path, queries: int, repeat: int):
+    '''
+    Yield (name, (func, repeat[, setup])) for the address book hot paths
+    '''
+    import main
+    book = make_book(size)
+    main.address_book = book
+    rnd = random.Random(SEED)
+    names = [rnd.choice(WORDS)[:rnd.randint(3, 6)] for _ in range(queries + 2)]
+    phones = [f"{rnd.randrange(1000, 10000)}" for _ in range(queries + 2)]
+    yield "random_search.name", (lambda i: _consume(main.random_search(names[i])), queries)
+    yield "random_search.phone", (lambda i: _consume(main.random_search(phones[i])), queries)
+    yield "bd_in_xx_days", (lambda i: _consume(book.bd_in_xx_days(1 + i % 60)), queries)
+    for order in ("added", "name", "birthday"):
+        yield f"iterator.{order}", (lambda i, order=order: _consume(book.iterator(50, order)), repeat)
+    filename = str(tmp / "book.dat")
+    yield "save", (lambda i: book.compact(filename), repeat)
+    if not os.path.exists(filename):
+        book.compact(filename)
+    book.close()
+
+    def load(i):
+        loaded = AddressBook()
+        loaded.load(filename)
+        loaded.close()
+    yield "load", (load, repeat)
+
+    def load_and_find(i):
+        loaded = AddressBook()
+        loaded.load(filename)
+        loaded.find(names_in_book[i % len(names_in_book)])
+        loaded.close()
+    names_in_book = list(book.data)[::max(1, size // 100)]
+    yield "load+find", (load_and_find, repeat)
+
+def bench_notes(size: int, tmp: Path, queries: int, repeat: int):
+    make_notes(size, str(tmp / "notes_book.bin"))
+    rnd = random.Random(SEED)
+    templates = ("{0}", "{0} {1}", '"{0} {1}"', "{2}*", "{0} OR {1}")
+    note_queries = [rnd.choice(templates).format(rnd.choice(WORDS), rnd.choice(WORDS), rnd.choice(WORDS)[:3])
+                    for _ in range(queries + 2)]
+    tag_queries = [f"{rnd.choice(TAGS)} NOT {rnd.choice(TAGS)}" for _ in range(queries + 2)]
+    yield "find_by_note", (lambda i: notes.find_by_note(note_queries[i]), queries)
+    yield "find_by_tag", (lambda i: notes.find_by_tag(tag_queries[i]), queries)
+    yield "sort_notes", (lambda i: notes.sort_notes(), repeat)
+    notes.note_store.close()
+
+def bench_folder_sort(size: int, tmp: Path, queries: int, repeat: int):
+    import folder_sort
+    template = tmp / "template"
+    template.mkdir()
+    make_tree(template, size)
+    runs = count()
+
+    def fresh_copy():
+        folder = tmp / f"run {next(runs)}"
+        shutil.copytree(template, folder)
+        return folder
+    yield "folder_sort.main", (lambda folder: folder_sort.main(str(folder)), repeat, fresh_copy)
+    yield "folder_sort.dedup", (lambda folder: folder_sort.main(str(folder), dedup="report"), repeat, fresh_copy)
+
+SUITES = {"contacts": (bench_contacts, CONTACT_SIZES),
+          "notes": (bench_notes, NOTE_SIZES),
+          "files": (bench_folder_sort, FILE_SIZES)}
+
+
+def run(sizes: dict, queries=QUERIES, repeat=REPEAT, only=None, out=sys.stdout) -> dict:
+    results = {}
+    for suite, (bench, _) in SUITES.items():
+        for size in sizes[suite]:
+            with tempfile.TemporaryDirectory() as tmp:
+                for name, args in bench(size, Path(tmp), queries, repeat):
+                    key = f"{name}[{size}]"
+                    if only and not any(part in key for part in only):
+                        continue
+                    result = results[key] = measure(*args)
+                    print(f"{key:<32}{result['ops_per_sec']:>12.1f} ops/s  p50 {result['p50_ms']:>9.3f} ms  "
+                          f"p95 {result['p95_ms']:>9.3f} ms  p99 {result['p99_ms']:>9.3f} ms  "
+                          f"peak {result['peak_kb']:>10.0f} KB", file=out)
+    return results
+
+def compare(old: dict, new: dict, threshold=THRESHOLD) -> tuple:
+    '''
+    Returns (report lines, number of regressions); a benchmark regressed when
+    its median latency or peak memory grew by more than threshold
+    '''
+    lines, regressions = [], 0
+    for key, result in new.items():
+        before = old.get(key)
+        if before is None:
+            continue
+        for field in ("p50_ms", "peak_kb"):
+            if not before[field]:
+                continue
+            ratio = result[field] / before[field]
+            if ratio > 1 + threshold:
+                regressions += 1
+                color, verdict = RED, "slower" if field == "p50_ms" else "more memory"
+            elif ratio < 1 - threshold:
+                color, verdict = GREEN, "faster" if field == "p50_ms" else "less memory"
+            else:
+                continue
+            lines.append(f"{color}{key:<32}{field:<8}{before[field]:>12.3f} -> {result[field]:>12.3f}"
+                         f"  x{ratio:.2f} {verdict}{RESET}")
+    return lines, regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the address book, notes and folder sort")
+    parser.add_argument("--contacts", type=int, nargs="*", default=CONTACT_SIZES, metavar="N",
+                        help="address book sizes (1k-1M)")
+    parser.add_argument("--notes", type=int, nargs="*", default=NOTE_SIZES, metavar="N", help="note corpus sizes")
+    parser.add_argument("--files", type=int, nargs="*", default=FILE_SIZES, metavar="N",
+                        help="number of files in the folder sort trees")
+    parser.add_argument("--queries", type=int, default=QUERIES, help="timed calls of a search")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="timed calls of save, load, sort...")
+    parser.add_argument("--only", nargs="*", metavar="NAME", help="run benchmarks whose name contains NAME")
+    parser.add_argument("--out", metavar="FILE", help="write the results to FILE as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare with the results saved in FILE")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="regression threshold, 0.1 is 10%%")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    sizes = {"contacts": args.contacts, "notes": args.notes, "files": args.files}
+    results = run(sizes, args.queries, args.repeat, args.only)
+    if args.out:
+        report = {"python": platform.python_version(),
+                  "platform": platform.platform(),
+                  "cpus": os.cpu_count(),
+                  "seed": SEED,
+                  "results": results}
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2)
+        print(f"{BLUE}Results written to {args.out}{RESET}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as fh:
+            old = json.load(fh)["results"]
+        lines, regressions = compare(old, results, args.threshold)
+        print("\n".join(lines) or f"{GREEN}No changes beyond {args.threshold:.0%}{RESET}")
+        if regressions:
+            print(f"{RED}{regressions} regressions{RESET}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,14 @@
+from bisect import bisect_right
 from collections import UserDict
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import date
 from types import GeneratorType
-from itertools import islice
+import os
 import pickle
-from fields import Name, Phone, Birthday, Address, Email
+import metrics
+from fields import Name, Phone, Birthday, Address, Email, today as current_date
+from indexes import NGramIndex, NameIndex, BirthdayIndex
+from record_store import RecordMap, RecordStore, write_store
 
 
 RED = "\033[91m"
@@ -11,19 +16,66 @@ GREEN = "\033[92m"
 BLUE = "\033[94m"
 RESET = "\033[0m"
 FILENAME = "book.dat"
+JOURNAL_SUFFIX = ".journal"
+ORDERS = ("added", "name", "birthday")
+# fold the journal into a new snapshot once it grows past this many entries
+COMPACT_EVERY = 1000
 
 class Record:
+    # fixed attributes in slots, no __dict__ per contact;
+    # birthday and address are None when not set
+    __slots__ = ("name", "phones", "emails", "birthday", "address", "book")
+
     def __init__(self, name: str, birthday=None, email=None, address=None) -> None:
         self.name = Name(name)
         self.phones = []
-        if birthday:
-            self.birthday = Birthday(birthday)
-        if address:
-            self.address = Address(address)
+        self.birthday = Birthday(birthday) if birthday else None
+        self.address = Address(address) if address else None
         self.emails = []
+        self.book = None
+
+    def __getstate__(self) -> dict:
+        # the owning book is not part of the record
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != "book"}
+
+    def __setstate__(self, state: dict) -> None:
+        # records pickled before slots may have no birthday or address
+        self.birthday = self.address = None
+        for slot, value in state.items():
+            if slot in self.__slots__:
+                setattr(self, slot, value)
+        if self.address == "":
+            self.address = None
+        self.book = None
+
+    def pack(self) -> tuple:
+        '''
+        Record as a tuple of plain values for the record store
+        '''
+        return (self.name.value,
+                tuple(phone.value for phone in self.phones),
+                tuple(email.value for email in self.emails),
+                self.birthday.value.toordinal() if self.birthday is not None else 0,
+                str(self.address) if self.address else None)
+
+    @classmethod
+    def unpack(cls, packed: tuple):
+        name, phones, emails, birthday, address = packed
+        record = cls.__new__(cls)
+        record.name = Name.checked(name)
+        record.phones = [Phone.checked(phone) for phone in phones]
+        record.emails = [Email.checked(email) for email in emails]
+        record.birthday = Birthday.checked(date.fromordinal(birthday)) if birthday else None
+        record.address = address
+        record.book = None
+        return record
+
+    def _changed(self, op: str, *args) -> None:
+        if self.book is not None:
+            self.book.record_changed(self, op, *args)
 
     def __str__(self) -> str:
-        if hasattr(self, 'birthday'):
+        if self.birthday is not None:
             __days_to_bdy = f"{self.days_to_birthday} days to next birthday" if self.days_to_birthday else f'{GREEN}it is TODAY!{RESET}'
             __last_part = f"{BLUE}Birthday: {RESET}{self.birthday}\n{__days_to_bdy}\n"
         else:
@@ -33,7 +85,7 @@ class Record:
                 __last_part += f"{BLUE}Emails: {RESET}{', '.join(e.value for e in self.emails)}\n"
             elif len(self.emails) == 1:
                 __last_part += f"{BLUE}Email: {RESET}{self.emails[0]}\n"
-        if hasattr(self, "address") and self.address != "":
+        if self.address:
             __last_part += f"{BLUE}Address: {RESET}{self.address}"
 
         message = (
@@ -46,11 +98,13 @@ class Record:
     def add_phone(self, phone: str) -> None:
         if phone not in (ph.value for ph in self.phones):
             self.phones.append(Phone(phone))
+            self._changed("add_phone", phone)
 
     def remove_phone(self, removing: str) -> None:
         for phone in self.phones:
             if phone.value == removing:
                 self.phones.remove(phone)
+                self._changed("remove_phone", removing)
 
     def edit_phone(self, old_phone: str, new_phone: str) -> None:
         if old_phone not in (ph.value for ph in self.phones):
@@ -58,6 +112,7 @@ class Record:
         for index, phone in enumerate(self.phones):
             if phone.value == old_phone:
                 self.phones[index].value = new_phone
+        self._changed("edit_phone", old_phone, new_phone)
 
     def find_phone(self, search: str) -> Phone:
         # -> Phone, not str !!!
@@ -68,16 +123,26 @@ class Record:
 
     def add_birthday(self, birthday: str) -> None:
         self.birthday = Birthday(birthday)
+        self._changed("add_birthday", birthday)
+
+    def delete_birthday(self) -> None:
+        if self.birthday is None:
+            raise AttributeError("birthday")
+        self.birthday = None
+        self._changed("delete_birthday")
 
     def add_address(self, adress: str) -> None:
         self.address = adress
+        self._changed("add_address", adress)
 
     def delete_address(self):
-        self.address = ""
+        self.address = None
+        self._changed("delete_address")
 
     def add_email(self, email: str) -> None:
         if email not in (e.value for e in self.emails):
             self.emails.append(Email(email))
+            self._changed("add_email", email)
 
     def change_email(self, old_email:str, new_email:str):
         if old_email not in (e.value for e in self.emails):
@@ -85,27 +150,136 @@ class Record:
         for index, email in enumerate(self.emails):
             if email.value == old_email:
                 self.emails[index].value = new_email
+        self._changed("change_email", old_email, new_email)
 
     def delete_email(self, old_email:str):
         for email in self.emails:
             if email.value == old_email:
                 self.emails.remove(email)
+                self._changed("delete_email", old_email)
 
     @property
     def days_to_birthday(self) -> int:
-        today = datetime.now().date()
-        this_year_birthday = self.birthday.value.replace(year=today.year)
-        next_year_birthday = self.birthday.value.replace(year=today.year+1)
-        difference = (this_year_birthday - today).days
-        if difference <= 0:
-            difference = (next_year_birthday - today).days
-        return difference
+        today = current_date()
+        for year in (today.year, today.year+1):
+            try:
+                next_birthday = self.birthday.value.replace(year=year)
+            except ValueError:
+                # Feb 29 in a common year
+                next_birthday = date(year, 3, 1)
+            if next_birthday >= today:
+                return (next_birthday - today).days
 
 class AddressBook(UserDict):
+    '''
+    Records are kept in a snapshot file plus an append-only journal
+    (<snapshot>.journal) with one entry per record change.
+    save() only syncs the journal; the snapshot is rewritten when the journal
+    grows past COMPACT_EVERY entries. load() replays snapshot + journal.
+    The snapshot is a record store opened through mmap, records are decoded
+    when they are used and the search indexes are built on first search.
+    '''
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.filename = None
+        self.journal = None
+        self.generation = 0
+        self._journal_len = 0
+        self._pending = None
+        self.phone_index = NGramIndex()
+        self.name_index = NameIndex()
+        self.birthday_index = BirthdayIndex()
+        self._indexed = False
+        # no journal entries while the journal is replayed
+        self._loading = False
+        super().__init__(*args, **kwargs)
+        records, self.data = self.data, RecordMap(decode=self._decode)
+        self.data.update(records)
+
+    def _decode(self, raw: bytes) -> Record:
+        record = Record.unpack(pickle.loads(raw))
+        if not self._loading:
+            record.book = self
+        return record
+
+    @staticmethod
+    def _encode(record: Record) -> bytes:
+        return pickle.dumps(record.pack(), pickle.HIGHEST_PROTOCOL)
+
+    def _index_record(self, record: Record) -> None:
+        if not self._indexed:
+            return
+        name = record.name.value
+        self.name_index.add(name)
+        if record.birthday is not None:
+            self.birthday_index.add(name, record.birthday.value)
+        for phone in record.phones:
+            self.phone_index.add(phone.value, name)
+
+    def _unindex_record(self, record: Record) -> None:
+        if not self._indexed:
+            return
+        name = record.name.value
+        self.name_index.remove(name)
+        self.birthday_index.remove(name)
+        for phone in record.phones:
+            self.phone_index.remove(phone.value, name)
+
+    def _reindex(self) -> None:
+        '''
+        Build the indexes in one pass over the records
+        '''
+        self.phone_index = NGramIndex()
+        self.name_index = NameIndex()
+        self.birthday_index = BirthdayIndex()
+        names, birthdays = [], []
+        for name, record in self.data.items():
+            names.append(name)
+            if record.birthday is not None:
+                birthdays.append((name, record.birthday.value))
+            for phone in record.phones:
+                self.phone_index.add(phone.value, name)
+        self.name_index.extend(names)
+        self.birthday_index.extend(birthdays)
+        self._indexed = True
+
+    def _ensure_indexed(self) -> None:
+        if not self._indexed:
+            self._reindex()
 
     def add_record(self, record: Record) -> None:
+        if self._indexed:
+            old_record = self.data.get(record.name.value)
+            if old_record is not None:
+                self._unindex_record(old_record)
+        record.book = self
         self.data[record.name.value] = record
+        self._index_record(record)
+        self._log("add_record", record.name.value, (record,))
+
+    def record_changed(self, record: Record, op: str, *args) -> None:
+        name = record.name.value
+        # a record streamed from the store is not kept unless it changes
+        self.data.keep(name, record)
+        if self._indexed:
+            self._index_change(record, op, args)
+        self._log(op, name, args)
 
+    def _index_change(self, record: Record, op: str, args: tuple) -> None:
+        name = record.name.value
+        if op == "add_phone":
+            self.phone_index.add(args[0], name)
+        elif op == "remove_phone":
+            self.phone_index.remove(args[0], name)
+        elif op == "edit_phone":
+            self.phone_index.remove(args[0], name)
+            self.phone_index.add(args[1], name)
+        elif op == "add_birthday":
+            self.birthday_index.add(name, record.birthday.value)
+        elif op == "delete_birthday":
+            self.birthday_index.remove(name)
+
+    @metrics.timed("search")
     def find(self, name: str) -> Record:
         record = self.data.get(name)
         # return record if record else None
@@ -116,36 +290,250 @@ class AddressBook(UserDict):
 
     def delete(self, name: str) -> None:
         if name in self.data:
-            self.data.pop(name)
+            if self._indexed:
+                self._unindex_record(self.data[name])
+            del self.data[name]
+            self._log("delete", name, ())
+
+    @metrics.timed("search")
+    def search_phones(self, search: str) -> list:
+        '''
+        Records having a phone that contains search
+        '''
+        self._ensure_indexed()
+        return [self.data.read(name) for name in self.phone_index.search(search) if name in self.data]
 
-    def iterator(self, n=2) -> GeneratorType:
+    @metrics.timed("search")
+    def search_names(self, search: str, limit=None) -> list:
+        '''
+        Records whose name contains search, best matches first
+        '''
+        self._ensure_indexed()
+        return [self.data.read(name) for name in self.name_index.search(search, limit)]
+
+    def _walk(self, order: str, position=None):
+        '''
+        Yield (position, record) pairs in the given order, resuming after position.
+        Every order walks the records once, without sorting the whole book.
+        '''
+        if order != "added":
+            self._ensure_indexed()
+        if order == "name":
+            names = self.name_index.names
+            i = 0 if position is None else bisect_right(names, position)
+            while i < len(names):
+                entry = names[i]
+                i += 1
+                yield entry, self.data.read(entry[1])
+        elif order == "birthday":
+            # only records having a birthday
+            for position, name in self.birthday_index.walk(position):
+                yield position, self.data.read(name)
+        else:
+            # positions of the record map, resumed without walking the records before
+            yield from self.data.walk(position or 0)
+
+    @staticmethod
+    def _paging(n, order: str, cursor) -> tuple:
+        '''
+        Returns (page size, order, position) for page() and iterator()
+        '''
         try:
             n = int(n)
-        except ValueError:
+        except (TypeError, ValueError):
+            n = 2
+        if n < 1:
             n = 2
-        for i in range(0, len(self), n):
-            yield islice(self.data.values(), i, i+n)
+        if order not in ORDERS:
+            order = "added"
+        position = None
+        if cursor is not None:
+            order, position = cursor
+        return n, order, position
+
+    def page(self, n=2, order="added", cursor=None) -> tuple:
+        '''
+        Returns (records, cursor) - up to n records and an opaque cursor
+        for the next page, or None as cursor if it was the last one
+        '''
+        n, order, position = self._paging(n, order, cursor)
+        records = []
+        for position, record in self._walk(order, position):
+            if len(records) == n:
+                return records, (order, last_position)
+            records.append(record)
+            last_position = position
+        return records, None
 
+    def iterator(self, n=2, order="added", cursor=None) -> GeneratorType:
+        n, order, position = self._paging(n, order, cursor)
+        page = []
+        for _, record in self._walk(order, position):
+            page.append(record)
+            if len(page) == n:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    @metrics.timed("search")
     def bd_in_xx_days(self, days: int) -> GeneratorType:
-        suit_lst = []
-        for rec in self.data.values():
-            if not hasattr(rec, "birthday"):
-                continue
-            if rec.days_to_birthday < days:
-                suit_lst.append(rec)
+        self._ensure_indexed()
+        suit_lst = [self.data.read(name) for name in self.birthday_index.upcoming(days)]
         if not suit_lst:
             suit_lst.append(f"{BLUE}Noone has birthday in {days} days!{RESET}")
-        for i in range(0, len(suit_lst)):
-            yield islice(suit_lst, i, i+1)
-            
+        for rec in suit_lst:
+            yield [rec]
+
+    @metrics.timed("persistence")
+    def _log(self, op: str, name: str, args: tuple) -> None:
+        if self.journal is None:
+            return
+        entry = pickle.dumps((op, name, args))
+        if self._pending is not None:
+            self._pending.append(entry)
+        else:
+            self.journal.write(entry)
+            self.journal.flush()
+        self._journal_len += 1
+
+    @contextmanager
+    def batch(self):
+        '''
+        Journal entries of the changes made inside the block
+        are written at once when it ends. A nested batch (e.g. an import
+        run from a script) joins the outer one, which does the writing.
+        '''
+        if self._pending is not None:
+            yield self
+            return
+        self._pending = []
+        try:
+            yield self
+        finally:
+            self._write_pending()
+            self._pending = None
+
+    @metrics.timed("persistence")
+    def _write_pending(self) -> None:
+        if self._pending and self.journal is not None:
+            self.journal.write(b"".join(self._pending))
+            self.journal.flush()
+            self._pending.clear()
 
-    def save(self, filename="book.dat", format='bin') -> None:
-        with open(filename, 'wb') as fh:
-            pickle.dump(self.data, fh)
+    def _apply(self, op: str, name: str, args: tuple) -> None:
+        if op == "add_record":
+            self.data[name] = args[0]
+        elif op == "delete":
+            self.data.pop(name, None)
+        else:
+            getattr(self.data[name], op)(*args)
+
+    def _replay(self, journal_name: str) -> bool:
+        '''
+        Apply journal entries on top of the loaded snapshot.
+        Returns False if there is no journal for the current snapshot generation.
+        '''
+        try:
+            fh = open(journal_name, 'rb')
+        except FileNotFoundError:
+            return False
+        with fh:
+            try:
+                header = pickle.load(fh)
+            except (EOFError, pickle.UnpicklingError):
+                return False
+            if header != ("generation", self.generation):
+                # stale journal, already folded into the snapshot
+                return False
+            while True:
+                try:
+                    op, name, args = pickle.load(fh)
+                except (EOFError, pickle.UnpicklingError):
+                    # end of journal or a torn last entry after a crash
+                    break
+                try:
+                    self._apply(op, name, args)
+                except (KeyError, ValueError, AttributeError):
+                    continue
+                self._journal_len += 1
+        return True
+
+    def _open_journal(self, append: bool) -> None:
+        self.journal = open(self.filename + JOURNAL_SUFFIX, 'ab' if append else 'wb')
+        if not append:
+            pickle.dump(("generation", self.generation), self.journal)
+            self.journal.flush()
+            self._journal_len = 0
+
+    def close(self) -> None:
+        if self.journal is not None:
+            self._write_pending()
+            self.journal.close()
+            self.journal = None
+
+    @metrics.timed("persistence")
+    def compact(self, filename=FILENAME) -> None:
+        '''
+        Write a new snapshot next to the old one, swap it in atomically
+        and start an empty journal. Records that were not decoded are
+        copied over as they are.
+        '''
+        self.close()
+        self.filename = filename
+        self.generation += 1
+        tmp_name = filename + ".tmp"
+        encode = self._encode
+        write_store(tmp_name, ((name, raw if raw is not None else encode(record))
+                               for name, (record, raw) in self.data.raw_items()), self.generation)
+        # unmap the old snapshot before replacing it
+        self.data.close()
+        os.replace(tmp_name, filename)
+        self.data.reopen(RecordStore(filename))
+        self._open_journal(append=False)
+
+    @metrics.timed("persistence")
+    def save(self, filename=FILENAME, format='bin') -> None:
+        if self.journal is None or filename != self.filename or self._journal_len >= COMPACT_EVERY:
+            self.compact(filename)
+        else:
+            self._write_pending()
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
 
-    def load(self, filename="book.dat", format='bin') -> None:
+    @metrics.timed("persistence")
+    def load(self, filename=FILENAME, format='bin') -> None:
+        self.close()
+        self.data.close()
+        self.filename = filename
+        self.generation = 0
+        self._journal_len = 0
+        self._loading = True
+        snapshot_found = True
         try:
-            with open(filename, 'rb') as fh:
-                self.data = pickle.load(fh)
+            if RecordStore.is_store(filename):
+                store = RecordStore(filename)
+                self.generation = store.generation
+                self.data = RecordMap(store, self._decode)
+            else:
+                # pickled dict of records written before the record store
+                with open(filename, 'rb') as fh:
+                    records = pickle.load(fh)
+                    try:
+                        self.generation = pickle.load(fh)
+                    except EOFError:
+                        # plain pickle written before the journal existed
+                        pass
+                self.data = RecordMap(decode=self._decode)
+                self.data.update(records)
         except FileNotFoundError:
+            self.data = RecordMap(decode=self._decode)
+            snapshot_found = False
+        journal_found = self._replay(filename + JOURNAL_SUFFIX)
+        self._loading = False
+        if not snapshot_found and not journal_found:
             print(f'{BLUE}File not found, using new book.{RESET}')
+        for record in self.data.loaded.values():
+            record.book = self
+        self._indexed = False
+        self._open_journal(append=journal_found)
@@ -0,0 +1,265 @@
+from itertools import islice
+from pathlib import Path
+import csv
+import json
+
+from classes import Record, AddressBook
+from fields import Phone, Email, Birthday, validate_phones, validate_emails, parse_date, parse_dates
+
+
+# rows validated and added to the book at a time
+CHUNK_SIZE = 1000
+# errors listed in the import summary
+ERRORS_SHOWN = 20
+FIELDS = ("name", "phones", "emails", "birthday", "address")
+# several phones or emails in one CSV cell
+MULTI_SEPARATOR = ";"
+FORMATS = {".csv": "csv", ".vcf": "vcard", ".vcard": "vcard", ".jsonl": "jsonl"}
+
+
+def get_format(filename: str) -> str:
+    fmt = FORMATS.get(Path(filename).suffix.lower())
+    if fmt is None:
+        raise ValueError(f"Unknown format of {filename}, use one of: {', '.join(FORMATS)}")
+    return fmt
+
+def _values(value) -> list:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(MULTI_SEPARATOR)
+    elif not isinstance(value, list):
+        # a JSON number or boolean instead of a string or a list
+        value = [value]
+    return [str(v).strip() for v in value if str(v).strip()]
+
+def read_csv(fh):
+    '''
+    Yield (line number, row) from a CSV file with a header of FIELDS
+    '''
+    reader = csv.DictReader(fh)
+    for row in reader:
+        yield reader.line_num, row
+
+def read_jsonl(fh):
+    '''
+    Yield (line number, row or error message) from a JSON Lines file
+    '''
+    for line_num, line in enumerate(fh, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield line_num, f"bad JSON: {error}"
+            continue
+        if not isinstance(row, dict):
+            yield line_num, "not a JSON object"
+            continue
+        yield line_num, row
+
+def vcard_escape(value: str) -> str:
+    '''
+    Escape a text value as RFC 6350 asks: backslash, comma, semicolon, newline
+    '''
+    return (value.replace("\\", "\\\\").replace(",", "\\,").replace(";", "\\;")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+def vcard_split(value: str, separator=None) -> list:
+    '''
+    Split a vCard value on the separators that are not escaped,
+    and unescape the parts
+    '''
+    parts, current = [], []
+    chars = iter(value)
+    for char in chars:
+        if char == "\\":
+            char = next(chars, "")
+            current.append("\n" if char in ("n", "N") else char)
+        elif char == separator:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+    parts.append("".join(current))
+    return parts
+
+def _unfolded(fh):
+    '''
+    Yield (line number, line) with folded lines (continued by a line
+    starting with a space or a tab) joined back
+    '''
+    line_num, line = 0, None
+    for num, raw in enumerate(fh, 1):
+        raw = raw.rstrip("\r\n")
+        if raw[:1] in (" ", "\t") and line is not None:
+            line += raw[1:]
+            continue
+        if line is not None:
+            yield line_num, line
+        line_num, line = num, raw
+    if line is not None:
+        yield line_num, line
+
+def read_vcard(fh):
+    '''
+    Yield (line number of BEGIN, row) for every vCard in the file
+    '''
+    row, start = None, 0
+    for line_num, line in _unfolded(fh):
+        line = line.strip()
+        if not line:
+            continue
+        key, _, value = line.partition(":")
+        # drop parameters like TEL;TYPE=cell
+        key = key.split(";")[0].upper()
+        if key == "BEGIN":
+            row, start = {"phones": [], "emails": []}, line_num
+        elif row is None:
+            continue
+        elif key == "END":
+            yield start, row
+            row = None
+        elif key == "FN":
+            row["name"] = vcard_split(value)[0]
+        elif key == "TEL":
+            row["phones"].append(vcard_split(value)[0])
+        elif key == "EMAIL":
+            row["emails"].append(vcard_split(value)[0])
+        elif key == "BDAY":
+            row["birthday"] = value
+        elif key == "ADR":
+            row["address"] = ", ".join(part for part in vcard_split(value, ";") if part)
+
+READERS = {"csv": read_csv, "jsonl": read_jsonl, "vcard": read_vcard}
+
+def validate_chunk(chunk: list) -> tuple:
+    '''
+    Build records for a chunk of (line number, row).
+    Phones, emails and birthdays of the whole chunk are validated
+    column by column. Returns (records, errors) where errors are
+    (line number, message)
+    '''
+    rows, errors = [], []
+    for line_num, row in chunk:
+        if isinstance(row, str):
+            errors.append((line_num, row))
+            continue
+        name = str(row.get("name") or "").strip()
+        if not name:
+            errors.append((line_num, "no name"))
+            continue
+        rows.append((line_num, name, _values(row.get("phones")), _values(row.get("emails")),
+                     str(row.get("birthday") or "").strip(), str(row.get("address") or "").strip()))
+    phones_ok = iter(validate_phones([phone for row in rows for phone in row[2]]))
+    emails_ok = iter(validate_emails([email for row in rows for email in row[3]]))
+    birthdays = iter(parse_dates([row[4] for row in rows if row[4]]))
+
+    records = []
+    for line_num, name, phones, emails, birthday, address in rows:
+        # take every flag of the row so the columns stay aligned
+        bad_phone = not all([next(phones_ok) for _ in phones])
+        bad_email = not all([next(emails_ok) for _ in emails])
+        birthday = next(birthdays) if birthday else False
+        if bad_phone or bad_email or birthday is None:
+            field = "phone" if bad_phone else "email" if bad_email else "birthday"
+            errors.append((line_num, f"bad {field}"))
+            continue
+        record = Record(name)
+        record.phones = [Phone.checked(phone) for phone in dict.fromkeys(phones)]
+        record.emails = [Email.checked(email) for email in dict.fromkeys(emails)]
+        if birthday:
+            record.birthday = Birthday.checked(birthday)
+        record.address = address or None
+        records.append(record)
+    errors.sort()
+    return records, errors
+
+def _merge(book: AddressBook, record: Record) -> None:
+    old = book.data.get(record.name.value)
+    if old is None:
+        book.add_record(record)
+        return
+    for phone in record.phones:
+        old.add_phone(phone.value)
+    for email in record.emails:
+        old.add_email(email.value)
+    if record.birthday is not None:
+        old.add_birthday(record.birthday.value.strftime("%d.%m.%Y"))
+    if record.address:
+        old.add_address(record.address)
+
+def import_contacts(book: AddressBook, filename: str) -> tuple:
+    '''
+    Stream contacts from a CSV, vCard or JSON Lines file into book,
+    CHUNK_SIZE rows at a time. Existing contacts are merged.
+    Returns (number of imported rows, [(line number, error)])
+    '''
+    reader = READERS[get_format(filename)]
+    imported, errors = 0, []
+    with open(filename, 'r', encoding='utf-8', newline='') as fh, book.batch():
+        rows = reader(fh)
+        while True:
+            chunk = list(islice(rows, CHUNK_SIZE))
+            if not chunk:
+                break
+            records, chunk_errors = validate_chunk(chunk)
+            for record in records:
+                _merge(book, record)
+            imported += len(records)
+            errors.extend(chunk_errors)
+    return imported, errors
+
+def _row(record: Record) -> dict:
+    birthday = record.birthday.value.strftime("%d.%m.%Y") if record.birthday is not None else ""
+    return {"name": record.name.value,
+            "phones": [phone.value for phone in record.phones],
+            "emails": [email.value for email in record.emails],
+            "birthday": birthday,
+            "address": str(record.address or "")}
+
+def _write_csv(fh, rows) -> None:
+    writer = csv.DictWriter(fh, FIELDS)
+    writer.writeheader()
+    for row in rows:
+        row["phones"] = MULTI_SEPARATOR.join(row["phones"])
+        row["emails"] = MULTI_SEPARATOR.join(row["emails"])
+        writer.writerow(row)
+
+def _write_jsonl(fh, rows) -> None:
+    for row in rows:
+        fh.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+def _write_vcard(fh, rows) -> None:
+    for row in rows:
+        lines = ["BEGIN:VCARD", "VERSION:3.0", f"FN:{vcard_escape(row['name'])}"]
+        lines.extend(f"TEL:{phone}" for phone in row["phones"])
+        lines.extend(f"EMAIL:{vcard_escape(email)}" for email in row["emails"])
+        if row["birthday"]:
+            lines.append("BDAY:" + parse_date(row["birthday"]).isoformat())
+        if row["address"]:
+            # the whole address is the street part
+            lines.append(f"ADR:;;{vcard_escape(row['address'])};;;;")
+        lines.append("END:VCARD")
+        fh.write("\n".join(lines) + "\n")
+
+WRITERS = {"csv": _write_csv, "jsonl": _write_jsonl, "vcard": _write_vcard}
+
+def export_contacts(book: AddressBook, filename: str) -> int:
+    '''
+    Stream all contacts of book to a CSV, vCard or JSON Lines file.
+    Returns the number of exported contacts.
+    '''
+    writer = WRITERS[get_format(filename)]
+    count = 0
+
+    def rows():
+        nonlocal count
+        for page in book.iterator(CHUNK_SIZE):
+            for record in page:
+                count += 1
+                yield _row(record)
+
+    with open(filename, 'w', encoding='utf-8', newline='') as fh:
+        writer(fh, rows())
+    return count
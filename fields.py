@@ -1,73 +1,172 @@
-from datetime import datetime
+from datetime import datetime, date, timedelta
 import re
+import time
+
+
+PHONE_LENGTH = 10
+EMAIL_RE = re.compile(r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+')
+# DD.MM.YYYY, YYYY-MM-DD or YYYYMMDD
+DATE_RE = re.compile(r'(\d\d?)\.(\d\d?)\.(\d{4})|(\d{4})-?(\d\d)-?(\d\d)', re.ASCII)
+
+# date.today() and the time it stops being today
+_today = [None, 0.0]
+
+
+def today() -> date:
+    '''
+    Current date, looked up again only after midnight
+    '''
+    day, expires = _today
+    now = time.time()
+    if now >= expires:
+        day = date.today()
+        midnight = datetime.combine(day + timedelta(days=1), datetime.min.time())
+        _today[:] = day, midnight.timestamp()
+    return day
+
+def is_phone(value: str) -> bool:
+    return len(value) == PHONE_LENGTH and value.isdigit()
+
+def is_email(value: str) -> bool:
+    return EMAIL_RE.fullmatch(value) is not None
+
+def parse_date(value: str) -> date:
+    '''
+    Date from DD.MM.YYYY, YYYY-MM-DD or YYYYMMDD.
+    Raises ValueError for anything else.
+    '''
+    match = DATE_RE.fullmatch(value)
+    if match is None:
+        raise ValueError(value)
+    day, month, year, iso_year, iso_month, iso_day = match.groups()
+    if year is None:
+        year, month, day = iso_year, iso_month, iso_day
+    return date(int(year), int(month), int(day))
+
+def validate_phones(values) -> list:
+    '''
+    [True/False] for a column of phones
+    '''
+    return [len(value) == PHONE_LENGTH and value.isdigit() for value in values]
+
+def validate_emails(values) -> list:
+    '''
+    [True/False] for a column of emails
+    '''
+    fullmatch = EMAIL_RE.fullmatch
+    return [fullmatch(value) is not None for value in values]
+
+def parse_dates(values) -> list:
+    '''
+    [date or None] for a column of birthdays,
+    None for a bad date or a date in the future
+    '''
+    current = today()
+    result = []
+    for value in values:
+        try:
+            parsed = parse_date(value)
+        except ValueError:
+            parsed = None
+        result.append(parsed if parsed is not None and parsed <= current else None)
+    return result
 
 
 class Field:
+    # one slot instead of a __dict__ per phone or email
+    __slots__ = ("_value",)
+
     def __init__(self, value: str) -> None:
-        self.__value = None
+        self._value = None
         self.value = value
 
+    @classmethod
+    def checked(cls, value):
+        '''
+        Field from a value already validated by the batch functions
+        '''
+        field = cls.__new__(cls)
+        field._value = value
+        return field
+
     def __str__(self) -> str:
-        return str(self.__value)
+        return str(self._value)
+
+    def __getstate__(self):
+        return self._value
+
+    def __setstate__(self, state) -> None:
+        if isinstance(state, dict):
+            # pickled before slots: {"_Field__value": None, "_Phone__value": ...}
+            state = next((value for key, value in state.items()
+                          if key.endswith("_value") and value is not None), None)
+        self._value = state
 
 class Name(Field):
+    __slots__ = ()
+
     @property
     def value(self) -> str:
-        return self.__value
-    
+        return self._value
+
     @value.setter
     def value(self, value) -> None:
-        self.__value = value
+        self._value = value
 
 class Phone(Field):
+    __slots__ = ()
+
     @property
     def value(self):
-        return self.__value
+        return self._value
 
     @value.setter
     def value(self, new_value: str):
-        PHONE_LENGTH = 10
-        if not all([len(new_value) == PHONE_LENGTH, new_value.isdigit()]):
+        if not is_phone(new_value):
             raise ValueError
-        self.__value = new_value
+        self._value = new_value
 
 class Birthday(Field):
+    __slots__ = ()
+
     @property
     def value(self):
-        return self.__value
+        return self._value
 
     @value.setter
     def value(self, new_date: str) -> str:
-        today = datetime.now().date()
-        date_to_check = datetime.strptime(new_date, '%d.%m.%Y').date()
-        if today < date_to_check:
+        date_to_check = parse_date(new_date)
+        if today() < date_to_check:
             raise ValueError
-        self.__value = date_to_check
+        self._value = date_to_check
 
 
     def __str__(self):
-        return datetime.strftime(self.__value, '%d %B')
-    
+        return datetime.strftime(self._value, '%d %B')
+
 class Address(Field):
+    __slots__ = ()
+
     @property
     def value(self) -> str:
-        return self.__value
-    
+        return self._value
+
     @value.setter
     def value(self, value) -> None:
-        self.__value = value
+        self._value = value
 
 class Email(Field):
+    __slots__ = ()
+
     @property
     def value(self):
-        return self.__value
+        return self._value
 
     @value.setter
     def value(self, new_email: str):
-        result = re.findall(r'(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)', new_email)
-        if new_email not in result:
+        if not is_email(new_email):
             raise ValueError
-        self.__value = new_email   
+        self._value = new_email
 
     def __str__(self):
-        return self.__value
\ No newline at end of file
+        return self._value
@@ -1,7 +1,20 @@
-# import sys
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import lru_cache
 from pathlib import Path
+from threading import BoundedSemaphore, Lock
+from time import perf_counter, time
+from types import MappingProxyType
+import hashlib
+import json
+import mmap
+import os
+import random
 import shutil
 import re
+import sys
+import tempfile
+import zipfile
 
 
 RED = "\033[91m"
@@ -14,19 +27,97 @@ CATEGORIES = {"Images": [".jpg", ".gif", ".png", ".svg"],
               "Audio": [".mp3", ".wav", ".flac", ".wma", ".ogg", ".amr"],
               "Docs": [".doc", ".docx", ".txt", ".rtf", ".pdf", ".epub", ".xls", ".xlsx", ".ppt", ".pptx"],
               "Video": [".avi", ".mp4", ".wmv", ".mov", ".mkv"],
-              "Archives": [".zip", ".tar", ".gztar", ".bztar", ".xztar"]
+              "Archives": [".zip", ".tar", ".gztar", ".bztar", ".xztar",
+                           ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz"]
               }
+UNKNOWN = "Unknown"
+# user rules, {"Category": [".ext", ...]}, extend or override CATEGORIES
+CONFIG_FILE = "folder_sort.json"
 
-TRANS = {}
+# (offset, signature, category) for files without extension
+MAGIC_NUMBERS = ((0, b"\x89PNG\r\n\x1a\n", "Images"),
+                 (0, b"\xff\xd8\xff", "Images"),
+                 (0, b"GIF8", "Images"),
+                 (0, b"%PDF", "Docs"),
+                 (0, b"{\\rtf", "Docs"),
+                 (0, b"ID3", "Audio"),
+                 (0, b"fLaC", "Audio"),
+                 (0, b"OggS", "Audio"),
+                 (8, b"WAVE", "Audio"),
+                 (8, b"AVI ", "Video"),
+                 (4, b"ftyp", "Video"),
+                 (0, b"\x1aE\xdf\xa3", "Video"),
+                 (0, b"PK\x03\x04", "Archives"),
+                 (0, b"\x1f\x8b", "Archives"),
+                 (0, b"BZh", "Archives"),
+                 (0, b"\xfd7zXZ\x00", "Archives"),
+                 (257, b"ustar", "Archives"))
+SNIFF_SIZE = max(offset + len(magic) for offset, magic, _ in MAGIC_NUMBERS)
 
-def initialize_translation_table() -> None:
-    CYRILLIC_SYMBOLS = "абвгдеёжзийклмнопрстуфхцчшщъыьэюяєіїґ"
-    TRANSLATION = ("a", "b", "v", "g", "d", "e", "e", "j", "z", "y", "j", "k", "l", "m", "n", "o", "p", "r", "s", "t", "u",
-                "f", "h", "ts", "ch", "sh", "sch", "", "y", "", "e", "yu", "ya", "je", "i", "ji", "g")
+# number of mover threads, moves are bound by syscall latency, not CPU
+WORKERS = 8
+# scanned files waiting for a mover, per worker
+QUEUE_PER_WORKER = 64
+# processes unpacking archives at the same time
+ARCHIVE_WORKERS = os.cpu_count() or 2
+# uncompressed bytes allowed to be unpacked at the same time
+EXTRACT_BUDGET = 1 << 30
+# tar members can't be listed without decompressing, guess the unpacked size
+TAR_RATIO = 3
+# log of the moves, kept in the sorted folder
+JOURNAL_NAME = ".folder_sort.journal"
+# moves written to the journal at once
+JOURNAL_BATCH = 256
+# digests of files by (inode, mtime), kept in the sorted folder
+HASHES_NAME = ".folder_sort.hashes"
+# directory listing of the previous run, for incremental sorting
+STATE_NAME = ".folder_sort.state"
+SERVICE_FILES = frozenset({JOURNAL_NAME, HASHES_NAME, STATE_NAME})
+# bytes read from the start and the end of a file for the quick hash
+HASH_BLOCK = 1 << 16
+# what to do with duplicates: report (leave them in place),
+# link (hard link to the first copy) or rename (sort them as usual)
+DEDUP_MODES = ("report", "link", "rename")
+# duplicate groups listed in the summary
+DUPLICATES_SHOWN = 20
+# moves listed by a dry run
+PLAN_SHOWN = 100
 
+CYRILLIC_SYMBOLS = "абвгдеёжзийклмнопрстуфхцчшщъыьэюяєіїґ"
+TRANSLATION = ("a", "b", "v", "g", "d", "e", "e", "j", "z", "y", "j", "k", "l", "m", "n", "o", "p", "r", "s", "t", "u",
+               "f", "h", "ts", "ch", "sh", "sch", "", "y", "", "e", "yu", "ya", "je", "i", "ji", "g")
+# normalized stems kept in memory
+NORMALIZE_CACHE = 1 << 16
+
+class TranslationTable(dict):
+    '''
+    str.translate table doing the whole normalize() in one pass:
+    Cyrillic letters -> Latin, other word characters (like re's \\w) stay,
+    everything else -> '_'. Characters not seen before are classified
+    on first lookup and remembered.
+    '''
+    def __missing__(self, code: int) -> str:
+        char = chr(code)
+        value = char if char.isalnum() or char == "_" else "_"
+        self[code] = value
+        return value
+
+def build_translation_table() -> TranslationTable:
+    table = TranslationTable()
+    for code in range(128):
+        table[code]
     for c, l in zip(CYRILLIC_SYMBOLS, TRANSLATION):
-        TRANS[ord(c)] = l
-        TRANS[ord(c.upper())] = l.upper()
+        table[ord(c)] = l
+        table[ord(c.upper())] = l.upper()
+    return table
+
+TRANS = build_translation_table()
+# the same table for ASCII-only names, as a bytes.translate table
+ASCII_TRANS = bytes(ord(TRANS[code]) for code in range(128)) + bytes(range(128, 256))
+
+@lru_cache(maxsize=NORMALIZE_CACHE)
+def _normalize_unicode(name: str) -> str:
+    return name.translate(TRANS)
 
 def normalize(name:str ) -> str:
     '''
@@ -35,68 +126,751 @@ def normalize(name:str ) -> str:
     транслітерація може не відповідати стандарту, але бути читабельною;
     великі літери залишаються великими, а маленькі — маленькими після транслітерації.   
     '''
-    # TODO: спробувати обійтися без 're'
-    return re.sub('\W', '_', name.translate(TRANS))
+    if name.isascii():
+        # bytes.translate is a plain table lookup, cheaper than a cache hit
+        return name.encode().translate(ASCII_TRANS).decode()
+    return _normalize_unicode(name)
+
+def bench_normalize(count=1_000_000, seed=1) -> str:
+    '''
+    Per-name cost of normalize() on count synthetic file names,
+    compared with the old translate + re.sub version
+    '''
+    rnd = random.Random(seed)
+    latin = "abcdefXYZ0123456789_ -.()[]!"
+    cyrillic = CYRILLIC_SYMBOLS + CYRILLIC_SYMBOLS.upper() + "_ -0123456789"
+
+    def synthetic_name():
+        # about a third of the names are Cyrillic
+        alphabet = cyrillic if rnd.random() < 0.3 else latin
+        return "".join(rnd.choice(alphabet) for _ in range(rnd.randint(5, 30)))
+
+    # a tenth of the names repeat, like "IMG_0001" style stems do
+    stems = [synthetic_name() for _ in range(count // 100)]
+    names = [rnd.choice(stems) if rnd.random() < 0.1 else synthetic_name() for _ in range(count)]
+    old_table = {}
+    for c, l in zip(CYRILLIC_SYMBOLS, TRANSLATION):
+        old_table[ord(c)] = l
+        old_table[ord(c.upper())] = l.upper()
+
+    def old(name):
+        return re.sub('\\W', '_', name.translate(old_table))
+
+    results = []
+    for title, func in (("re.sub", old), ("normalize", normalize)):
+        _normalize_unicode.cache_clear()
+        start = perf_counter()
+        for name in names:
+            func(name)
+        elapsed = perf_counter() - start
+        results.append(f'{title}: {elapsed:.3f}s, {elapsed / count * 1e9:.0f} ns/name')
+    info = _normalize_unicode.cache_info()
+    results.append(f'cache: {info.hits} hits, {info.misses} misses')
+    return "\n".join(results)
+
+class CategoryResolver:
+    '''
+    Extension -> category table built once.
+    Multi-part extensions (.tar.gz) win over their last part,
+    files without extension are recognised by their first bytes.
+    '''
+    def __init__(self, categories: dict) -> None:
+        table = {}
+        for cat, extensions in categories.items():
+            for ext in extensions:
+                table[ext.lower()] = cat
+        self.extensions = MappingProxyType(table)
+        self.names = frozenset(categories) | {UNKNOWN}
+        self.max_parts = max((ext.count(".") for ext in table), default=1)
+
+    @classmethod
+    def from_config(cls, filename=CONFIG_FILE) -> "CategoryResolver":
+        categories = {cat: list(ext) for cat, ext in CATEGORIES.items()}
+        try:
+            with open(filename, 'r') as fh:
+                rules = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            rules = {}
+        for cat, extensions in rules.items():
+            categories[cat] = [ext if ext.startswith(".") else "." + ext for ext in extensions]
+        return cls(categories)
+
+    def classify(self, name: str, path=None) -> tuple:
+        '''
+        Returns (category, extension) for a file name.
+        The extension keeps its case and may have several parts.
+        '''
+        lower = name.lower()
+        category, extension = None, ""
+        start = len(lower)
+        for _ in range(self.max_parts):
+            # a leading dot is a hidden file, not an extension
+            start = lower.rfind(".", 1, start)
+            if start <= 0:
+                break
+            if not extension:
+                extension = name[start:]
+            found = self.extensions.get(lower[start:])
+            if found:
+                category, extension = found, name[start:]
+        if category is None and not extension and path is not None:
+            category = self.sniff(path)
+        return category or UNKNOWN, extension
+
+    @staticmethod
+    def sniff(path) -> str:
+        try:
+            with open(path, 'rb') as fh:
+                head = fh.read(SNIFF_SIZE)
+        except OSError:
+            return None
+        for offset, magic, cat in MAGIC_NUMBERS:
+            if head.startswith(magic, offset):
+                return cat
+        return None
+
+
+RESOLVER = CategoryResolver.from_config()
 
 def get_category(entry:Path) -> str:
     '''
-    Get file category based on file extension from global const CATEGORIES
+    Get file category based on file extension (or content if there is none)
     '''
-    extension = entry.suffix.lower()
-    for cat, ext in CATEGORIES.items():
-        if extension in ext:
-            return cat
-    return 'Unknown'
-    # ^^^ hadrcode ??
+    return RESOLVER.classify(entry.name, entry)[0]
 
-def move_file(file, category, base_dir) -> None:
+def move_file(file: str, new_file: str, suffix="") -> str:
     '''
-    Move file to a directory named by a category (create if not exists)), with base_dir
+    Move file to new_file, or to new_file_1, new_file_2... if the name is taken.
+    os.link never overwrites, so concurrent movers can't take the same name;
+    without hard links the name is reserved with O_EXCL before the move.
+    Returns the final destination.
     '''
-    category_dir = base_dir.joinpath(category)
-    if not category_dir.exists():
-        category_dir.mkdir()
-    new_name = normalize(file.stem) + file.suffix
-    new_file = category_dir.joinpath(new_name)
-    if not new_file.exists():
-        file.replace(new_file)
-    # else:
-    # TODO: use another destination file name 
+    base = new_file[:len(new_file)-len(suffix)]
+    candidate = new_file
+    n = 0
+    while True:
+        try:
+            os.link(file, candidate)
+        except FileExistsError:
+            pass
+        except OSError:
+            # no hard links on this file system
+            if _reserve(candidate):
+                try:
+                    os.replace(file, candidate)
+                except OSError:
+                    os.unlink(candidate)
+                    raise
+                return candidate
+        else:
+            os.unlink(file)
+            return candidate
+        n += 1
+        candidate = f"{base}_{n}{suffix}"
 
-def process_dir(directory: Path) -> None:
+def _reserve(name: str) -> bool:
     '''
-    Process all files in the given directory
+    Create an empty name, False if it already exists
     '''
-    for entry in directory.glob("**/*"):
-        # skip directories
-        if entry.is_file():
-            category = get_category(entry)
-            move_file(entry, category, directory)
+    try:
+        os.close(os.open(name, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    return True
+
+class MoveJournal:
+    '''
+    Moves made in a folder, one JSON line per move: [src, dst, inode, size].
+    Every run starts with a {"run": ...} line and ends with {"done": ...}.
+    Moves are buffered and written JOURNAL_BATCH at a time.
+    '''
+    def __init__(self, directory: Path) -> None:
+        self.filename = directory.joinpath(JOURNAL_NAME)
+        self.batch = []
+        self.lock = Lock()
+        self.fh = None
+
+    def runs(self) -> list:
+        '''
+        Returns [{"moves": [...], "done": bool}, ...] oldest first
+        '''
+        runs = []
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as fh:
+                for line in fh:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        # torn line after a crash
+                        continue
+                    if isinstance(item, list):
+                        if runs:
+                            runs[-1]["moves"].append(item)
+                    elif "run" in item:
+                        runs.append({"moves": [], "done": False})
+                    elif "done" in item and runs:
+                        runs[-1]["done"] = True
+        except FileNotFoundError:
+            pass
+        return runs
+
+    def start(self, resume=False) -> dict:
+        '''
+        Open the journal for a run. With resume an unfinished last run is continued.
+        Returns dst -> inode of every move recorded so far.
+        '''
+        runs = self.runs()
+        self.fh = open(self.filename, 'a', encoding='utf-8')
+        if not (resume and runs and not runs[-1]["done"]):
+            self.fh.write(json.dumps({"run": time()}) + "\n")
+            self.fh.flush()
+        return self.completed(runs)
+
+    def completed(self, runs=None) -> dict:
+        '''
+        dst -> inode of every move recorded so far
+        '''
+        runs = self.runs() if runs is None else runs
+        return {dst: inode for run in runs for src, dst, inode, size in run["moves"]}
+
+    def add(self, src: str, dst: str, inode: int, size: int) -> None:
+        with self.lock:
+            self.batch.append(json.dumps([src, dst, inode, size], ensure_ascii=False) + "\n")
+            if len(self.batch) >= JOURNAL_BATCH:
+                self._flush()
+
+    def _flush(self) -> None:
+        self.fh.write("".join(self.batch))
+        self.fh.flush()
+        self.batch = []
+
+    def finish(self) -> None:
+        with self.lock:
+            self._flush()
+        self.fh.write(json.dumps({"done": time()}) + "\n")
+        self.close()
+
+    def close(self) -> None:
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def undo(self) -> tuple:
+        '''
+        Move the files of the last run back, newest move first, and drop the run.
+        Files changed since (other inode) are left alone.
+        Unpacked archives are not packed back.
+        Returns (restored, skipped)
+        '''
+        runs = self.runs()
+        # runs that moved nothing are dropped together with the last real one
+        target = max((i for i, run in enumerate(runs) if run["moves"]), default=None)
+        if target is None:
+            return 0, 0
+        restored = skipped = 0
+        for src, dst, inode, size in reversed(runs[target]["moves"]):
+            try:
+                if os.stat(dst).st_ino != inode or os.path.exists(src):
+                    skipped += 1
+                    continue
+                os.makedirs(os.path.dirname(src), exist_ok=True)
+                os.replace(dst, src)
+                restored += 1
+            except OSError:
+                skipped += 1
+                continue
+            try:
+                # category directory left empty
+                os.rmdir(os.path.dirname(dst))
+            except OSError:
+                pass
+        lines = []
+        with open(self.filename, 'r', encoding='utf-8') as fh:
+            for line in fh:
+                lines.append(line)
+        # keep everything before the header of the undone run
+        headers = [i for i, line in enumerate(lines) if line.startswith('{"run"')]
+        cut = headers[target]
+        if cut:
+            with open(self.filename, 'w', encoding='utf-8') as fh:
+                fh.writelines(lines[:cut])
+        else:
+            os.unlink(self.filename)
+        return restored, skipped
+
+class ScanState:
+    '''
+    Directory listing remembered between runs in STATE_NAME:
+    path -> [mtime_ns, subdirectories, files].
+    A directory with the same mtime as last time has no new entries,
+    so it is not listed again; only its subdirectories are visited.
+    '''
+    def __init__(self, directory: Path) -> None:
+        self.filename = directory.joinpath(STATE_NAME)
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as fh:
+                self.old = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            self.old = {}
+        self.dirs = {}
+        self.dirty = set()
+
+    def visit(self, path: str, mtime: int):
+        '''
+        Returns (subdirectories, known files) remembered for an unchanged
+        directory, or (None, known files) if it has to be listed again
+        '''
+        old = self.old.get(path)
+        if old is not None and old[0] == mtime:
+            self.dirs[path] = [mtime, set(old[1]), set(old[2])]
+            return old[1], None
+        return None, set(old[2]) if old is not None else set()
+
+    def listed(self, path: str, mtime: int, subdirs: list, files: list) -> None:
+        self.dirs[path] = [mtime, set(subdirs), set(files)]
+        self.dirty.add(path)
+
+    def moved(self, src: str, dst: str) -> None:
+        src_dir, src_name = os.path.split(src)
+        dst_dir, dst_name = os.path.split(dst)
+        if src_dir in self.dirs:
+            self.dirs[src_dir][2].discard(src_name)
+        if dst_dir not in self.dirs:
+            self.dirs[dst_dir] = [0, set(), set()]
+            parent = os.path.dirname(dst_dir)
+            if parent in self.dirs:
+                self.dirs[parent][1].add(dst_dir)
+        self.dirs[dst_dir][2].add(dst_name)
+        self.dirty.update((src_dir, dst_dir))
+
+    def save(self) -> None:
+        for path in self.dirty:
+            try:
+                self.dirs[path][0] = os.stat(path).st_mtime_ns
+            except OSError:
+                # removed by the clean up
+                self.dirs.pop(path, None)
+        data = {path: [mtime, sorted(subdirs), sorted(files)] for path, (mtime, subdirs, files) in self.dirs.items()}
+        with open(self.filename, 'w', encoding='utf-8') as fh:
+            json.dump(data, fh)
+
+def scan_dir(directory: Path, state=None):
+    '''
+    Yield os.DirEntry for every file below directory.
+    os.scandir gets the file type from the directory listing, no extra stat per file.
+    With state (ScanState) unchanged directories are skipped and
+    only files that were not there last time are yielded.
+    '''
+    stack = [str(directory)]
+    while stack:
+        path = stack.pop()
+        try:
+            known = ()
+            if state is not None:
+                mtime = os.stat(path).st_mtime_ns
+                subdirs, known = state.visit(path, mtime)
+                if subdirs is not None:
+                    stack.extend(subdirs)
+                    continue
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        subdirs, files = [], []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                files.append(entry)
+        stack.extend(subdirs)
+        if state is not None:
+            state.listed(path, mtime, subdirs, [entry.name for entry in files])
+        for entry in files:
+            if entry.name not in known:
+                yield entry
+
+class HashCache:
+    '''
+    File digests by (inode, mtime), kept between runs in HASHES_NAME.
+    Only the files seen by the current scan are saved, so entries of
+    deleted or changed files don't pile up.
+    '''
+    def __init__(self, directory: Path) -> None:
+        self.filename = directory.joinpath(HASHES_NAME)
+        try:
+            with open(self.filename, 'r') as fh:
+                self.data = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            self.data = {}
+        self.seen = set()
+
+    @staticmethod
+    def _key(entry: os.DirEntry) -> str:
+        stat = entry.stat()
+        return f"{stat.st_ino}:{stat.st_mtime_ns}"
 
-def process_archives(directory: Path) -> None:
+    def keep(self, entries) -> None:
+        '''
+        Mark scanned files, their digests are saved even if not asked for this time
+        '''
+        for entry in entries:
+            try:
+                self.seen.add(self._key(entry))
+            except OSError:
+                # gone since the scan
+                continue
+
+    def digest(self, entry: os.DirEntry, kind: str, hasher) -> str:
+        key = self._key(entry)
+        self.seen.add(key)
+        digests = self.data.get(key, {})
+        if kind not in digests:
+            digests[kind] = hasher(entry.path, entry.stat().st_size)
+            self.data[key] = digests
+        return digests[kind]
+
+    def save(self) -> None:
+        self.data = {key: digests for key, digests in self.data.items() if key in self.seen}
+        with open(self.filename, 'w') as fh:
+            json.dump(self.data, fh)
+
+def quick_hash(path: str, size: int) -> str:
+    '''
+    Hash of the first and the last HASH_BLOCK bytes
+    '''
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as fh:
+        digest.update(fh.read(HASH_BLOCK))
+        if size > HASH_BLOCK:
+            fh.seek(max(HASH_BLOCK, size - HASH_BLOCK))
+            digest.update(fh.read(HASH_BLOCK))
+    return digest.hexdigest()
+
+def full_hash(path: str, size: int) -> str:
+    '''
+    Hash of the whole file, read through mmap
+    '''
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        digest.update(mm)
+    return digest.hexdigest()
+
+def _split_groups(groups: list, pool, cache: HashCache, kind: str, hasher) -> list:
+    '''
+    Split every group of entries by digest, keep the groups that still collide.
+    Files that disappeared or can't be read are left out, like the mover skips them.
+    '''
+    def digest(item):
+        try:
+            return cache.digest(item[1], kind, hasher)
+        except OSError:
+            return None
+
+    flat = [(n, entry) for n, group in enumerate(groups) for entry in group]
+    buckets = defaultdict(list)
+    for (n, entry), digest in zip(flat, pool.map(digest, flat)):
+        if digest is not None:
+            buckets[(n, digest)].append(entry)
+    return [group for group in buckets.values() if len(group) > 1]
+
+def find_duplicates(entries: list, workers=WORKERS, cache=None) -> list:
     '''
-    Unpack archives to archive_name_dir/
-    NB: arch.zip and arch.tar.gz will use the same destination directory
+    Groups of paths with the same content, each in scan order.
+    Files are grouped by size, then by a hash of their first and last block,
+    and only files that still collide are hashed completely.
     '''
-    archive_base_name = directory.joinpath([k for k,v in CATEGORIES.items() if '.zip' in v][0])
-    for archive_name in archive_base_name.glob("*"):
-        archive_dir = archive_base_name.joinpath(archive_name.stem)
-        if not archive_dir.exists:
-            archive_dir.mkdir()
-        shutil.unpack_archive(archive_name, archive_dir, archive_name.suffix[1:])
-        archive_name.unlink()
+    by_size = defaultdict(list)
+    for entry in entries:
+        try:
+            size = entry.stat().st_size
+        except OSError:
+            continue
+        if size:
+            by_size[size].append(entry)
+    groups = [group for group in by_size.values() if len(group) > 1]
+    if not groups:
+        return []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        groups = _split_groups(groups, pool, cache, "quick", quick_hash)
+        # the quick hash already covered small files completely
+        small = [group for group in groups if group[0].stat().st_size <= 2 * HASH_BLOCK]
+        large = [group for group in groups if group[0].stat().st_size > 2 * HASH_BLOCK]
+        groups = small + _split_groups(large, pool, cache, "full", full_hash)
+    return [[entry.path for entry in group] for group in groups]
+
+def plan_moves(directory: Path, completed: dict, state=None):
+    '''
+    Yield (entry, destination, extension) for every file that has to move
+    '''
+    category_dirs = {}
+    for entry in scan_dir(directory, state):
+        if entry.name in SERVICE_FILES:
+            continue
+        if completed.get(entry.path) == entry.inode():
+            # moved here by an earlier run
+            continue
+        category, suffix = RESOLVER.classify(entry.name, entry.path)
+        category_dir = category_dirs.get(category)
+        if category_dir is None:
+            category_dir = category_dirs[category] = os.path.join(directory, category)
+        stem = entry.name[:len(entry.name)-len(suffix)]
+        new_file = os.path.join(category_dir, normalize(stem) + suffix)
+        if new_file != entry.path:
+            yield entry, new_file, suffix
+
+def resolve_names(plan: list) -> list:
+    '''
+    (source, destination) for a planned list of moves, destinations renamed
+    the way move_file will do it: name_1, name_2... when the name exists
+    or was already given to an earlier file of the plan
+    '''
+    claimed = set()
+    resolved = []
+    for entry, new_file, suffix in plan:
+        base = new_file[:len(new_file)-len(suffix)]
+        candidate = new_file
+        n = 0
+        while candidate in claimed or os.path.exists(candidate):
+            n += 1
+            candidate = f"{base}_{n}{suffix}"
+        claimed.add(candidate)
+        resolved.append((entry.path, candidate))
+    return resolved
+
+def process_dir(directory: Path, workers=WORKERS, journal=None, completed=None, dedup=None,
+                state=None, dry_run=False) -> dict:
+    '''
+    Process all files in the given directory.
+    The scanner picks a category and a destination for each file and feeds
+    a bounded pool of mover threads. Returns counters and phase timings.
+    Moves are recorded in journal; files listed in completed (dst -> inode)
+    were moved by an earlier run and are skipped right away.
+    With dedup (one of DEDUP_MODES) the whole plan is collected first
+    and checked for duplicate content.
+    With dry_run nothing is moved, the plan is returned in stats["plan"].
+    '''
+    stats = {"moved": 0, "skipped": 0}
+    stats_lock = Lock()
+    slots = BoundedSemaphore(workers * QUEUE_PER_WORKER)
+    moved_to = {}
+    made_dirs = set()
+
+    def mover(entry, dst, suffix):
+        try:
+            size = entry.stat().st_size if journal else 0
+            dst = move_file(entry.path, dst, suffix)
+            if journal:
+                journal.add(entry.path, dst, entry.inode(), size)
+            moved = True
+        except OSError:
+            moved = False
+        finally:
+            slots.release()
+        with stats_lock:
+            stats["moved" if moved else "skipped"] += 1
+            if moved and state is not None:
+                state.moved(entry.path, dst)
+            if moved and dedup == "link":
+                moved_to[entry.path] = dst
+
+    start = perf_counter()
+    plan = plan_moves(directory, completed or {}, state)
+    duplicate_of = {}
+    if dedup or dry_run:
+        plan = list(plan)
+    if dedup:
+        cache = HashCache(directory)
+        cache.keep(entry for entry, _, _ in plan)
+        groups = find_duplicates([entry for entry, _, _ in plan], workers, cache)
+        if not dry_run:
+            cache.save()
+        stats["duplicates"] = groups
+        duplicate_of = {path: group[0] for group in groups for path in group[1:]}
+        if dedup == "report":
+            plan = [move for move in plan if move[0].path not in duplicate_of]
+        stats["dedup"] = perf_counter() - start
+    if dry_run:
+        stats["plan"] = resolve_names(plan)
+        stats["scan"] = perf_counter() - start
+        return stats
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for entry, new_file, suffix in plan:
+            category_dir = os.path.dirname(new_file)
+            if category_dir not in made_dirs:
+                os.makedirs(category_dir, exist_ok=True)
+                made_dirs.add(category_dir)
+            slots.acquire()
+            pool.submit(mover, entry, new_file, suffix)
+        stats["scan"] = perf_counter() - start
+    if dedup == "link":
+        stats["linked"] = 0
+        for duplicate, original in duplicate_of.items():
+            if duplicate in moved_to and original in moved_to:
+                link_name = moved_to[duplicate] + ".link"
+                try:
+                    os.link(moved_to[original], link_name)
+                    os.replace(link_name, moved_to[duplicate])
+                except OSError:
+                    continue
+                stats["linked"] += 1
+    stats["move"] = perf_counter() - start
+    return stats
+
+def archive_size(archive: str) -> int:
+    '''
+    Unpacked size of an archive: exact for zip, estimated for the rest
+    '''
+    try:
+        if zipfile.is_zipfile(archive):
+            with zipfile.ZipFile(archive) as zf:
+                return sum(info.file_size for info in zf.infolist())
+        return os.path.getsize(archive) * TAR_RATIO
+    except (OSError, zipfile.BadZipFile):
+        return 0
+
+def unpack_format(extension: str):
+    '''
+    shutil format name for an archive extension: .gztar -> gztar,
+    .tar.gz -> gztar; None leaves it to shutil to guess from the name
+    '''
+    extension = extension.lower()
+    for name, extensions, _ in shutil.get_unpack_formats():
+        if extension == "." + name or extension in extensions:
+            return name
+    return None
+
+def extract_archive(archive: str, archive_dir: str, extension="") -> tuple:
+    '''
+    Unpack archive into archive_dir through a temporary directory,
+    so a broken archive leaves no partial output. Runs in a worker process.
+    Returns (archive, error message or None)
+    '''
+    tmp_dir = None
+    try:
+        # unique, so two archives with the same stem never share it
+        tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(archive_dir) + ".", suffix=".part",
+                                   dir=os.path.dirname(archive_dir))
+        shutil.unpack_archive(archive, tmp_dir, unpack_format(extension))
+        if os.path.exists(archive_dir):
+            shutil.copytree(tmp_dir, archive_dir, dirs_exist_ok=True)
+            shutil.rmtree(tmp_dir)
+        else:
+            os.rename(tmp_dir, archive_dir)
+        os.unlink(archive)
+    except Exception as error:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return archive, f"{type(error).__name__}: {error}"
+    return archive, None
+
+def process_archives(directory: Path, workers=ARCHIVE_WORKERS, budget=EXTRACT_BUDGET) -> list:
+    '''
+    Unpack archives to archive_name_dir/ in a pool of processes.
+    Archives are started while their unpacked sizes fit into budget (and the
+    free disk space); one archive is always allowed to run.
+    Returns (archive, error message or None) for every archive.
+    arch.zip and arch.tar.gz share the destination directory, so they are
+    never unpacked at the same time.
+    '''
+    archive_base_name = directory.joinpath(RESOLVER.extensions[".zip"])
+    if not archive_base_name.is_dir():
+        return []
+    pending = deque()
+    for entry in os.scandir(archive_base_name):
+        if entry.is_file():
+            suffix = RESOLVER.classify(entry.name)[1]
+            archive_dir = os.path.join(archive_base_name, entry.name[:len(entry.name)-len(suffix)])
+            pending.append((entry.path, archive_dir, suffix, archive_size(entry.path)))
+    if not pending:
+        return []
+    free = shutil.disk_usage(archive_base_name).free
+    budget = min(budget, free)
+    results = [(archive, "not enough disk space") for archive, _, _, size in pending if size > free]
+    pending = deque(job for job in pending if job[3] <= free)
+    if workers <= 1 or len(pending) == 1:
+        for archive, archive_dir, suffix, size in pending:
+            results.append(extract_archive(archive, archive_dir, suffix))
+        return results
+
+    running = {}
+    in_flight = 0
+    # destinations being unpacked into
+    busy = set()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            while pending and len(running) < workers:
+                job = next((job for job in pending if job[1] not in busy), None)
+                if job is None:
+                    break
+                archive, archive_dir, suffix, size = job
+                if running and in_flight + size > budget:
+                    break
+                pending.remove(job)
+                running[pool.submit(extract_archive, archive, archive_dir, suffix)] = (archive, archive_dir, size)
+                in_flight += size
+                busy.add(archive_dir)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                archive, archive_dir, size = running.pop(future)
+                in_flight -= size
+                busy.discard(archive_dir)
+                try:
+                    results.append(future.result())
+                except Exception as error:
+                    # the worker process itself died
+                    results.append((archive, f"{type(error).__name__}: {error}"))
+    return results
 
 def remove_empty_dirs(directory: Path) -> None:
     '''
-    Clean up empty directories
+    Clean up empty directories, bottom-up. Directories still holding files
+    (duplicates left in place, files that could not be moved) are kept.
     '''
     for entry in directory.glob("*"):
-        # костиль ?
-        if entry.is_dir() and entry.name not in list(CATEGORIES.keys())+['Unknown']:
-        # if entry.is_dir() and not entry.name in list(CATEGORIES.keys()).append('Unknown'):
-            shutil.rmtree(entry)
+        if entry.is_dir() and not entry.is_symlink() and entry.name not in RESOLVER.names:
+            for path, _, _ in os.walk(entry, topdown=False):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    # not empty
+                    continue
+
+def format_summary(stats: dict) -> str:
+    phases = ("dedup", "scan", "move", "archives", "cleanup", "total")
+    timings = ", ".join(f"{phase} {stats[phase]:.3f}s" for phase in phases if phase in stats)
+    summary = f'Moved {stats["moved"]} files, skipped {stats["skipped"]}. Time: {timings}'
+    groups = stats.get("duplicates", [])
+    if groups:
+        summary += f'\nFound {sum(len(group) - 1 for group in groups)} duplicates in {len(groups)} groups'
+        if "linked" in stats:
+            summary += f', {stats["linked"]} hard linked'
+        summary += '.'
+        for group in groups[:DUPLICATES_SHOWN]:
+            summary += f'\n  {Path(group[0]).name}: ' + ', '.join(Path(path).name for path in group[1:])
+    archives = stats.get("unpacked", [])
+    if archives:
+        failed = [(archive, error) for archive, error in archives if error]
+        summary += f'\nUnpacked {len(archives) - len(failed)} of {len(archives)} archives.'
+        for archive, error in failed:
+            summary += f'\n{RED}{Path(archive).name}: {error}{RESET}'
+    return summary
+
+def format_plan(stats: dict, directory: Path) -> str:
+    plan = stats["plan"]
+    lines = [f'{os.path.relpath(src, directory)} -> {os.path.relpath(dst, directory)}' for src, dst in plan[:PLAN_SHOWN]]
+    if len(plan) > PLAN_SHOWN:
+        lines.append(f'... and {len(plan) - PLAN_SHOWN} more')
+    lines.append(f'{len(plan)} files to move. Time: scan {stats["scan"]:.3f}s')
+    return "\n".join(lines)
 
-def main(folder:str) -> str:
+def main(folder:str, workers=WORKERS, archive_workers=ARCHIVE_WORKERS, resume=False, dedup=None,
+         dry_run=False, incremental=False) -> str:
+    '''
+    Sort the folder. dry_run only shows the moves, incremental skips
+    directories that did not change since the previous incremental run.
+    '''
     # if len(sys.argv) == 1:
     #     return 'ERROR: dir argument is needed. Terminating...'
     # else:
@@ -108,16 +882,53 @@ def main(folder:str) -> str:
         return f'{RED}Directory "{path}" does not exist.{RESET}'
         # raise KeyError
 
-    initialize_translation_table()
+    start = perf_counter()
+    state = ScanState(path) if incremental else None
+    journal = MoveJournal(path)
+
+    if dry_run:
+        stats = process_dir(path, workers, None, journal.completed(), dedup, state, dry_run=True)
+        return f'{BLUE}Dry run, nothing was moved{RESET}\n{format_plan(stats, path)}'
 
-    process_dir(path)
+    completed = journal.start(resume)
+    try:
+        stats = process_dir(path, workers, journal, completed, dedup, state)
+    except BaseException:
+        # keep what was moved, the run can be resumed or undone
+        with journal.lock:
+            journal._flush()
+        journal.close()
+        raise
 
-    process_archives(path)
+    phase_start = perf_counter()
+    stats["unpacked"] = process_archives(path, archive_workers)
+    stats["archives"] = perf_counter() - phase_start
 
+    phase_start = perf_counter()
     remove_empty_dirs(path)
+    stats["cleanup"] = perf_counter() - phase_start
+    journal.finish()
+    if state is not None:
+        state.save()
+    stats["total"] = perf_counter() - start
 
-    return f'{BLUE}All done{RESET}'
+    return f'{BLUE}All done{RESET}\n{format_summary(stats)}'
+
+def undo(folder: str) -> str:
+    '''
+    Move files of the last sort of folder back to where they were
+    '''
+    path = Path(folder)
+    if not path.exists():
+        return f'{RED}Directory "{path}" does not exist.{RESET}'
+    restored, skipped = MoveJournal(path).undo()
+    if not restored and not skipped:
+        return f'{RED}Nothing to undo in "{path}".{RESET}'
+    return f'{BLUE}Restored {restored} files, skipped {skipped}.{RESET}'
 
 
 if __name__ == "__main__":
-    print(main())
+    if sys.argv[1:] == ["--bench-normalize"]:
+        print(bench_normalize())
+    else:
+        print(main(sys.argv[1]))
\ No newline at end of file
@@ -0,0 +1,240 @@
+from bisect import bisect_left, bisect_right, insort
+from calendar import isleap
+from collections import defaultdict
+from datetime import date, timedelta
+
+
+class NGramIndex:
+    '''
+    Substring index over string values.
+    Every value is split into n-grams; a query is answered by intersecting
+    the posting sets of its own n-grams and checking the few survivors.
+    Each value remembers the keys (record names) it belongs to.
+    '''
+    def __init__(self, n=3) -> None:
+        self.n = n
+        self.grams = defaultdict(set)
+        self.owners = {}
+        # values shorter than n have no n-grams
+        self.short = set()
+
+    def __len__(self) -> int:
+        return len(self.owners)
+
+    def _grams(self, value: str) -> set:
+        n = self.n
+        return {value[i:i+n] for i in range(len(value) - n + 1)}
+
+    def add(self, value: str, key) -> None:
+        owners = self.owners.get(value)
+        if owners is None:
+            owners = self.owners[value] = set()
+            grams = self._grams(value)
+            if not grams:
+                self.short.add(value)
+            for gram in grams:
+                self.grams[gram].add(value)
+        owners.add(key)
+
+    def remove(self, value: str, key) -> None:
+        owners = self.owners.get(value)
+        if owners is None:
+            return
+        owners.discard(key)
+        if owners:
+            return
+        del self.owners[value]
+        self.short.discard(value)
+        for gram in self._grams(value):
+            posting = self.grams[gram]
+            posting.discard(value)
+            if not posting:
+                del self.grams[gram]
+
+    def values(self, query: str) -> set:
+        '''
+        All indexed values containing query
+        '''
+        if len(query) < self.n:
+            found = {value for gram, posting in self.grams.items() if query in gram for value in posting}
+            found.update(value for value in self.short if query in value)
+            return found
+        postings = sorted((self.grams.get(gram, ()) for gram in self._grams(query)), key=len)
+        found = set(postings[0])
+        for posting in postings[1:]:
+            if not found:
+                break
+            found.intersection_update(posting)
+        # n-grams may match out of order, check the real substring
+        return {value for value in found if query in value}
+
+    def search(self, query: str) -> set:
+        '''
+        Keys of all values containing query
+        '''
+        keys = set()
+        for value in self.values(query):
+            keys.update(self.owners[value])
+        return keys
+
+
+class NameIndex:
+    '''
+    Case-insensitive name index.
+    A sorted list of (lowercased name, name) answers prefix queries with a
+    bisect, an n-gram index over lowercased names answers infix queries.
+    '''
+    def __init__(self) -> None:
+        self.names = []
+        self.grams = NGramIndex()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str) -> None:
+        lower = name.lower()
+        insort(self.names, (lower, name))
+        self.grams.add(lower, name)
+
+    def extend(self, names) -> None:
+        '''
+        Add many names with one sort instead of an insort per name
+        '''
+        added = [(name.lower(), name) for name in names]
+        self.names.extend(added)
+        self.names.sort()
+        for lower, name in added:
+            self.grams.add(lower, name)
+
+    def remove(self, name: str) -> None:
+        lower = name.lower()
+        i = bisect_left(self.names, (lower, name))
+        if i < len(self.names) and self.names[i] == (lower, name):
+            del self.names[i]
+        self.grams.remove(lower, name)
+
+    def prefix(self, query: str):
+        '''
+        Names starting with query, in alphabetical order
+        '''
+        lower = query.lower()
+        names = self.names
+        for i in range(bisect_left(names, (lower,)), len(names)):
+            if not names[i][0].startswith(lower):
+                break
+            yield names[i][1]
+
+    def search(self, query: str, limit=None) -> list:
+        '''
+        Names containing query, ranked: exact and prefix matches first,
+        then matches at the start of a word, then by match position and length.
+        '''
+        result = []
+        for name in self.prefix(query):
+            if limit is not None and len(result) >= limit:
+                return result
+            result.append(name)
+        lower = query.lower()
+        ranked = []
+        for name in self.grams.search(lower):
+            name_lower = name.lower()
+            pos = name_lower.find(lower)
+            if pos == 0:
+                # already taken as a prefix match
+                continue
+            word_start = not name_lower[pos-1].isalnum()
+            ranked.append((not word_start, pos, len(name), name))
+        ranked.sort()
+        result.extend(rank[-1] for rank in ranked)
+        return result if limit is None else result[:limit]
+
+
+def calendar_key(day: date) -> tuple:
+    # Feb 29 birthdays are celebrated on Mar 1 in common years
+    if day.month == 3 and day.day == 1 and not isleap(day.year):
+        return (2, 29)
+    return (day.month, day.day)
+
+
+class BirthdayIndex:
+    '''
+    Birthdays kept sorted by (month, day).
+    Birthdays in the next N days are a bisect plus one or two slices
+    (two when the range wraps over the new year).
+    '''
+    def __init__(self) -> None:
+        self.entries = []
+        self.keys = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, name: str, birthday: date) -> None:
+        self.remove(name)
+        key = (birthday.month, birthday.day)
+        insort(self.entries, key + (name,))
+        self.keys[name] = key
+
+    def extend(self, birthdays) -> None:
+        '''
+        Add many (name, birthday) pairs with one sort
+        '''
+        birthdays = dict(birthdays)
+        for name in birthdays:
+            self.remove(name)
+        for name, birthday in birthdays.items():
+            key = (birthday.month, birthday.day)
+            self.entries.append(key + (name,))
+            self.keys[name] = key
+        self.entries.sort()
+
+    def remove(self, name: str) -> None:
+        key = self.keys.pop(name, None)
+        if key is None:
+            return
+        del self.entries[bisect_left(self.entries, key + (name,))]
+
+    def upcoming(self, days: int, today=None) -> list:
+        '''
+        Names with a birthday in [today, today + days), nearest first
+        '''
+        if days <= 0:
+            return []
+        today = today or date.today()
+        entries = self.entries
+        start_key = calendar_key(today)
+        start = bisect_left(entries, start_key)
+        if days >= 366:
+            selected = entries[start:] + entries[:start]
+        else:
+            end_key = calendar_key(today + timedelta(days=days))
+            end = bisect_left(entries, end_key)
+            # decided on the keys: start == end is also an empty window
+            if start_key < end_key:
+                selected = entries[start:end]
+            else:
+                selected = entries[start:] + entries[:end]
+        return [entry[-1] for entry in selected]
+
+    def walk(self, position=None, today=None):
+        '''
+        Yield (position, name) pairs in order of the next birthday.
+        Pass a yielded position back to resume right after that name.
+        '''
+        entries = self.entries
+        if position is None:
+            start_key = calendar_key(today or date.today())
+            i = bisect_left(entries, start_key)
+            wrapped = False
+        else:
+            start_key, last, wrapped = position
+            i = bisect_right(entries, last)
+        while True:
+            if not wrapped and i >= len(entries):
+                wrapped = True
+                i = 0
+            if i >= len(entries) or (wrapped and entries[i] >= start_key):
+                return
+            entry = entries[i]
+            i += 1
+            yield (start_key, entry, wrapped), entry[-1]
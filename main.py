@@ -1,11 +1,19 @@
+from time import perf_counter
+# taken before the other imports for --profile-startup
+STARTED = perf_counter()
 from types import GeneratorType
-from prompt_toolkit import prompt
-from prompt_toolkit.completion import WordCompleter
+import sys
+import threading
 from abc import abstractmethod, ABC
 
 from notes import NoteRecord, add_record, find_by_tag, find_by_note, delete_note, sort_notes, save_notes, load_notes
+import notes
+import metrics
 from classes import Record, AddressBook
-import folder_sort
+from router import CommandRouter
+# prompt_toolkit, argparse, folder_sort and contacts_io are imported
+# where they are used, they are not needed to show the first prompt
+IMPORTED = perf_counter()
 
 
 RED = "\033[91m"
@@ -14,6 +22,9 @@ BLUE = "\033[94m"
 RESET = "\033[0m"
 
 file_name = "book.dat"
+# where --metrics FILE writes the metrics on exit
+metrics_file = None
+SEARCH_LIMIT = 50
 STOP_WORDS = [
                 'good bye', 
                 'goodbye', 
@@ -35,16 +46,21 @@ def input_error(func):
     def inner(*args):
         try:
             result = func(*args)
-        except KeyError:
+        except KeyError as error:
             result = "Not found."
-        except ValueError:
+            metrics.error(error)
+        except ValueError as error:
             result = "Entered incorrect data."
-        except IndexError:
+            metrics.error(error)
+        except IndexError as error:
             result = "Not enough parameters."
-        except TypeError:
+            metrics.error(error)
+        except TypeError as error:
             result = "Write command in right format.(Use help!)"
-        except AttributeError:
+            metrics.error(error)
+        except AttributeError as error:
             result = "Not found."
+            metrics.error(error)
         else:
             return result
         return f'{RED}{result}{RESET}'
@@ -272,7 +288,7 @@ class DeleteBirthday(DeleteClass):
     @input_error
     def delete(self) -> str:
         record = address_book.data[self.name]
-        delattr(record, "birthday")
+        record.delete_birthday()
         return f'{GREEN}Removed.{RESET}'
     
 class DeleteEmail(DeleteClass):
@@ -303,15 +319,15 @@ class DeleteAddress(DeleteClass):
     @input_error
     def delete(self) -> str:
         record = address_book.data[self.name]
-        delattr(record, "address")
+        record.delete_address()
         return f'{GREEN}Removed.{RESET}'
 
 @input_error
 def get_phone(*args):
     return address_book.find(args[0])
 
-def all_contacts(N=3, *args):
-    return address_book.iterator(N)
+def all_contacts(N=3, order="added", *args):
+    return address_book.iterator(N, order)
 
 def help_(*args):
     with open('README.md', 'r') as fh:
@@ -339,18 +355,38 @@ def random_search(*args) -> GeneratorType:
             raise IndexError
     search_result = AddressBook()
     if search.isnumeric():
-        for record in address_book.values():
-            for phone in record.phones:
-                if search in str(phone.value):
-                    search_result.add_record(record)
+        for record in address_book.search_phones(search):
+            search_result.data[record.name.value] = record
     else:
-        for name, record in address_book.data.items():
-            if search in name:
-                search_result.add_record(record)
+        for record in address_book.search_names(search, SEARCH_LIMIT):
+            search_result.data[record.name.value] = record
     if not search_result:
         raise KeyError
     return search_result.iterator(2)
 
+@input_error
+def import_contacts(*args):
+    import contacts_io
+    try:
+        imported, errors = contacts_io.import_contacts(address_book, args[0])
+    except OSError as error:
+        return f"{RED}{error}{RESET}"
+    message = f"{GREEN}Imported {imported} contacts.{RESET}"
+    if errors:
+        message += f"\n{RED}{len(errors)} rows skipped:{RESET}"
+        for line_num, error in errors[:contacts_io.ERRORS_SHOWN]:
+            message += f"\n  line {line_num}: {error}"
+    return message
+
+@input_error
+def export_contacts(*args):
+    import contacts_io
+    try:
+        count = contacts_io.export_contacts(address_book, args[0])
+    except OSError as error:
+        return f"{RED}{error}{RESET}"
+    return f"{GREEN}Exported {count} contacts to {args[0]}{RESET}"
+
 @input_error
 def birthday_in_XX_days(*args):
     return address_book.bd_in_xx_days(int(args[0]))
@@ -366,7 +402,6 @@ def add_note():
     tags = base_input.side_inp(f"{BLUE}Please enter note tags: {RESET}")
     note_rec.add_tags(tags.split(", ") if "," in tags else tags.split(" "))
     add_record(note_rec)
-    save_notes()
     return f"{GREEN}The note was saved.{RESET}"
 
 @input_error
@@ -446,40 +481,88 @@ def del_note():
     else:
         return f"{RED}Note was not deleted!{RESET}"
         
+@input_error
 def sort_folder(*args):
     ''' Sort files from a single folder into categorized folders '''
+    import folder_sort
     if not args:
-        folder = input(f"{BLUE}Please enter the folder name: {RESET}")
+        folder = base_input.side_inp(f"{BLUE}Please enter the folder name: {RESET}")
         if not folder:
             raise IndexError
     else:
         folder = args[0]
-    return folder_sort.main(folder)
+    options = {}
+    for option in args[1:]:
+        if option == "--resume":
+            options["resume"] = True
+        elif option == "--dry-run":
+            options["dry_run"] = True
+        elif option == "--incremental":
+            options["incremental"] = True
+        elif option.startswith("--dedup"):
+            mode = option.partition("=")[2] or "report"
+            if mode not in folder_sort.DEDUP_MODES:
+                raise ValueError
+            options["dedup"] = mode
+        else:
+            options["workers"] = int(option)
+    return folder_sort.main(folder, **options)
+
+@input_error
+def undo_sort(*args):
+    ''' Move files of the last folder sort back '''
+    import folder_sort
+    if not args:
+        folder = base_input.side_inp(f"{BLUE}Please enter the folder name: {RESET}")
+        if not folder:
+            raise IndexError
+    else:
+        folder = args[0]
+    return folder_sort.undo(folder)
+
+@input_error
+def stats(*args):
+    '''
+    stats - latency, errors and persistence/search time per command
+    stats on|off|reset, stats export [FILE] - Prometheus text format
+    '''
+    action = args[0] if args else "show"
+    if action in ("on", "off"):
+        metrics.enable(action == "on")
+        return f"{GREEN}Metrics are {action}.{RESET}"
+    if action == "reset":
+        metrics.registry.reset()
+        return f"{GREEN}Metrics were reset.{RESET}"
+    if action == "export":
+        filename = args[1] if len(args) > 1 else metrics_file
+        if not filename:
+            raise IndexError
+        metrics.export(filename)
+        return f"{GREEN}Metrics written to {filename}{RESET}"
+    if action != "show":
+        raise ValueError
+    if not metrics.enabled and not metrics.registry.commands:
+        return f"{BLUE}Metrics are off, start with --metrics or use 'stats on'.{RESET}"
+    return "\n".join(metrics.report())
 
 
 address_book = AddressBook()
 
-# order MATTERS!!!! Single word command must be in the end !
 OPERATIONS = {
                 "hello": hello,
                 "help": help_,
-                "?": help_,
                 "add phone": (AddContact, "add"),
                 "add birthday": (AddBirthday, "add"),
                 "add note": add_note,
                 "add tags": add_tags,
                 "add email": (AddEmail, "add"),
                 "add address": (AddAddress, "add"),
-                "add": (AddContact, "add"),
                 "change address": (ChangeAddress, "change"),
                 "change phone": (ChangeContact, "change"),
                 "change birthday": (ChangeBirthday, "change"),
                 "change note": change_note,
                 "change email": (ChangeEmail, "change"),
-                "change": (ChangeContact, "change"), 
                 "get contact": get_phone,
-                "get": get_phone,
-                "all": all_contacts,
                 "show all": all_contacts,
                 "delete phone": (DeleteContact, "delete"),
                 "delete birthday": (DeleteBirthday, "delete"),
@@ -487,36 +570,57 @@ OPERATIONS = {
                 "delete tags": delete_tags,
                 "delete address": (DeleteAddress, "delete"),
                 "delete email": (DeleteEmail, "delete"),
-                "delete": (DeleteContact, "delete"),
                 # "d": debug_,
                 "load": restore_data_from_file,
                 "save": save_data_to_file,
+                "import": import_contacts,
+                "export": export_contacts,
                 "find note": find_note,
                 "find": random_search,
-                "search": random_search,
                 "sort notes": sort_notes,
                 "birthdays": birthday_in_XX_days,
-                "sort folder": sort_folder
+                "sort folder": sort_folder,
+                "undo sort": undo_sort,
+                "stats": stats
               }
 
-ALL_COMMANDS = OPERATIONS.keys()
-command_completer = WordCompleter(ALL_COMMANDS, sentence=True, ignore_case=True)
+ALIASES = {
+            "hi": "hello",
+            "?": "help",
+            "add": "add phone",
+            "change": "change phone",
+            "get": "get contact",
+            "all": "show all",
+            "delete": "delete phone",
+            "search": "find"
+          }
+
+router = CommandRouter(OPERATIONS, ALIASES)
+ALL_COMMANDS = router.names
+
+def register_command(name: str, func) -> None:
+    '''
+    Add a command (or replace one), func is a function or a (class, method name) pair
+    '''
+    router.register(name, func)
 
-def handler(inp):
-        cor_func = unknown_command
-        params = []
-        for kw, func in OPERATIONS.items():
-            if inp.startswith(kw):
-                params = inp[len(kw):].strip().split()
-                cor_func = func
-                break
-        if isinstance(func, tuple):
+def call(cor_func, params):
+        if isinstance(cor_func, tuple):
             func = getattr(cor_func[0], cor_func[1])
             result = func(cor_func[0](*params))
         else:
             result = cor_func(*params)
         return result  
 
+def handler(inp):
+        loader.wait()
+        cor_func, params = router.route(inp)
+        if cor_func is None:
+            return unknown_command()
+        if metrics.enabled:
+            return metrics.run_command(router.commands[cor_func], call, cor_func, params)
+        return call(cor_func, params)
+
 class InputBaseClass(ABC):
     @abstractmethod
     def main_inp(self):
@@ -526,15 +630,39 @@ class InputBaseClass(ABC):
     def side_inp(self, inp_text):
         raise NotImplementedError
     
-class TerminalInput(InputBaseClass):        
+class TerminalInput(InputBaseClass):
+    def __init__(self) -> None:
+        from prompt_toolkit import prompt
+        from prompt_toolkit.completion import WordCompleter
+        self.prompt = prompt
+        self.completer = WordCompleter(ALL_COMMANDS, sentence=True, ignore_case=True)
+
     def main_inp(self):
-        res = prompt(">>> ", completer=command_completer).lower()
+        res = self.prompt(">>> ", completer=self.completer).lower()
         return res
     
     def side_inp(self, inp_text):
         res = input(inp_text)
         return res
     
+class BatchInput(InputBaseClass):
+    '''
+    Commands and answers to questions read from lines of a script.
+    Empty lines and lines starting with # are skipped as commands.
+    '''
+    def __init__(self, lines) -> None:
+        self.lines = iter(lines)
+
+    def main_inp(self):
+        for line in self.lines:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                return line.lower()
+        return None
+
+    def side_inp(self, inp_text):
+        return next(self.lines, "").rstrip("\n")
+
 class OutputBaseClass(ABC):
     @abstractmethod
     def output(self, text):
@@ -553,19 +681,159 @@ class TerminalOutput(OutputBaseClass):
         else:
             print(f'{text}')
 
+class BatchOutput(TerminalOutput):
+    def __init__(self, quiet=False) -> None:
+        self.quiet = quiet
+
+    def output(self, text):
+        # quiet: only errors
+        if not self.quiet or (isinstance(text, str) and text.startswith(RED)):
+            super().output(text)
+
+def run_batch(lines, quiet=False) -> str:
+    '''
+    Run commands from lines without prompts, journal and note writes
+    are deferred and saved once at the end
+    '''
+    global base_input
+    global base_output
+    base_input = BatchInput(lines)
+    base_output = BatchOutput(quiet)
+    count = 0
+    start = perf_counter()
+    with address_book.batch(), notes.batch():
+        while True:
+            inp = base_input.main_inp()
+            if inp is None or inp in STOP_WORDS:
+                break
+            base_output.output(handler(inp))
+            count += 1
+    save_data_to_file()
+    save_notes()
+    elapsed = perf_counter() - start
+    export_metrics()
+    return f"{GREEN}{count} commands in {elapsed:.3f}s ({count / elapsed if elapsed else 0:.0f} commands/sec){RESET}"
+
+class Loader:
+    '''
+    Loads the book and the notes, in a thread when started in the background,
+    so the prompt shows up while they are read. Commands wait for it.
+    '''
+    def __init__(self) -> None:
+        self.thread = None
+        self.error = None
+        self.timings = {}
+        # SQLite database holding both the book and the notes
+        self.db = None
+
+    def start(self, background=False) -> None:
+        if background:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        else:
+            self._run()
+            self.wait()
+
+    def _run(self) -> None:
+        try:
+            start = perf_counter()
+            address_book.load(file_name)
+            loaded = perf_counter()
+            if self.db:
+                from sqlite_store import SQLiteNoteStore
+                notes.open_store(SQLiteNoteStore(address_book.db))
+            else:
+                load_notes(lazy=True)
+            self.timings["load book"] = loaded - start
+            self.timings["load notes"] = perf_counter() - loaded
+        except BaseException as error:
+            self.error = error
+
+    def wait(self) -> None:
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+loader = Loader()
+
+def startup_profile(timings: dict) -> str:
+    lines = [f"{BLUE}Startup:{RESET}"]
+    for name, seconds in timings.items():
+        lines.append(f"  {name:<20}{seconds * 1000:8.1f} ms")
+    return "\n".join(lines)
+
+def export_metrics() -> None:
+    if metrics_file:
+        metrics.export(metrics_file)
+
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="CLI Address Book")
+    parser.add_argument("--batch", metavar="FILE", help="run commands from FILE ('-' for stdin) and exit")
+    parser.add_argument("--quiet", action="store_true", help="in batch mode print only errors")
+    parser.add_argument("--profile-startup", action="store_true", help="print import and load times")
+    parser.add_argument("--db", metavar="FILE", help="keep contacts and notes in the SQLite database FILE")
+    parser.add_argument("--metrics", nargs="?", const="", metavar="FILE",
+                        help="collect command metrics (see 'stats'), with FILE write them there on exit")
+    return parser.parse_args(argv)
+
+def use_database(filename: str) -> None:
+    '''
+    Keep contacts and notes in a SQLite database instead of book.dat and notes_book.bin
+    '''
+    global address_book, file_name
+    from sqlite_store import SQLiteBook
+    address_book = SQLiteBook()
+    file_name = filename
+    loader.db = filename
+
 def main():
     global base_input
     global base_output
-    address_book.load(file_name)
-    load_notes()
+    global metrics_file
+    # argparse is not imported for a plain start
+    args = parse_args() if len(sys.argv) > 1 else None
+    profile = args is not None and args.profile_startup
+    timings = {"imports": IMPORTED - STARTED}
+    if args is not None and args.db:
+        use_database(args.db)
+    if args is not None and args.metrics is not None:
+        metrics.enable()
+        metrics_file = args.metrics or None
+    if args is not None and args.batch:
+        loader.start()
+        timings.update(loader.timings)
+        if profile:
+            print(startup_profile(timings), file=sys.stderr)
+        if args.batch == "-":
+            result = run_batch(sys.stdin, args.quiet)
+        else:
+            with open(args.batch, 'r', encoding='utf-8') as fh:
+                result = run_batch(fh, args.quiet)
+        print(result, file=sys.stderr)
+        return
+    loader.start(background=True)
+    start = perf_counter()
     base_input = TerminalInput()
     base_output = TerminalOutput()
+    timings["import prompt_toolkit"] = perf_counter() - start
+    timings["first prompt"] = perf_counter() - STARTED
     base_output.output(f'{RESET}{hello()}')
+    if profile:
+        loader.wait()
+        timings.update(loader.timings)
+        timings["data ready"] = perf_counter() - STARTED
+        base_output.output(startup_profile(timings))
     while True:
         input = base_input.main_inp()
         if input.strip() in STOP_WORDS:
+            loader.wait()
             save_data_to_file()
             save_notes()
+            export_metrics()
             base_output.output(f"{GREEN}See you, bye!{RESET}")
             exit()
         if input.strip() == '':
@@ -0,0 +1,280 @@
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+from types import GeneratorType
+import os
+import threading
+
+
+# off unless started with --metrics or turned on by "stats on",
+# when off the only cost is checking this flag
+enabled = False
+
+# upper bounds of the latency buckets, seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ("persistence", "search")
+PREFIX = "addressbook"
+# command of the time spent outside of commands, e.g. loading at startup
+NO_COMMAND = "-"
+
+
+class Histogram:
+    '''
+    Counts of observations per bucket, plus their count, sum and maximum
+    '''
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self) -> None:
+        # the last one is +Inf
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        '''
+        Estimated like Prometheus histogram_quantile: linear inside the bucket,
+        but never above the slowest call seen
+        '''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.commands = {}
+            # (command, exception type name): count
+            self.errors = {}
+            # (command, phase): seconds
+            self.phases = {}
+
+    def observe(self, command: str, seconds: float) -> None:
+        with self.lock:
+            histogram = self.commands.get(command)
+            if histogram is None:
+                histogram = self.commands[command] = Histogram()
+            histogram.observe(seconds)
+
+    def error(self, command: str, error_type: str) -> None:
+        with self.lock:
+            key = (command, error_type)
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def spent(self, command: str, phase: str, seconds: float) -> None:
+        with self.lock:
+            key = (command, phase)
+            self.phases[key] = self.phases.get(key, 0.0) + seconds
+
+
+registry = Registry()
+# command being run and the phase being timed, per thread
+_local = threading.local()
+
+
+def current_command() -> str:
+    return getattr(_local, "command", NO_COMMAND)
+
+def enable(on=True) -> None:
+    global enabled
+    enabled = on
+
+def error(exc: BaseException) -> None:
+    '''
+    Count an exception turned into a message by input_error
+    '''
+    if enabled:
+        registry.error(current_command(), type(exc).__name__)
+
+def _finish(command: str, start: float, result):
+    '''
+    Observe the command, once its result is consumed if it is a generator
+    '''
+    if not isinstance(result, GeneratorType):
+        registry.observe(command, perf_counter() - start)
+        return result
+    spent = perf_counter() - start
+
+    def consume():
+        nonlocal spent
+        _local.command = command
+        try:
+            while True:
+                # only the time spent producing items, not printing them
+                begin = perf_counter()
+                try:
+                    item = next(result)
+                except StopIteration:
+                    spent += perf_counter() - begin
+                    return
+                except BaseException as exc:
+                    registry.error(command, type(exc).__name__)
+                    raise
+                spent += perf_counter() - begin
+                yield item
+        finally:
+            _local.command = NO_COMMAND
+            registry.observe(command, spent)
+    return consume()
+
+def run_command(command: str, func, *args):
+    '''
+    func(*args) timed and counted under command
+    '''
+    _local.command = command
+    start = perf_counter()
+    try:
+        result = func(*args)
+    except BaseException as exc:
+        registry.error(command, type(exc).__name__)
+        registry.observe(command, perf_counter() - start)
+        raise
+    finally:
+        _local.command = NO_COMMAND
+    return _finish(command, start, result)
+
+def _stack() -> list:
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+def _leave(stack: list, frame: list, command: str, spent: float) -> None:
+    # the time of a nested phase is taken out of the one around it
+    stack.pop()
+    if stack:
+        stack[-1][1] += spent
+    registry.spent(command, frame[0], spent - frame[1])
+
+def timed(phase: str):
+    '''
+    Decorator adding the time of the call to phase ("persistence" or "search")
+    of the current command. A generator is timed while it produces items.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            stack = _stack()
+            if stack and stack[-1][0] == phase:
+                return func(*args, **kwargs)
+            command = current_command()
+            # phase, time of the phases nested in it
+            frame = [phase, 0.0]
+            stack.append(frame)
+            start = perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                _leave(stack, frame, command, perf_counter() - start)
+            if isinstance(result, GeneratorType):
+                return _timed_items(result, phase, command)
+            return result
+        return inner
+    return decorator
+
+def _timed_items(result: GeneratorType, phase: str, command: str):
+    stack = _stack()
+    while True:
+        frame = [phase, 0.0]
+        stack.append(frame)
+        start = perf_counter()
+        try:
+            item = next(result)
+        except StopIteration:
+            return
+        finally:
+            _leave(stack, frame, command, perf_counter() - start)
+        yield item
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus() -> str:
+    '''
+    Metrics in the Prometheus text exposition format
+    '''
+    with registry.lock:
+        commands = sorted(registry.commands.items())
+        errors = sorted(registry.errors.items())
+        phases = sorted(registry.phases.items())
+    lines = [f"# HELP {PREFIX}_command_seconds Time taken by a command.",
+             f"# TYPE {PREFIX}_command_seconds histogram"]
+    for command, histogram in commands:
+        label = f'command="{_label(command)}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{PREFIX}_command_seconds_bucket{{{label},le="{le}"}} {cumulative}')
+        lines.append(f"{PREFIX}_command_seconds_sum{{{label}}} {histogram.total!r}")
+        lines.append(f"{PREFIX}_command_seconds_count{{{label}}} {histogram.count}")
+    lines.append(f"# HELP {PREFIX}_errors_total Exceptions raised by commands.")
+    lines.append(f"# TYPE {PREFIX}_errors_total counter")
+    for (command, error_type), count in errors:
+        lines.append(f'{PREFIX}_errors_total{{command="{_label(command)}",type="{error_type}"}} {count}')
+    lines.append(f"# HELP {PREFIX}_phase_seconds_total Time spent in persistence and search.")
+    lines.append(f"# TYPE {PREFIX}_phase_seconds_total counter")
+    for (command, phase), seconds in phases:
+        lines.append(f'{PREFIX}_phase_seconds_total{{command="{_label(command)}",phase="{phase}"}} {seconds!r}')
+    return "\n".join(lines) + "\n"
+
+def export(filename: str) -> None:
+    '''
+    Write prometheus() to filename atomically, so that a collector
+    reading the file never sees half of it
+    '''
+    tmp_name = filename + ".tmp"
+    with open(tmp_name, "w", encoding="utf-8") as fh:
+        fh.write(prometheus())
+    os.replace(tmp_name, filename)
+
+def report() -> list:
+    '''
+    Lines of a table: per command count, mean, p50, p95, p99, errors
+    and the share of its time spent in persistence and search
+    '''
+    with registry.lock:
+        commands = sorted(registry.commands.items(), key=lambda item: -item[1].total)
+        errors = dict(registry.errors)
+        phases = dict(registry.phases)
+    lines = [f"{'command':<18}{'count':>7}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+             f"{'errors':>8}{'persist':>9}{'search':>8}"]
+    for command, histogram in commands:
+        error_count = sum(count for (name, _), count in errors.items() if name == command)
+        shares = [phases.get((command, phase), 0.0) / histogram.total if histogram.total else 0.0
+                  for phase in PHASES]
+        lines.append(f"{command:<18}{histogram.count:>7}{histogram.total / histogram.count * 1000:>10.3f}"
+                     f"{histogram.quantile(0.5) * 1000:>10.3f}{histogram.quantile(0.95) * 1000:>10.3f}"
+                     f"{histogram.quantile(0.99) * 1000:>10.3f}{error_count:>8}"
+                     f"{shares[0]:>9.0%}{shares[1]:>8.0%}")
+    outside = [f"{phase} {phases[(NO_COMMAND, phase)] * 1000:.1f} ms" for phase in PHASES
+               if (NO_COMMAND, phase) in phases]
+    if outside:
+        lines.append("outside commands: " + ", ".join(outside))
+    if errors:
+        lines.append("errors: " + ", ".join(f"{command} {error_type} x{count}"
+                                            for (command, error_type), count in sorted(errors.items())))
+    return lines
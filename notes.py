@@ -1,53 +1,495 @@
+from collections import defaultdict
 from datetime import datetime
+from math import log
+import os
 import pickle
+import re
+import struct
+from contextlib import contextmanager
+
+import metrics
+
 
 BLUE = "\033[94m"
 RESET = "\033[0m"
 
+TOKEN_RE = re.compile(r"\w+")
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+OR_WORDS = ("OR", "|")
+
+NOTES_FILE = "notes_book.bin"
+NOTES_MAGIC = b"NOTES1\n"
+# frame header: op, note id, payload length
+FRAME = struct.Struct("<cQI")
+PUT = b"P"
+DELETE = b"D"
+# compact the store once this many bytes are taken by old versions
+COMPACT_GARBAGE = 1 << 20
+
+
+def tokenize(text: str) -> list:
+    return TOKEN_RE.findall(text.lower())
+
+def parse_note_query(query: str) -> list:
+    '''
+    Clauses of a note query, each a list of terms: a token,
+    a token ending with * (prefix) or a list of tokens (phrase)
+    '''
+    clauses = [[]]
+    for phrase, word in QUERY_RE.findall(query):
+        if word in OR_WORDS:
+            clauses.append([])
+            continue
+        tokens = tokenize(phrase or word)
+        if word.endswith("*") and len(tokens) == 1:
+            clauses[-1].append(tokens[0] + "*")
+        elif len(tokens) == 1:
+            clauses[-1].append(tokens[0])
+        elif tokens:
+            clauses[-1].append(tokens)
+    return [clause for clause in clauses if clause]
+
+def parse_tag_query(query: str) -> list:
+    '''
+    Clauses of a tag query as (tags to include, tags to exclude).
+    AND, OR and NOT are operators in any case, a "quoted tag" never is
+    and may hold spaces.
+    '''
+    clauses = [([], [])]
+    negate = False
+    for phrase, word in QUERY_RE.findall(query):
+        operator = word.upper()
+        if operator in OR_WORDS:
+            clauses.append(([], []))
+        elif operator == "AND":
+            continue
+        elif operator == "NOT":
+            negate = True
+        else:
+            tag = (phrase or word).strip().lower()
+            if tag:
+                clauses[-1][negate].append(tag)
+            negate = False
+    return [(include, exclude) for include, exclude in clauses if include or exclude]
+
+
+class NoteIndex:
+    '''
+    Inverted index over note text with positional postings:
+    token -> {note id: [positions]}.
+    Query syntax: words are AND-ed, "quoted words" must appear as a phrase,
+    OR (or |) separates alternatives, a trailing * matches a word prefix.
+    '''
+    def __init__(self) -> None:
+        self.postings = defaultdict(dict)
+
+    def add(self, note_id: int, text: str) -> None:
+        for pos, token in enumerate(tokenize(text)):
+            self.postings[token].setdefault(note_id, []).append(pos)
+
+    def remove(self, note_id: int, text: str) -> None:
+        for token in set(tokenize(text)):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(note_id, None)
+            if not posting:
+                del self.postings[token]
+
+    def _term(self, term: str) -> dict:
+        '''
+        note id -> number of occurrences
+        '''
+        if term.endswith("*"):
+            prefix = term[:-1]
+            found = defaultdict(int)
+            for token, posting in self.postings.items():
+                if token.startswith(prefix):
+                    for note_id, positions in posting.items():
+                        found[note_id] += len(positions)
+            return found
+        return {note_id: len(positions) for note_id, positions in self.postings.get(term, {}).items()}
+
+    def _phrase(self, tokens: list) -> dict:
+        postings = [self.postings.get(token) for token in tokens]
+        if not all(postings):
+            return {}
+        found = {}
+        for note_id in set(postings[0]).intersection(*postings[1:]):
+            following = [set(posting[note_id]) for posting in postings[1:]]
+            hits = sum(1 for pos in postings[0][note_id]
+                       if all(pos+k in positions for k, positions in enumerate(following, 1)))
+            if hits:
+                found[note_id] = hits
+        return found
+
+    def _clause(self, clause: list, total: int) -> dict:
+        '''
+        AND of all terms in the clause, note id -> tf-idf score
+        '''
+        scores = None
+        for term in clause:
+            matches = self._phrase(term) if isinstance(term, list) else self._term(term)
+            if not matches:
+                return {}
+            idf = log(1 + total / len(matches))
+            if scores is None:
+                scores = {note_id: count * idf for note_id, count in matches.items()}
+            else:
+                scores = {note_id: score + matches[note_id] * idf
+                          for note_id, score in scores.items() if note_id in matches}
+                if not scores:
+                    return {}
+        return scores or {}
+
+    def search(self, query: str, total: int) -> list:
+        '''
+        Note ids matching query, most relevant first
+        '''
+        scores = {}
+        for clause in parse_note_query(query):
+            for note_id, score in self._clause(clause, total).items():
+                scores[note_id] = max(score, scores.get(note_id, 0))
+        return sorted(scores, key=lambda note_id: (-scores[note_id], note_id))
+
+
+class TagIndex:
+    '''
+    tag -> set of note ids.
+    Query syntax: tags are AND-ed, NOT excludes the next tag,
+    OR separates alternatives: "work AND urgent NOT done OR home";
+    a tag with spaces is quoted: "my tag" OR work
+    '''
+    def __init__(self) -> None:
+        self.postings = defaultdict(set)
+
+    def add(self, note_id: int, tag: str) -> None:
+        self.postings[tag].add(note_id)
+
+    def remove(self, note_id: int, tag: str) -> None:
+        posting = self.postings.get(tag)
+        if posting is None:
+            return
+        posting.discard(note_id)
+        if not posting:
+            del self.postings[tag]
+
+    def _clause(self, include: list, exclude: list, all_ids) -> set:
+        if include:
+            postings = sorted((self.postings.get(tag, set()) for tag in include), key=len)
+            found = set(postings[0])
+            for posting in postings[1:]:
+                if not found:
+                    break
+                found.intersection_update(posting)
+        else:
+            # only exclusions - nothing to start from but all notes
+            found = set(all_ids)
+        for tag in exclude:
+            if not found:
+                break
+            found.difference_update(self.postings.get(tag, ()))
+        return found
+
+    def search(self, query: str, all_ids) -> set:
+        found = set()
+        for include, exclude in parse_tag_query(query):
+            found |= self._clause(include, exclude, all_ids)
+        return found
+
 class NoteRecord():
     def __init__(self, note: str) -> None:
+        self.id = None
         self.note = note
-        self.tags = []
+        # dict keeps tags ordered with O(1) membership
+        self.tags = {}
         self.create_date = datetime.now().date()
         self.change_date = None
 
     def add_tags(self, tags: list) -> None:
         for i in tags:
-            self.tags.append(i.lower())
+            i = i.lower()
+            if i and i not in self.tags:
+                self.tags[i] = None
+                if self.id in notes_by_id:
+                    tag_index.add(self.id, i)
+        _saved(self)
 
     def del_tags(self, tags_to_del: list) -> None:
         for i in tags_to_del:
-            self.tags.remove(i) if i in self.tags else ...
+            i = i.lower()
+            if i in self.tags:
+                del self.tags[i]
+                if self.id in notes_by_id:
+                    tag_index.remove(self.id, i)
+        _saved(self)
 
     def edit_note(self, new_note: str) -> None:
+        if self.id in notes_by_id:
+            note_index.remove(self.id, self.note)
+            note_index.add(self.id, new_note)
         self.note = new_note
+        _saved(self)
 
     def __str__(self):
         return f"{BLUE}Tags:{RESET} {', '.join(self.tags)}\n{BLUE}Note:{RESET} {self.note}\n{BLUE}Date of creation:{RESET} {self.create_date}.\n"
 
+class NoteStore:
+    '''
+    Append-only note file: a magic line followed by one frame per change,
+    a PUT frame carries a pickled NoteRecord, a DELETE frame only the id.
+    offsets maps note id -> (payload offset, payload length) of the latest
+    version, so opening the file reads frame headers only and a single note
+    can be decoded on its own.
+    '''
+    # stores that answer queries themselves keep no notes in memory
+    searchable = False
+
+    def __init__(self, filename=NOTES_FILE) -> None:
+        self.filename = filename
+        self.offsets = {}
+        self.garbage = 0
+        self.fh = None
+        # frames buffered by defer() until commit()
+        self.pending = None
+        self.end = 0
+
+    def open(self):
+        '''
+        Index the frames of the file.
+        Returns the list of notes if the file is an old single pickle, else None.
+        '''
+        try:
+            fh = open(self.filename, 'r+b')
+        except FileNotFoundError:
+            self.rewrite([])
+            return None
+        magic = fh.read(len(NOTES_MAGIC))
+        if magic != NOTES_MAGIC:
+            fh.seek(0)
+            legacy = pickle.load(fh) if magic else []
+            fh.close()
+            return legacy
+        self.fh = fh
+        end = self._scan()
+        if end < os.fstat(fh.fileno()).st_size:
+            # torn last frame after a crash
+            fh.truncate(end)
+        return None
+
+    def _scan(self) -> int:
+        fh = self.fh
+        size = os.fstat(fh.fileno()).st_size
+        pos = len(NOTES_MAGIC)
+        while pos + FRAME.size <= size:
+            fh.seek(pos)
+            op, note_id, length = FRAME.unpack(fh.read(FRAME.size))
+            end = pos + FRAME.size + length
+            if end > size or op not in (PUT, DELETE):
+                break
+            old = self.offsets.pop(note_id, None)
+            if old is not None:
+                self.garbage += FRAME.size + old[1]
+            if op == PUT:
+                self.offsets[note_id] = (pos + FRAME.size, length)
+            else:
+                self.garbage += FRAME.size
+            pos = end
+        return pos
+
+    def get(self, note_id: int) -> NoteRecord:
+        if self.pending:
+            self._write_pending()
+        offset, length = self.offsets[note_id]
+        self.fh.seek(offset)
+        return pickle.loads(self.fh.read(length))
+
+    def _write(self, op: bytes, note_id: int, payload=b"") -> int:
+        frame = FRAME.pack(op, note_id, len(payload)) + payload
+        if self.pending is not None:
+            pos = self.end
+            self.pending.append(frame)
+            self.end += len(frame)
+        else:
+            fh = self.fh
+            pos = fh.seek(0, 2)
+            fh.write(frame)
+            fh.flush()
+        old = self.offsets.pop(note_id, None)
+        if old is not None:
+            self.garbage += FRAME.size + old[1]
+        return pos + FRAME.size
+
+    @metrics.timed("persistence")
+    def put(self, record: NoteRecord) -> None:
+        payload = pickle.dumps(record)
+        self.offsets[record.id] = (self._write(PUT, record.id, payload), len(payload))
+
+    @metrics.timed("persistence")
+    def delete(self, note_id: int) -> None:
+        if note_id in self.offsets:
+            self._write(DELETE, note_id)
+            self.garbage += FRAME.size
+
+    def defer(self) -> None:
+        '''
+        Buffer frames in memory until commit()
+        '''
+        if self.pending is None:
+            self.end = self.fh.seek(0, 2)
+            self.pending = []
+
+    def _write_pending(self) -> None:
+        self.fh.seek(0, 2)
+        self.fh.write(b"".join(self.pending))
+        self.fh.flush()
+        self.pending.clear()
+
+    @metrics.timed("persistence")
+    def commit(self) -> None:
+        if self.pending is not None:
+            if self.fh is not None:
+                self._write_pending()
+            self.pending = None
+
+    def _replace(self, frames) -> None:
+        '''
+        Write (note id, payload) frames to a new file and swap it in atomically
+        '''
+        tmp_name = self.filename + ".tmp"
+        offsets = {}
+        with open(tmp_name, 'wb') as out:
+            out.write(NOTES_MAGIC)
+            for note_id, payload in frames:
+                offsets[note_id] = (out.tell() + FRAME.size, len(payload))
+                out.write(FRAME.pack(PUT, note_id, len(payload)) + payload)
+            out.flush()
+            os.fsync(out.fileno())
+        self.close()
+        os.replace(tmp_name, self.filename)
+        self.fh = open(self.filename, 'r+b')
+        self.offsets = offsets
+        self.garbage = 0
+
+    def rewrite(self, records: list) -> None:
+        self._replace((record.id, pickle.dumps(record)) for record in records)
+
+    @metrics.timed("persistence")
+    def compact(self) -> None:
+        '''
+        Drop old versions, copying the live frames without decoding them
+        '''
+        if self.pending:
+            self._write_pending()
+
+        def frames():
+            for note_id, (offset, length) in self.offsets.items():
+                self.fh.seek(offset)
+                yield note_id, self.fh.read(length)
+        self._replace(list(frames()))
+
+    @metrics.timed("persistence")
+    def sync(self) -> None:
+        if self.pending:
+            self._write_pending()
+        if self.garbage > COMPACT_GARBAGE and self.garbage > os.fstat(self.fh.fileno()).st_size // 2:
+            self.compact()
+        else:
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+
+    def close(self) -> None:
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
 try:
     notes_lst[0]
 except NameError:
     notes_lst = []
 
+notes_by_id = {}
+note_index = NoteIndex()
+tag_index = TagIndex()
+next_id = 1
+note_store = None
+# notes of a lazily opened store are decoded on first use
+_unloaded = False
+
+def _saved(record: NoteRecord) -> None:
+    if note_store is None:
+        return
+    if note_store.searchable:
+        if record.id is not None:
+            note_store.put(record)
+    elif notes_by_id.get(record.id) is record:
+        note_store.put(record)
+
+def _searchable() -> bool:
+    return note_store is not None and note_store.searchable
+
+@metrics.timed("persistence")
+def _ensure_loaded() -> None:
+    global _unloaded
+    if not _unloaded:
+        return
+    _unloaded = False
+    for note_id in list(note_store.offsets):
+        record = note_store.get(note_id)
+        notes_lst.append(record)
+        _register(record)
+
+def _register(record: NoteRecord) -> None:
+    global next_id
+    # notes pickled before ids existed have no id attribute
+    if getattr(record, "id", None) is None or record.id in notes_by_id:
+        record.id = next_id
+    next_id = max(next_id, record.id + 1)
+    if isinstance(record.tags, list):
+        # tags were a list before the tag index
+        record.tags = dict.fromkeys(record.tags)
+    notes_by_id[record.id] = record
+    note_index.add(record.id, record.note)
+    for tag in record.tags:
+        tag_index.add(record.id, tag)
+
+def _rebuild() -> None:
+    global note_index, tag_index, next_id
+    notes_by_id.clear()
+    note_index = NoteIndex()
+    tag_index = TagIndex()
+    next_id = 1
+    for record in notes_lst:
+        _register(record)
+
 def add_record(record: NoteRecord) -> None:
+    if _searchable():
+        note_store.add(record)
+        return
+    _ensure_loaded()
     notes_lst.append(record)
+    _register(record)
+    _saved(record)
     
+@metrics.timed("search")
 def find_by_tag(key: str) -> list:
-    notes = []
-    for i in notes_lst:
-        if key.lower() in i.tags:
-            notes.append(i)
-    return notes
+    if _searchable():
+        return note_store.find_by_tag(key)
+    _ensure_loaded()
+    return [notes_by_id[note_id] for note_id in sorted(tag_index.search(key, notes_by_id))]
     
+@metrics.timed("search")
 def find_by_note(key: str) -> list:
-    notes = []
-    for i in notes_lst:
-        if key in i.note:
-            notes.append(i)
-    return notes
+    if _searchable():
+        return note_store.find_by_note(key)
+    _ensure_loaded()
+    return [notes_by_id[note_id] for note_id in note_index.search(key, len(notes_by_id))]
 
+@metrics.timed("search")
 def sort_notes() -> list:
+    if _searchable():
+        return note_store.sort_notes()
+    _ensure_loaded()
     lst = []
     notes_lst.sort(key = lambda x: len(x.tags), reverse=True)
     for i in notes_lst:
@@ -55,19 +497,83 @@ def sort_notes() -> list:
     return lst
 
 def delete_note(key) -> None:
+    if _searchable():
+        note_store.delete(key.id)
+        return
+    _ensure_loaded()
     notes_lst.remove(key)
+    if notes_by_id.pop(key.id, None) is not None:
+        note_index.remove(key.id, key.note)
+        for tag in key.tags:
+            tag_index.remove(key.id, tag)
+        if note_store is not None:
+            note_store.delete(key.id)
 
-def save_notes(filename="notes_book.bin") -> None:
-    with open(filename, 'wb') as fh:
-        pickle.dump(notes_lst, fh)
-        
-def load_notes(filename="notes_book.bin") -> None:
-    global notes_lst
+@contextmanager
+def batch():
+    '''
+    Changes made inside the block are written to the store at once when it ends
+    '''
+    store = note_store
+    if store is not None:
+        store.defer()
     try:
-        with open(filename, 'rb') as fh:
-            notes_lst = pickle.load(fh)
-    except FileNotFoundError:
-        ...
+        yield
+    finally:
+        if store is not None:
+            store.commit()
+
+@metrics.timed("persistence")
+def save_notes(filename=NOTES_FILE) -> None:
+    '''
+    Every change is already appended to the store, this only syncs it
+    (and compacts it when old versions take most of the file)
+    '''
+    global note_store
+    if note_store is not None and (note_store.filename == filename or note_store.searchable):
+        note_store.sync()
+        return
+    _ensure_loaded()
+    if note_store is not None:
+        note_store.close()
+    note_store = NoteStore(filename)
+    note_store.rewrite(notes_lst)
+
+@metrics.timed("persistence")
+def load_notes(filename=NOTES_FILE, lazy=False) -> None:
+    '''
+    Open the note store. With lazy=True only frame headers are read,
+    notes are decoded by the first function that needs them.
+    '''
+    global notes_lst, note_store, _unloaded
+    if note_store is not None:
+        note_store.close()
+    note_store = NoteStore(filename)
+    legacy = note_store.open()
+    _unloaded = False
+    if legacy is not None:
+        # old format: one pickled list, convert it
+        notes_lst = legacy
+        _rebuild()
+        note_store.rewrite(notes_lst)
+    else:
+        notes_lst = []
+        _rebuild()
+        _unloaded = True
+        if not lazy:
+            _ensure_loaded()
+
+def open_store(store) -> None:
+    '''
+    Use a store that keeps and searches the notes itself (see sqlite_store)
+    '''
+    global notes_lst, note_store, _unloaded
+    if note_store is not None:
+        note_store.close()
+    note_store = store
+    notes_lst = []
+    _unloaded = False
+    _rebuild()
 
 if __name__ == "__main__":
     ...
\ No newline at end of file
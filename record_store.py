@@ -0,0 +1,269 @@
+from collections.abc import MutableMapping, ItemsView, ValuesView
+import mmap
+import os
+import struct
+
+
+STORE_MAGIC = b"BOOKMM1\n"
+# name offset, name length, record offset, record length
+ENTRY = struct.Struct("<QIQI")
+# position in the name table of the n-th added record
+ORDER = struct.Struct("<I")
+# generation, count, names offset, table offset, order offset, magic
+FOOTER = struct.Struct("<QQQQQ8s")
+
+
+def write_store(filename: str, items, generation: int) -> None:
+    '''
+    Write (name, encoded record) pairs, in the order they were added.
+    Layout: magic, records, names sorted, name table, order, footer.
+    '''
+    entries = []
+    with open(filename, 'wb') as fh:
+        fh.write(STORE_MAGIC)
+        pos = len(STORE_MAGIC)
+        for name, raw in items:
+            entries.append((name.encode('utf-8'), pos, len(raw)))
+            fh.write(raw)
+            pos += len(raw)
+        # utf-8 bytes sort in the same order as the str names
+        by_name = sorted(range(len(entries)), key=lambda i: entries[i][0])
+        names_offset = pos
+        name_offsets = {}
+        for i in by_name:
+            name_offsets[i] = pos
+            fh.write(entries[i][0])
+            pos += len(entries[i][0])
+        table_offset = pos
+        fh.write(b"".join(ENTRY.pack(name_offsets[i], len(entries[i][0]), entries[i][1], entries[i][2])
+                          for i in by_name))
+        order = [0] * len(entries)
+        for position, i in enumerate(by_name):
+            order[i] = position
+        order_offset = table_offset + ENTRY.size * len(entries)
+        fh.write(b"".join(ORDER.pack(position) for position in order))
+        fh.write(FOOTER.pack(generation, len(entries), names_offset, table_offset, order_offset, STORE_MAGIC))
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+class RecordStore:
+    '''
+    Read side of a file written by write_store, opened through mmap.
+    A name is found by a binary search over the fixed size name table,
+    only the record asked for is read, nothing is decoded up front.
+    '''
+    def __init__(self, filename: str) -> None:
+        with open(filename, 'rb') as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (self.generation, self.count, self.names_offset,
+         self.table_offset, self.order_offset, magic) = FOOTER.unpack_from(self.mm, len(self.mm) - FOOTER.size)
+        if magic != STORE_MAGIC:
+            self.mm.close()
+            raise ValueError(f"{filename} is not a record store")
+
+    @staticmethod
+    def is_store(filename: str) -> bool:
+        with open(filename, 'rb') as fh:
+            return fh.read(len(STORE_MAGIC)) == STORE_MAGIC
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self) -> None:
+        self.mm.close()
+
+    def _entry(self, position: int) -> tuple:
+        return ENTRY.unpack_from(self.mm, self.table_offset + position * ENTRY.size)
+
+    def _name(self, entry: tuple) -> bytes:
+        return self.mm[entry[0]:entry[0] + entry[1]]
+
+    def find(self, name: str):
+        '''
+        Entry of name or None
+        '''
+        key = name.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            found = self._name(entry)
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return entry
+        return None
+
+    def get(self, name: str):
+        '''
+        Encoded record of name or None
+        '''
+        entry = self.find(name)
+        if entry is None:
+            return None
+        return self.mm[entry[2]:entry[2] + entry[3]]
+
+    def items(self, start=0):
+        '''
+        Yield (name, encoded record) in the order the records were added,
+        starting with the start-th one
+        '''
+        mm = self.mm
+        for i in range(start, self.count):
+            entry = self._entry(ORDER.unpack_from(mm, self.order_offset + i * ORDER.size)[0])
+            yield self._name(entry).decode('utf-8'), mm[entry[2]:entry[2] + entry[3]]
+
+
+class RecordValues(ValuesView):
+    def __iter__(self):
+        for _, record in self._mapping.stream():
+            yield record
+
+
+class RecordItems(ItemsView):
+    def __iter__(self):
+        return self._mapping.stream()
+
+
+class RecordMap(MutableMapping):
+    '''
+    Records of a book on top of a RecordStore.
+    A record is decoded when it is asked for by name and kept in loaded,
+    as are the new and changed ones. read(), values() and items() decode
+    the rest from the store without keeping them.
+    '''
+    def __init__(self, store=None, decode=None) -> None:
+        self.store = store
+        self.decode = decode
+        self.loaded = {}
+        # names added that are not in the store, in order
+        self.new = {}
+        self.deleted = set()
+        self.count = len(store) if store is not None else 0
+
+    def _stored(self, name: str) -> bool:
+        return self.store is not None and name not in self.deleted and self.store.find(name) is not None
+
+    def __getitem__(self, name: str):
+        record = self.loaded.get(name)
+        if record is not None:
+            return record
+        if self.store is None or name in self.deleted:
+            raise KeyError(name)
+        raw = self.store.get(name)
+        if raw is None:
+            raise KeyError(name)
+        record = self.loaded[name] = self.decode(raw)
+        return record
+
+    def read(self, name: str):
+        '''
+        Record by name for listings and searches: decoded, but kept only
+        if it is changed (see keep())
+        '''
+        record = self.loaded.get(name)
+        if record is not None:
+            return record
+        raw = None if self.store is None or name in self.deleted else self.store.get(name)
+        if raw is None:
+            raise KeyError(name)
+        return self.decode(raw)
+
+    def __setitem__(self, name: str, record) -> None:
+        if name not in self.loaded and not self._stored(name):
+            self.count += 1
+            if self.store is None or self.store.find(name) is None:
+                self.new[name] = None
+        self.deleted.discard(name)
+        self.loaded[name] = record
+
+    def __delitem__(self, name: str) -> None:
+        if name not in self:
+            raise KeyError(name)
+        self.loaded.pop(name, None)
+        self.new.pop(name, None)
+        if self.store is not None and self.store.find(name) is not None:
+            self.deleted.add(name)
+        self.count -= 1
+
+    def __contains__(self, name) -> bool:
+        return name in self.loaded or self._stored(name)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        for name, _ in self.raw_items():
+            yield name
+
+    def keep(self, name: str, record) -> None:
+        '''
+        Keep a streamed record that was changed
+        '''
+        if name in self:
+            self.loaded[name] = record
+
+    def _entries(self, start=0):
+        '''
+        Yield (position, name, loaded record or None, encoded record or None)
+        in the order the records were added. Positions count the deleted
+        records of the store too, so the store is entered right at start.
+        '''
+        stored = len(self.store) if self.store is not None else 0
+        if start < stored:
+            for position, (name, raw) in enumerate(self.store.items(start), start + 1):
+                if name in self.deleted:
+                    continue
+                record = self.loaded.get(name)
+                yield position, name, record, None if record is not None else raw
+        first_new = max(start, stored)
+        for position, name in enumerate(list(self.new)[first_new - stored:], first_new + 1):
+            yield position, name, self.loaded[name], None
+
+    def raw_items(self):
+        '''
+        Yield (name, (loaded record, None)) or (name, (None, encoded record))
+        in the order the records were added
+        '''
+        for _, name, record, raw in self._entries():
+            yield name, (record, raw)
+
+    def stream(self):
+        '''
+        Yield (name, record) in the order the records were added
+        '''
+        for _, name, record, raw in self._entries():
+            yield name, record if record is not None else self.decode(raw)
+
+    def walk(self, start=0):
+        '''
+        Yield (position, record) in the order the records were added, starting
+        after position start; records before it are neither read nor decoded
+        '''
+        for position, _, record, raw in self._entries(start):
+            yield position, record if record is not None else self.decode(raw)
+
+    def values(self):
+        return RecordValues(self)
+
+    def items(self):
+        return RecordItems(self)
+
+    def reopen(self, store) -> None:
+        '''
+        Switch to a store holding all the records, e.g. after a compaction
+        '''
+        self.close()
+        self.store = store
+        self.loaded = {}
+        self.new = {}
+        self.deleted = set()
+        self.count = len(store)
+
+    def close(self) -> None:
+        if self.store is not None:
+            self.store.close()
+            self.store = None
@@ -0,0 +1,49 @@
+class CommandRouter:
+    '''
+    Commands kept in a trie of words.
+    The longest command matching the first words of the input wins,
+    the rest of the words are the arguments. Routing costs one dict
+    lookup per word, whatever the number of commands.
+    '''
+    # key of the handler in a trie node, can't clash with a word
+    HANDLER = None
+
+    def __init__(self, operations=None, aliases=None) -> None:
+        self.root = {}
+        self.names = []
+        # handler: the name it was registered under first, aliases don't replace it
+        self.commands = {}
+        for name, func in (operations or {}).items():
+            self.register(name, func)
+        for alias, name in (aliases or {}).items():
+            self.alias(alias, name)
+
+    def register(self, name: str, func) -> None:
+        node = self.root
+        for word in name.split():
+            node = node.setdefault(word, {})
+        if self.HANDLER not in node:
+            self.names.append(name)
+        node[self.HANDLER] = func
+        self.commands.setdefault(func, name)
+
+    def alias(self, alias: str, name: str) -> None:
+        func, params = self.route(name)
+        if func is None or params:
+            raise KeyError(name)
+        self.register(alias, func)
+
+    def route(self, inp: str) -> tuple:
+        '''
+        Returns (handler or None, list of arguments)
+        '''
+        words = inp.split()
+        node = self.root
+        func, used = None, 0
+        for i, word in enumerate(words):
+            node = node.get(word)
+            if node is None:
+                break
+            if self.HANDLER in node:
+                func, used = node[self.HANDLER], i + 1
+        return func, words[used:]
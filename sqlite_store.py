@@ -0,0 +1,590 @@
+from collections.abc import MutableMapping, ItemsView, ValuesView
+from contextlib import contextmanager
+from datetime import date, timedelta
+import sqlite3
+
+from classes import AddressBook, Record, BLUE, RESET
+from indexes import calendar_key
+import metrics
+from notes import NoteRecord, parse_note_query, parse_tag_query
+
+
+# records read from the database at a time while streaming
+FETCH_SIZE = 500
+# sorts after every name starting with a given prefix
+MAX_CHAR = "\U0010ffff"
+
+BOOK_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS contacts (
+    seq INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    name_lower TEXT NOT NULL,
+    birthday INTEGER,
+    birthday_md INTEGER,
+    address TEXT
+);
+CREATE INDEX IF NOT EXISTS contacts_name_lower ON contacts (name_lower, name);
+CREATE INDEX IF NOT EXISTS contacts_birthday ON contacts (birthday_md, name) WHERE birthday_md IS NOT NULL;
+CREATE TABLE IF NOT EXISTS phones (name TEXT NOT NULL, phone TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS phones_name ON phones (name);
+CREATE TABLE IF NOT EXISTS emails (name TEXT NOT NULL, email TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS emails_name ON emails (name);
+'''
+
+# substring index of names and phones: one row per contact (rowid = seq),
+# FTS5 trigram tokens answer "contains" queries of 3 characters and more
+GRAMS_TABLE = "CREATE VIRTUAL TABLE contacts_grams USING fts5(name_lower, phones, tokenize='trigram')"
+GRAMS_FILL = '''
+INSERT INTO contacts_grams (rowid, name_lower, phones)
+SELECT seq, name_lower, (SELECT group_concat(phone, ' ') FROM phones WHERE phones.name = contacts.name)
+FROM contacts
+'''
+GRAM = 3
+
+NOTES_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    note TEXT NOT NULL,
+    tag_count INTEGER NOT NULL DEFAULT 0,
+    create_date TEXT,
+    change_date TEXT
+);
+CREATE INDEX IF NOT EXISTS notes_tag_count ON notes (tag_count DESC, id);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT NOT NULL,
+    note_id INTEGER NOT NULL,
+    pos INTEGER NOT NULL,
+    PRIMARY KEY (tag, note_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tags_note ON tags (note_id);
+'''
+NOTES_FTS_TABLE = "CREATE VIRTUAL TABLE notes_fts USING fts5(note)"
+NOTES_FTS_FILL = "INSERT INTO notes_fts (rowid, note) SELECT id, note FROM notes"
+
+
+class Database:
+    '''
+    SQLite connection shared by the book and the notes.
+    Writes go through transaction(); nested ones are savepoints of the
+    outer one, so a batch is committed once at the end.
+    '''
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        # opened by the background loader, used by the main thread after it
+        self.conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.depth = 0
+        # run once the outer transaction is committed
+        self.after_commit = []
+
+    def execute(self, sql: str, params=()):
+        return self.conn.execute(sql, params)
+
+    def begin(self) -> None:
+        # nested transactions are savepoints of the outer one
+        self.conn.execute("BEGIN" if self.depth == 0 else f"SAVEPOINT level{self.depth}")
+        self.depth += 1
+
+    def end(self, rollback=False) -> None:
+        self.depth -= 1
+        if self.depth == 0:
+            self.conn.execute("ROLLBACK" if rollback else "COMMIT")
+            actions, self.after_commit = self.after_commit, []
+            if not rollback:
+                for action in actions:
+                    action()
+            return
+        if rollback:
+            self.conn.execute(f"ROLLBACK TO level{self.depth}")
+        self.conn.execute(f"RELEASE level{self.depth}")
+
+    def on_commit(self, action) -> None:
+        '''
+        Run action now, or after the open transaction is committed
+        (checkpoints and VACUUM can't run inside one)
+        '''
+        if self.depth == 0:
+            action()
+        else:
+            self.after_commit.append(action)
+
+    @contextmanager
+    def transaction(self):
+        self.begin()
+        try:
+            yield self.conn
+        except BaseException:
+            self.end(rollback=True)
+            raise
+        self.end()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class SQLiteValues(ValuesView):
+    def __iter__(self):
+        for _, record in self._mapping.stream():
+            yield record
+
+
+class SQLiteItems(ItemsView):
+    def __iter__(self):
+        return self._mapping.stream()
+
+
+class SQLiteRecords(MutableMapping):
+    '''
+    Records of a SQLiteBook, read from the database on every access
+    '''
+    def __init__(self, book) -> None:
+        self.book = book
+
+    def __getitem__(self, name: str) -> Record:
+        records = self.book._records([name])
+        if not records:
+            raise KeyError(name)
+        return records[0]
+
+    def __setitem__(self, name: str, record: Record) -> None:
+        self.book._write(record)
+
+    def __delitem__(self, name: str) -> None:
+        with self.book.db.transaction() as conn:
+            row = conn.execute("SELECT seq FROM contacts WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                raise KeyError(name)
+            conn.execute("DELETE FROM contacts WHERE seq = ?", row)
+            if self.book.grams:
+                conn.execute("DELETE FROM contacts_grams WHERE rowid = ?", row)
+            conn.execute("DELETE FROM phones WHERE name = ?", (name,))
+            conn.execute("DELETE FROM emails WHERE name = ?", (name,))
+
+    def __contains__(self, name) -> bool:
+        return self.book.db.execute("SELECT 1 FROM contacts WHERE name = ?", (name,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.book.db.execute("SELECT count(*) FROM contacts").fetchone()[0]
+
+    def __iter__(self):
+        for name, _ in self.stream():
+            yield name
+
+    def stream(self, start=0):
+        '''
+        Yield (name, record) in the order the records were added
+        '''
+        for _, record in self.book._walk("added", None, start):
+            yield record.name.value, record
+
+    def values(self):
+        return SQLiteValues(self)
+
+    def items(self):
+        return SQLiteItems(self)
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteBook(AddressBook):
+    '''
+    AddressBook kept in a SQLite database instead of book.dat.
+    Lookups and listings are queries over indexed columns (name, birthday
+    month-day), substrings of names and phones are found through a trigram
+    table. Each change is one transaction, changes made inside batch() share one.
+    '''
+    def __init__(self, *args, **kwargs) -> None:
+        self.db = None
+        # False when this SQLite has no FTS5 trigram tokenizer, searches scan then
+        self.grams = False
+        super().__init__(*args, **kwargs)
+        self.data = SQLiteRecords(self)
+
+    def _records(self, names: list) -> list:
+        '''
+        Records of names, in the given order, missing names are skipped
+        '''
+        if len(names) > FETCH_SIZE:
+            return [record for i in range(0, len(names), FETCH_SIZE)
+                    for record in self._records(names[i:i+FETCH_SIZE])]
+        if not names:
+            return []
+        marks = ",".join("?" * len(names))
+        rows = self.db.execute(f"SELECT name, birthday, address FROM contacts WHERE name IN ({marks})", names)
+        contacts = {name: (birthday, address) for name, birthday, address in rows}
+        phones, emails = {}, {}
+        for name, phone in self.db.execute(f"SELECT name, phone FROM phones WHERE name IN ({marks}) ORDER BY rowid", names):
+            phones.setdefault(name, []).append(phone)
+        for name, email in self.db.execute(f"SELECT name, email FROM emails WHERE name IN ({marks}) ORDER BY rowid", names):
+            emails.setdefault(name, []).append(email)
+        records = []
+        for name in names:
+            if name not in contacts:
+                continue
+            birthday, address = contacts[name]
+            record = Record.unpack((name, phones.get(name, ()), emails.get(name, ()), birthday or 0, address))
+            record.book = self
+            records.append(record)
+        return records
+
+    def _by_name(self, rows: list) -> dict:
+        return {record.name.value: record for record in self._records([row[1] for row in rows])}
+
+    @metrics.timed("persistence")
+    def _write(self, record: Record) -> None:
+        name, phones, emails, birthday, address = record.pack()
+        birthday_md = None
+        if birthday:
+            day = record.birthday.value
+            birthday_md = day.month * 100 + day.day
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT INTO contacts (name, name_lower, birthday, birthday_md, address) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET birthday = excluded.birthday, "
+                "birthday_md = excluded.birthday_md, address = excluded.address",
+                (name, name.lower(), birthday or None, birthday_md, address))
+            if self.grams:
+                seq = conn.execute("SELECT seq FROM contacts WHERE name = ?", (name,)).fetchone()[0]
+                conn.execute("DELETE FROM contacts_grams WHERE rowid = ?", (seq,))
+                conn.execute("INSERT INTO contacts_grams (rowid, name_lower, phones) VALUES (?, ?, ?)",
+                             (seq, name.lower(), " ".join(phones)))
+            conn.execute("DELETE FROM phones WHERE name = ?", (name,))
+            conn.executemany("INSERT INTO phones (name, phone) VALUES (?, ?)", [(name, phone) for phone in phones])
+            conn.execute("DELETE FROM emails WHERE name = ?", (name,))
+            conn.executemany("INSERT INTO emails (name, email) VALUES (?, ?)", [(name, email) for email in emails])
+
+    def add_record(self, record: Record) -> None:
+        record.book = self
+        self._write(record)
+
+    def record_changed(self, record: Record, op: str, *args) -> None:
+        self._write(record)
+
+    @metrics.timed("persistence")
+    def delete(self, name: str) -> None:
+        if name in self.data:
+            del self.data[name]
+
+    @metrics.timed("search")
+    def search_phones(self, search: str) -> list:
+        if self.grams and len(search) >= GRAM:
+            rows = self.db.execute("SELECT name FROM contacts_grams JOIN contacts ON seq = contacts_grams.rowid "
+                                   "WHERE contacts_grams.phones MATCH ? ORDER BY seq", (self._phrase(search),))
+        else:
+            rows = self.db.execute("SELECT DISTINCT name FROM phones WHERE instr(phone, ?) > 0", (search,))
+        return self._records([name for name, in rows])
+
+    @staticmethod
+    def _phrase(search: str) -> str:
+        return '"' + search.replace('"', '""') + '"'
+
+
+    @metrics.timed("search")
+    def search_names(self, search: str, limit=None) -> list:
+        lower = search.lower()
+        sql_limit = -1 if limit is None else limit
+        names = [name for name, in self.db.execute(
+            "SELECT name FROM contacts WHERE name_lower >= ? AND name_lower < ? ORDER BY name_lower, name LIMIT ?",
+            (lower, lower + MAX_CHAR, sql_limit))]
+        if limit is None or len(names) < limit:
+            # same ranking as NameIndex.search
+            ranked = []
+            if self.grams and len(lower) >= GRAM:
+                rows = self.db.execute("SELECT name, contacts.name_lower FROM contacts_grams JOIN contacts "
+                                       "ON seq = contacts_grams.rowid WHERE contacts_grams.name_lower MATCH ?",
+                                       (self._phrase(lower),))
+            else:
+                rows = self.db.execute("SELECT name, name_lower FROM contacts WHERE instr(name_lower, ?) > 1",
+                                       (lower,))
+            for name, name_lower in rows:
+                pos = name_lower.find(lower)
+                if pos == 0:
+                    continue
+                ranked.append((name_lower[pos-1].isalnum(), pos, len(name), name))
+            ranked.sort()
+            names.extend(rank[-1] for rank in ranked)
+        if limit is not None:
+            names = names[:limit]
+        return self._records(names)
+
+    def _walk(self, order: str, position=None, start=0):
+        '''
+        Yield (position, record) pairs, FETCH_SIZE records per query,
+        position is the sort key of the record to resume after
+        '''
+        if order == "name":
+            sql = ("SELECT name_lower, name FROM contacts WHERE (name_lower, name) > (?, ?) "
+                   "ORDER BY name_lower, name LIMIT ?")
+            key = position or ("", "")
+            segments = [(sql, key, False)]
+        elif order == "birthday":
+            if position is None:
+                month, day = calendar_key(date.today())
+                first = month * 100 + day
+                key, wrapped = (first, ""), False
+            else:
+                first, key, wrapped = position
+            after = ("SELECT birthday_md, name FROM contacts WHERE birthday_md IS NOT NULL "
+                     "AND (birthday_md, name) > (?, ?) AND birthday_md >= {first} ORDER BY birthday_md, name LIMIT ?")
+            before = ("SELECT birthday_md, name FROM contacts WHERE birthday_md IS NOT NULL "
+                      "AND (birthday_md, name) > (?, ?) AND birthday_md < {first} ORDER BY birthday_md, name LIMIT ?")
+            segments = [(before.format(first=int(first)), key if wrapped else (0, ""), True)]
+            if not wrapped:
+                segments.insert(0, (after.format(first=int(first)), key, False))
+        else:
+            sql = "SELECT seq, name FROM contacts WHERE seq > ? ORDER BY seq LIMIT ? OFFSET ?"
+            seq = position or 0
+            while True:
+                rows = self.db.execute(sql, (seq, FETCH_SIZE, start)).fetchall()
+                start = 0
+                if not rows:
+                    return
+                records = self._by_name(rows)
+                for seq, name in rows:
+                    if name in records:
+                        yield seq, records[name]
+            return
+        for sql, key, wrapped in segments:
+            while True:
+                rows = self.db.execute(sql, key + (FETCH_SIZE,)).fetchall()
+                if not rows:
+                    break
+                records = self._by_name(rows)
+                for row in rows:
+                    if row[1] in records:
+                        yield ((first, row, wrapped) if order == "birthday" else row), records[row[1]]
+                key = rows[-1]
+
+    @metrics.timed("search")
+    def bd_in_xx_days(self, days: int):
+        names = []
+        if days > 0:
+            today = date.today()
+            month, day = calendar_key(today)
+            first = month * 100 + day
+            sql = ("SELECT name FROM contacts WHERE birthday_md >= ? AND birthday_md < ? "
+                   "ORDER BY birthday_md, name")
+            if days >= 366:
+                ranges = [(first, 10000), (0, first)]
+            else:
+                month, day = calendar_key(today + timedelta(days=days))
+                last = month * 100 + day
+                ranges = [(first, last)] if first < last else [(first, 10000), (0, last)]
+            for low, high in ranges:
+                names.extend(name for name, in self.db.execute(sql, (low, high)))
+        suit_lst = self._records(names)
+        if not suit_lst:
+            suit_lst.append(f"{BLUE}Noone has birthday in {days} days!{RESET}")
+        for rec in suit_lst:
+            yield [rec]
+
+    @contextmanager
+    def batch(self):
+        '''
+        Changes made inside the block are committed in one transaction
+        '''
+        with self.db.transaction():
+            yield self
+
+    def close(self) -> None:
+        pass
+
+    @metrics.timed("persistence")
+    def compact(self, filename=None) -> None:
+        '''
+        Copy the database to filename, or rebuild it in place
+        '''
+        if filename is None or filename == self.filename:
+            self.db.execute("VACUUM")
+        else:
+            self.db.execute("VACUUM INTO ?", (filename,))
+
+    @metrics.timed("persistence")
+    def save(self, filename=None, format='bin') -> None:
+        '''
+        Every change is already committed; saving to another file copies the database.
+        Inside batch() this happens when the batch is committed.
+        '''
+        if filename is not None and filename != self.filename:
+            self.db.on_commit(lambda: self.compact(filename))
+        else:
+            self.db.on_commit(lambda: self.db.execute("PRAGMA wal_checkpoint(PASSIVE)"))
+
+    @metrics.timed("persistence")
+    def load(self, filename=None, format='bin') -> None:
+        filename = filename or self.filename
+        if self.db is None or self.db.filename != filename:
+            if self.db is not None:
+                self.db.close()
+            self.db = Database(filename)
+        self.filename = filename
+        self.db.conn.executescript(BOOK_SCHEMA)
+        self.grams = self._create_grams()
+
+    def _create_grams(self) -> bool:
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'contacts_grams'").fetchone():
+            return True
+        try:
+            with self.db.transaction() as conn:
+                conn.execute(GRAMS_TABLE)
+                # a database made before the table existed
+                conn.execute(GRAMS_FILL)
+        except sqlite3.OperationalError:
+            return False
+        return True
+
+
+class SQLiteNoteStore:
+    '''
+    Notes kept in the database of a SQLiteBook.
+    Tags are an indexed table, note text is searched with FTS5
+    (or with LIKE when sqlite is built without it).
+    '''
+    searchable = True
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+        self.filename = db.filename
+        db.conn.executescript(NOTES_SCHEMA)
+        self.fts = self._create_fts()
+        if not self.fts:
+            db.conn.create_function("py_lower", 1, str.lower, deterministic=True)
+
+    def _create_fts(self) -> bool:
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'notes_fts'").fetchone():
+            return True
+        try:
+            with self.db.transaction() as conn:
+                conn.execute(NOTES_FTS_TABLE)
+                # notes written while sqlite had no FTS5
+                conn.execute(NOTES_FTS_FILL)
+        except sqlite3.OperationalError:
+            return False
+        return True
+
+    def _write(self, conn, record: NoteRecord) -> None:
+        conn.execute("INSERT OR REPLACE INTO notes (id, note, tag_count, create_date, change_date) "
+                     "VALUES (?, ?, ?, ?, ?)",
+                     (record.id, record.note, len(record.tags),
+                      record.create_date.isoformat() if record.create_date else None,
+                      record.change_date.isoformat() if record.change_date else None))
+        conn.execute("DELETE FROM tags WHERE note_id = ?", (record.id,))
+        conn.executemany("INSERT INTO tags (tag, note_id, pos) VALUES (?, ?, ?)",
+                         [(tag, record.id, pos) for pos, tag in enumerate(record.tags)])
+        if self.fts:
+            conn.execute("DELETE FROM notes_fts WHERE rowid = ?", (record.id,))
+            conn.execute("INSERT INTO notes_fts (rowid, note) VALUES (?, ?)", (record.id, record.note))
+
+    @metrics.timed("persistence")
+    def add(self, record: NoteRecord) -> None:
+        with self.db.transaction() as conn:
+            record.id = conn.execute("SELECT coalesce(max(id), 0) + 1 FROM notes").fetchone()[0]
+            self._write(conn, record)
+
+    @metrics.timed("persistence")
+    def put(self, record: NoteRecord) -> None:
+        with self.db.transaction() as conn:
+            self._write(conn, record)
+
+    @metrics.timed("persistence")
+    def delete(self, note_id: int) -> None:
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+            conn.execute("DELETE FROM tags WHERE note_id = ?", (note_id,))
+            if self.fts:
+                conn.execute("DELETE FROM notes_fts WHERE rowid = ?", (note_id,))
+
+    def _notes(self, ids: list) -> list:
+        '''
+        Notes of ids, in the given order
+        '''
+        if len(ids) > FETCH_SIZE:
+            return [record for i in range(0, len(ids), FETCH_SIZE)
+                    for record in self._notes(ids[i:i+FETCH_SIZE])]
+        if not ids:
+            return []
+        marks = ",".join("?" * len(ids))
+        rows = self.db.execute(f"SELECT id, note, create_date, change_date FROM notes WHERE id IN ({marks})", ids)
+        found = {}
+        for note_id, note, create_date, change_date in rows:
+            record = NoteRecord.__new__(NoteRecord)
+            record.id = note_id
+            record.note = note
+            record.tags = {}
+            record.create_date = date.fromisoformat(create_date) if create_date else None
+            record.change_date = date.fromisoformat(change_date) if change_date else None
+            found[note_id] = record
+        for tag, note_id in self.db.execute(
+                f"SELECT tag, note_id FROM tags WHERE note_id IN ({marks}) ORDER BY note_id, pos", ids):
+            found[note_id].tags[tag] = None
+        return [found[note_id] for note_id in ids if note_id in found]
+
+    def get(self, note_id: int) -> NoteRecord:
+        notes = self._notes([note_id])
+        if not notes:
+            raise KeyError(note_id)
+        return notes[0]
+
+    def find_by_tag(self, query: str) -> list:
+        selects, params = [], []
+        for include, exclude in parse_tag_query(query):
+            parts = ["SELECT note_id FROM tags WHERE tag = ?"] * len(include) or ["SELECT id FROM notes"]
+            sql = " INTERSECT ".join(parts)
+            if exclude:
+                sql += " EXCEPT " + " EXCEPT ".join(["SELECT note_id FROM tags WHERE tag = ?"] * len(exclude))
+            selects.append(sql)
+            params.extend(include + exclude)
+        if not selects:
+            return []
+        # compound selects can't be nested in parentheses
+        sql = " UNION ".join(f"SELECT * FROM ({select})" for select in selects)
+        ids = sorted(note_id for note_id, in self.db.execute(sql, params))
+        return self._notes(ids)
+
+    def find_by_note(self, query: str) -> list:
+        clauses = parse_note_query(query)
+        if not clauses:
+            return []
+        if self.fts:
+            match = " OR ".join("(" + " AND ".join(self._fts_term(term) for term in clause) + ")"
+                                for clause in clauses)
+            rows = self.db.execute("SELECT rowid FROM notes_fts WHERE notes_fts MATCH ? ORDER BY rank, rowid",
+                                   (match,))
+        else:
+            # substring match without ranking
+            wheres, params = [], []
+            for clause in clauses:
+                for term in clause:
+                    params.append("%" + (" ".join(term) if isinstance(term, list) else term.rstrip("*")) + "%")
+                wheres.append(" AND ".join(["py_lower(note) LIKE ?"] * len(clause)))
+            rows = self.db.execute("SELECT id FROM notes WHERE " + " OR ".join(f"({where})" for where in wheres)
+                                   + " ORDER BY id", params)
+        return self._notes([note_id for note_id, in rows])
+
+    @staticmethod
+    def _fts_term(term) -> str:
+        if isinstance(term, list):
+            return '"' + " ".join(term) + '"'
+        if term.endswith("*"):
+            return '"' + term[:-1] + '" *'
+        return '"' + term + '"'
+
+    def sort_notes(self) -> list:
+        return self._notes([note_id for note_id, in self.db.execute(
+            "SELECT id FROM notes ORDER BY tag_count DESC, id")])
+
+    def defer(self) -> None:
+        self.db.begin()
+
+    @metrics.timed("persistence")
+    def commit(self) -> None:
+        self.db.end()
+
+    def sync(self) -> None:
+        pass
+
+    def close(self) -> None:
+        # the database belongs to the book
+        pass
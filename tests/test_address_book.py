@@ -0,0 +1,88 @@
+import pickle
+
+from classes import AddressBook, Record, JOURNAL_SUFFIX
+
+
+def open_book(filename):
+    book = AddressBook()
+    book.load(filename)
+    return book
+
+
+def add(book, name, phone):
+    record = Record(name)
+    record.add_phone(phone)
+    book.add_record(record)
+    return record
+
+
+def test_changes_survive_a_crash_through_the_journal(tmp_path):
+    filename = str(tmp_path / "book.dat")
+    book = open_book(filename)
+    add(book, "alice", "0123456789")
+    bob = add(book, "bob", "0987654321")
+    bob.add_email("bob@example.com")
+    bob.edit_phone("0987654321", "0000000001")
+    book.delete("alice")
+    # no save, no close: only the journal is on disk
+    copy = open_book(filename)
+    assert list(copy.data) == ["bob"]
+    assert [phone.value for phone in copy.find("bob").phones] == ["0000000001"]
+    assert [email.value for email in copy.find("bob").emails] == ["bob@example.com"]
+
+
+def test_torn_journal_entry_is_ignored(tmp_path):
+    filename = str(tmp_path / "book.dat")
+    book = open_book(filename)
+    add(book, "alice", "0123456789")
+    book.close()
+    with open(filename + JOURNAL_SUFFIX, "ab") as fh:
+        fh.write(pickle.dumps(("add_phone", "alice", ("0000000002",)))[:-3])
+    copy = open_book(filename)
+    assert [phone.value for phone in copy.find("alice").phones] == ["0123456789"]
+
+
+def test_compaction_folds_the_journal_into_the_snapshot(tmp_path):
+    filename = str(tmp_path / "book.dat")
+    book = open_book(filename)
+    for i in range(20):
+        add(book, f"name {i}", f"{i:010d}")
+    book.compact(filename)
+    add(book, "after", "0555555555")
+    book.delete("name 3")
+    book.close()
+    stale = (tmp_path / "book.dat.stale")
+    stale.write_bytes((tmp_path / ("book.dat" + JOURNAL_SUFFIX)).read_bytes())
+
+    copy = open_book(filename)
+    assert len(copy) == 20
+    assert "name 3" not in copy.data and "after" in copy.data
+    copy.compact(filename)
+    copy.close()
+    # the journal of the previous generation must not be replayed again
+    (tmp_path / ("book.dat" + JOURNAL_SUFFIX)).write_bytes(stale.read_bytes())
+    again = open_book(filename)
+    assert len(again) == 20 and "name 3" not in again.data
+
+
+def test_legacy_pickle_is_loaded(tmp_path):
+    filename = tmp_path / "book.dat"
+    record = Record("old")
+    record.add_phone("0123456789")
+    record.book = None
+    with open(filename, "wb") as fh:
+        pickle.dump({"old": record}, fh)
+    book = open_book(str(filename))
+    assert book.find("old").phones[0].value == "0123456789"
+
+
+def test_searches_follow_changes(tmp_path):
+    book = open_book(str(tmp_path / "book.dat"))
+    add(book, "Anna Petrenko", "0501234567")
+    add(book, "Petro Ivanenko", "0671234000")
+    assert [r.name.value for r in book.search_names("petr")] == ["Petro Ivanenko", "Anna Petrenko"]
+    assert {r.name.value for r in book.search_phones("1234")} == {"Anna Petrenko", "Petro Ivanenko"}
+    book.find("Anna Petrenko").edit_phone("0501234567", "0500000000")
+    assert [r.name.value for r in book.search_phones("1234")] == ["Petro Ivanenko"]
+    book.delete("Petro Ivanenko")
+    assert [r.name.value for r in book.search_names("petr")] == ["Anna Petrenko"]
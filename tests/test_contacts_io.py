@@ -0,0 +1,86 @@
+import contacts_io
+from classes import AddressBook, Record
+
+
+def test_vcard_round_trip_keeps_special_characters(tmp_path):
+    book = AddressBook()
+    record = Record("Smith, John; Jr \\ II")
+    record.add_phone("0123456789")
+    record.add_email("john@example.com")
+    record.add_address("Main st, 5; apt 3\nKyiv")
+    book.add_record(record)
+    filename = str(tmp_path / "book.vcf")
+    assert contacts_io.export_contacts(book, filename) == 1
+    text = (tmp_path / "book.vcf").read_text(encoding="utf-8")
+    assert r"FN:Smith\, John\; Jr \\ II" in text
+    assert "Kyiv" in text and "\nKyiv" not in text
+
+    imported = AddressBook()
+    assert contacts_io.import_contacts(imported, filename) == (1, [])
+    copy = imported.find("Smith, John; Jr \\ II")
+    assert copy.address == "Main st, 5; apt 3\nKyiv"
+    assert copy.phones[0].value == "0123456789"
+
+
+def test_vcard_folded_lines_and_structured_address(tmp_path):
+    filename = tmp_path / "in.vcf"
+    filename.write_text("BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Anna\r\n  Petrenko\r\nTEL;TYPE=cell:0501234567\r\n"
+                        "ADR:;;Shevchenka 1\\, office 2;Kyiv;;01001;UA\r\nEND:VCARD\r\n", encoding="utf-8")
+    book = AddressBook()
+    assert contacts_io.import_contacts(book, str(filename)) == (1, [])
+    record = book.find("Anna Petrenko")
+    assert record.address == "Shevchenka 1, office 2, Kyiv, 01001, UA"
+
+
+def test_csv_import_merges_and_reports_bad_rows(tmp_path):
+    filename = tmp_path / "in.csv"
+    filename.write_text("name,phones,emails,birthday,address\n"
+                        "Anna,0501234567;0671234567,anna@example.com,01.02.1990,Kyiv\n"
+                        ",0501234567,,,\n"
+                        "Bob,12345,,,\n"
+                        "Carl,,not-an-email,,\n"
+                        "Dan,,,31.02.1990,\n"
+                        "Anna,0931234567,,,\n", encoding="utf-8")
+    book = AddressBook()
+    imported, errors = contacts_io.import_contacts(book, str(filename))
+    assert imported == 2
+    assert errors == [(3, "no name"), (4, "bad phone"), (5, "bad email"), (6, "bad birthday")]
+    anna = book.find("Anna")
+    assert [phone.value for phone in anna.phones] == ["0501234567", "0671234567", "0931234567"]
+    assert anna.birthday.value.year == 1990 and anna.address == "Kyiv"
+
+
+def test_jsonl_import_reports_bad_lines_and_scalar_values(tmp_path):
+    filename = tmp_path / "in.jsonl"
+    filename.write_text('{"name": "Anna", "phones": ["0501234567"], "emails": "anna@example.com"}\n'
+                        '{"name": "Bob", "phones": 1234567890}\n'
+                        '{"name": "Carl", "phones": true}\n'
+                        'not json\n'
+                        '[1, 2]\n'
+                        '\n'
+                        '{"name": "Dan", "phones": 0501234567}\n', encoding="utf-8")
+    book = AddressBook()
+    imported, errors = contacts_io.import_contacts(book, str(filename))
+    assert imported == 2
+    assert [line_num for line_num, _ in errors] == [3, 4, 5, 7]
+    assert errors[0] == (3, "bad phone") and errors[2] == (5, "not a JSON object")
+    assert book.find("Bob").phones[0].value == "1234567890"
+    assert book.find("Anna").emails[0].value == "anna@example.com"
+
+
+def test_export_then_import_csv_and_jsonl(tmp_path):
+    book = AddressBook()
+    record = Record("Anna")
+    record.add_phone("0501234567")
+    record.add_phone("0671234567")
+    record.add_email("anna@example.com")
+    record.add_birthday("01.02.1990")
+    book.add_record(record)
+    for name in ("book.csv", "book.jsonl"):
+        filename = str(tmp_path / name)
+        assert contacts_io.export_contacts(book, filename) == 1
+        copy = AddressBook()
+        assert contacts_io.import_contacts(copy, filename) == (1, [])
+        anna = copy.find("Anna")
+        assert [phone.value for phone in anna.phones] == ["0501234567", "0671234567"]
+        assert anna.birthday.value == record.birthday.value
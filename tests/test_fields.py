@@ -0,0 +1,46 @@
+from datetime import date, timedelta
+
+import pytest
+
+import fields
+from fields import Birthday, Email, Phone, parse_date, parse_dates, validate_emails, validate_phones
+
+
+def test_parse_date_formats():
+    assert parse_date("01.02.1990") == date(1990, 2, 1)
+    assert parse_date("1.2.1990") == date(1990, 2, 1)
+    assert parse_date("1990-02-01") == date(1990, 2, 1)
+    assert parse_date("19900201") == date(1990, 2, 1)
+    for bad in ("31.02.1990", "1990-13-01", "01/02/1990", "1.2.90", "", "01.02.1990 ", "١٩٩٠-٠٢-٠١"):
+        with pytest.raises(ValueError):
+            parse_date(bad)
+
+
+def test_column_validators_match_the_fields():
+    phones = ["0123456789", "012345678", "01234567890", "012345678a", ""]
+    assert validate_phones(phones) == [fields.is_phone(phone) for phone in phones] == [True, False, False, False, False]
+    emails = ["ann@example.com", "a.b+c@mail.co.uk", "ann@", "@example.com", "ann example@x.com", ""]
+    assert validate_emails(emails) == [True, True, False, False, False, False]
+    for phone, ok in zip(phones, validate_phones(phones)):
+        if ok:
+            assert Phone(phone).value == phone
+        else:
+            with pytest.raises(ValueError):
+                Phone(phone)
+    with pytest.raises(ValueError):
+        Email("ann@")
+
+
+def test_parse_dates_rejects_bad_and_future_dates():
+    tomorrow = fields.today() + timedelta(days=1)
+    assert parse_dates(["01.02.1990", "31.02.1990", tomorrow.isoformat(), fields.today().isoformat()]) == \
+        [date(1990, 2, 1), None, None, fields.today()]
+    with pytest.raises(ValueError):
+        Birthday(tomorrow.isoformat())
+
+
+def test_today_is_looked_up_again_after_midnight(monkeypatch):
+    monkeypatch.setattr(fields, "_today", [date(2000, 1, 1), float("inf")])
+    assert fields.today() == date(2000, 1, 1)
+    fields._today[1] = 0.0
+    assert fields.today() == date.today()
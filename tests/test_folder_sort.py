@@ -0,0 +1,186 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import folder_sort
+
+
+def write(path, content=b"data"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path
+
+
+def make_tar(path, mode, members):
+    with tarfile.open(path, mode) as archive:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+
+
+def test_archives_with_shutil_format_extensions_are_unpacked(tmp_path):
+    make_tar(tmp_path / "a.gztar", "w:gz", {"x.txt": b"x"})
+    make_tar(tmp_path / "b.bztar", "w:bz2", {"y.txt": b"y"})
+    make_tar(tmp_path / "c.xztar", "w:xz", {"z.txt": b"z"})
+    with zipfile.ZipFile(tmp_path / "d.zip", "w") as archive:
+        archive.writestr("w.txt", b"w")
+    make_tar(tmp_path / "e.tar.gz", "w:gz", {"v.txt": b"v"})
+    folder_sort.main(str(tmp_path), archive_workers=1)
+    archives = tmp_path / "Archives"
+    for folder, name in (("a", "x.txt"), ("b", "y.txt"), ("c", "z.txt"), ("d", "w.txt"), ("e", "v.txt")):
+        assert (archives / folder / name).is_file()
+
+
+def test_report_mode_keeps_duplicates_in_place(tmp_path):
+    write(tmp_path / "a.txt", b"same content")
+    write(tmp_path / "sub" / "b.txt", b"same content")
+    write(tmp_path / "other" / "a.txt", b"same content")
+    write(tmp_path / "other" / "c.txt", b"unique")
+    folder_sort.main(str(tmp_path), dedup="report")
+    assert (tmp_path / "Docs" / "c.txt").read_bytes() == b"unique"
+    moved = [path for path in (tmp_path / "Docs").iterdir() if path.read_bytes() == b"same content"]
+    left = [path for path in (tmp_path / "sub" / "b.txt", tmp_path / "other" / "a.txt", tmp_path / "a.txt")
+            if path.exists()]
+    # one copy is sorted, the other two stay where they were
+    assert len(moved) == 1 and len(left) == 2
+
+
+def test_cleanup_removes_only_empty_dirs(tmp_path):
+    write(tmp_path / "deep" / "deeper" / "a.txt")
+    (tmp_path / "empty" / "nested").mkdir(parents=True)
+    kept = write(tmp_path / "kept" / "inner" / "x.txt")
+    folder_sort.remove_empty_dirs(tmp_path)
+    assert not (tmp_path / "empty").exists()
+    assert kept.exists()
+    assert (tmp_path / "deep" / "deeper" / "a.txt").exists()
+
+
+def test_move_without_hard_links_never_overwrites(tmp_path, monkeypatch):
+    def no_links(src, dst):
+        raise PermissionError("no hard links")
+    monkeypatch.setattr(folder_sort.os, "link", no_links)
+    taken = write(tmp_path / "dst" / "a.txt", b"old")
+    src = write(tmp_path / "a.txt", b"new")
+    dst = folder_sort.move_file(str(src), str(taken), ".txt")
+    assert dst == str(tmp_path / "dst" / "a_1.txt")
+    assert taken.read_bytes() == b"old"
+    assert (tmp_path / "dst" / "a_1.txt").read_bytes() == b"new"
+    assert not src.exists()
+
+
+def test_hash_cache_drops_files_not_seen(tmp_path):
+    a = write(tmp_path / "a.bin", b"x" * 100)
+    b = write(tmp_path / "b.bin", b"x" * 100)
+    cache = folder_sort.HashCache(tmp_path)
+    entries = {entry.name: entry for entry in os.scandir(tmp_path)}
+    for entry in entries.values():
+        cache.digest(entry, "quick", folder_sort.quick_hash)
+    cache.save()
+    b.unlink()
+
+    cache = folder_sort.HashCache(tmp_path)
+    assert len(cache.data) == 2
+    cache.keep(entry for entry in os.scandir(tmp_path) if entry.name == a.name)
+    cache.save()
+    assert len(folder_sort.HashCache(tmp_path).data) == 1
+
+
+def test_dry_run_plan_matches_the_real_run(tmp_path):
+    write(tmp_path / "a.txt", b"1")
+    write(tmp_path / "other" / "a.txt", b"2")
+    write(tmp_path / "more" / "a.txt", b"3")
+    write(tmp_path / "Docs" / "b.txt", b"sorted before")
+    write(tmp_path / "b.txt", b"4")
+    stats = folder_sort.process_dir(tmp_path, journal=None, dry_run=True)
+    planned = sorted(os.path.relpath(dst, tmp_path) for _, dst in stats["plan"])
+    assert len(planned) == len(set(planned)) == 4
+    folder_sort.main(str(tmp_path))
+    moved = sorted(os.path.relpath(path, tmp_path) for path in (tmp_path / "Docs").iterdir()
+                   if path.name != "b.txt")
+    assert planned == moved
+
+
+def test_undo_moves_the_last_run_back(tmp_path):
+    files = [write(tmp_path / "a.txt"), write(tmp_path / "pics" / "b.jpg"), write(tmp_path / "c.mp3")]
+    folder_sort.main(str(tmp_path))
+    assert not any(path.exists() for path in files)
+    assert "Restored 3 files, skipped 0" in folder_sort.undo(str(tmp_path))
+    assert all(path.exists() for path in files)
+    assert not (tmp_path / folder_sort.JOURNAL_NAME).exists()
+    assert "Nothing to undo" in folder_sort.undo(str(tmp_path))
+
+
+def test_resumed_run_continues_the_interrupted_one(tmp_path):
+    first = write(tmp_path / "sub" / "a.txt")
+    second = write(tmp_path / "sub" / "b.txt")
+    # a run that moved one file and crashed before finishing
+    journal = folder_sort.MoveJournal(tmp_path)
+    journal.start()
+    inode = first.stat().st_ino
+    os.makedirs(tmp_path / "Docs")
+    dst = folder_sort.move_file(str(first), str(tmp_path / "Docs" / "a.txt"))
+    journal.add(str(first), dst, inode, 4)
+    with journal.lock:
+        journal._flush()
+    journal.close()
+
+    folder_sort.main(str(tmp_path), resume=True)
+    assert sorted(path.name for path in (tmp_path / "Docs").iterdir()) == ["a.txt", "b.txt"]
+    runs = journal.runs()
+    assert len(runs) == 1 and runs[0]["done"]
+    # both moves belong to the one run and are undone together
+    assert "Restored 2 files" in folder_sort.undo(str(tmp_path))
+    assert first.exists() and second.exists()
+
+
+def test_link_mode_hard_links_duplicates(tmp_path):
+    write(tmp_path / "a.txt", b"same content")
+    write(tmp_path / "sub" / "b.txt", b"same content")
+    write(tmp_path / "c.txt", b"other content")
+    folder_sort.main(str(tmp_path), dedup="link")
+    docs = tmp_path / "Docs"
+    assert sorted(path.name for path in docs.iterdir()) == ["a.txt", "b.txt", "c.txt"]
+    assert (docs / "a.txt").stat().st_ino == (docs / "b.txt").stat().st_ino
+    assert (docs / "c.txt").stat().st_ino != (docs / "a.txt").stat().st_ino
+    assert (docs / "b.txt").read_bytes() == b"same content"
+
+
+def test_archives_sharing_a_stem_are_both_unpacked(tmp_path):
+    # a race, so a few rounds
+    for round in range(3):
+        archives = tmp_path / str(round) / "Archives"
+        archives.mkdir(parents=True)
+        with zipfile.ZipFile(archives / "a.zip", "w") as archive:
+            for i in range(300):
+                archive.writestr(f"zip{i}.txt", b"z")
+        make_tar(archives / "a.tar.gz", "w:gz", {f"tar{i}.txt": b"t" for i in range(300)})
+        results = folder_sort.process_archives(archives.parent, workers=2)
+        assert [error for _, error in results] == [None, None]
+        assert len(os.listdir(archives / "a")) == 600
+        assert sorted(os.listdir(archives)) == ["a"]
+
+
+def test_sequential_unpack_checks_the_free_space(tmp_path, monkeypatch):
+    archives = tmp_path / "Archives"
+    archives.mkdir()
+    make_tar(archives / "big.tar.gz", "w:gz", {"x.txt": b"x"})
+    monkeypatch.setattr(folder_sort, "archive_size", lambda archive: 1 << 62)
+    results = folder_sort.process_archives(tmp_path, workers=1)
+    assert results == [(str(archives / "big.tar.gz"), "not enough disk space")]
+    assert not (archives / "big").exists()
+
+
+def test_unreadable_files_are_left_out_of_the_duplicates(tmp_path, monkeypatch):
+    for name in ("a.txt", "b.txt", "c.txt"):
+        write(tmp_path / "in" / name, b"same content")
+    quick_hash = folder_sort.quick_hash
+
+    def failing_hash(path, size):
+        if path.endswith("b.txt"):
+            raise PermissionError(path)
+        return quick_hash(path, size)
+    monkeypatch.setattr(folder_sort, "quick_hash", failing_hash)
+    stats = folder_sort.process_dir(tmp_path, dedup="report", dry_run=True)
+    assert [sorted(os.path.basename(path) for path in group) for group in stats["duplicates"]] == [["a.txt", "c.txt"]]
@@ -0,0 +1,68 @@
+from datetime import date, timedelta
+import random
+
+from indexes import BirthdayIndex, NameIndex, NGramIndex, calendar_key
+
+
+def celebrated(birthday: date, day: date) -> bool:
+    if (birthday.month, birthday.day) == (day.month, day.day):
+        return True
+    # Feb 29 birthdays are celebrated on Mar 1 in common years
+    return (birthday.month, birthday.day) == (2, 29) and calendar_key(day) == (2, 29)
+
+def brute_upcoming(birthdays: dict, days: int, today: date) -> set:
+    window = [today + timedelta(days=i) for i in range(min(days, 366))]
+    return {name for name, birthday in birthdays.items() if any(celebrated(birthday, day) for day in window)}
+
+
+def test_empty_window_returns_nothing():
+    index = BirthdayIndex()
+    index.add("far", date(1990, 12, 1))
+    index.add("farther", date(1990, 8, 1))
+    assert index.upcoming(3, today=date(2023, 5, 10)) == []
+
+
+def test_window_wrapping_over_new_year():
+    index = BirthdayIndex()
+    index.add("eve", date(1990, 12, 31))
+    index.add("new", date(1990, 1, 2))
+    index.add("summer", date(1990, 7, 1))
+    assert index.upcoming(5, today=date(2023, 12, 30)) == ["eve", "new"]
+
+
+def test_upcoming_matches_brute_force():
+    rnd = random.Random(4)
+    index = BirthdayIndex()
+    birthdays = {}
+    for i in range(60):
+        birthday = date(1980, 1, 1) + timedelta(days=rnd.randrange(366 * 4))
+        birthdays[f"name {i}"] = birthday
+    # around the leap day
+    birthdays.update(leap=date(1984, 2, 29), march=date(1985, 3, 1), feb=date(1985, 2, 28))
+    for name, birthday in birthdays.items():
+        index.add(name, birthday)
+    for _ in range(500):
+        today = date(2023, 1, 1) + timedelta(days=rnd.randrange(366 * 2))
+        days = rnd.choice((1, 2, 3, 7, 30, 200, 364, 365, 366, 400))
+        assert set(index.upcoming(days, today=today)) == brute_upcoming(birthdays, days, today)
+
+
+def test_ngram_index_finds_substrings_of_any_length():
+    index = NGramIndex()
+    index.add("0501234567", "anna")
+    index.add("0671234000", "petro")
+    index.add("12", "short")
+    assert index.search("1234") == {"anna", "petro"}
+    assert index.search("4567") == {"anna"}
+    assert index.search("12") == {"anna", "petro", "short"}
+    index.remove("0501234567", "anna")
+    assert index.search("1234") == {"petro"}
+
+
+def test_name_index_ranks_prefixes_then_word_starts_then_positions():
+    index = NameIndex()
+    index.extend(["Anna Petrenko", "Petro Ivanenko", "Kopetr", "petrov"])
+    assert index.search("petr") == ["Petro Ivanenko", "petrov", "Anna Petrenko", "Kopetr"]
+    assert index.search("petr", limit=3) == ["Petro Ivanenko", "petrov", "Anna Petrenko"]
+    index.remove("Petro Ivanenko")
+    assert index.search("PETR") == ["petrov", "Anna Petrenko", "Kopetr"]
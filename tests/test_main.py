@@ -0,0 +1,58 @@
+import pytest
+
+import main
+import notes
+from classes import AddressBook
+
+
+@pytest.fixture
+def book(tmp_path, monkeypatch):
+    '''
+    main with a fresh book and note store in tmp_path
+    '''
+    monkeypatch.chdir(tmp_path)
+    filename = str(tmp_path / "book.dat")
+    monkeypatch.setattr(main, "address_book", AddressBook())
+    monkeypatch.setattr(main, "file_name", filename)
+    # run_batch replaces the input and the output of the CLI
+    monkeypatch.setattr(main, "base_input", None, raising=False)
+    monkeypatch.setattr(main, "base_output", None, raising=False)
+    for name in ("notes_lst", "notes_by_id", "note_index", "tag_index", "next_id", "note_store", "_unloaded"):
+        monkeypatch.setattr(notes, name, getattr(notes, name))
+    monkeypatch.setattr(notes, "note_store", None)
+    main.address_book.load(filename)
+    notes.load_notes()
+    yield filename
+    main.address_book.close()
+    notes.note_store.close()
+
+
+def test_import_inside_a_batch_keeps_the_changes_around_it(book, tmp_path):
+    csv = tmp_path / "c.csv"
+    csv.write_text("name,phones\nbob,0222222222\n", encoding="utf-8")
+    main.run_batch(["add phone ann 0123456789", f"import {csv}", "add phone cat 0111111111"], quiet=True)
+    main.address_book.close()
+    reloaded = AddressBook()
+    reloaded.load(book)
+    assert sorted(reloaded.data) == ["ann", "bob", "cat"]
+    reloaded.close()
+
+
+def test_script_answers_questions_and_skips_comments(book, capsys):
+    lines = ["# contacts", "", "ADD PHONE ann 0123456789\n", "add note", "pay the rent", "home, bills",
+             "add phone bob 123", "exit", "add phone cat 0111111111"]
+    result = main.run_batch(lines, quiet=True)
+    assert "3 commands" in result
+    output = capsys.readouterr().out
+    # quiet: only the error of the bad phone is printed
+    assert output.startswith(main.RED) and "Record added" not in output
+    assert list(main.address_book.data) == ["ann"]
+    assert [record.note for record in notes.find_by_tag("bills")] == ["pay the rent"]
+
+
+def test_batch_changes_are_saved_at_the_end(book):
+    main.run_batch(["add phone ann 0123456789", "add phone ann 0987654321"], quiet=True)
+    reloaded = AddressBook()
+    reloaded.load(book)
+    assert [phone.value for phone in reloaded.find("ann").phones] == ["0123456789", "0987654321"]
+    reloaded.close()
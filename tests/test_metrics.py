@@ -0,0 +1,102 @@
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    '''
+    Metrics on, with an empty registry and a clock moved by hand
+    '''
+    now = [0.0]
+    monkeypatch.setattr(metrics, "perf_counter", lambda: now[0])
+    monkeypatch.setattr(metrics, "registry", metrics.Registry())
+    monkeypatch.setattr(metrics, "enabled", True)
+    return now
+
+
+def test_histogram_quantiles_stay_within_the_observations():
+    histogram = metrics.Histogram()
+    assert histogram.quantile(0.5) == 0.0
+    for seconds in [0.001] * 90 + [0.3] * 10:
+        histogram.observe(seconds)
+    assert histogram.count == 100 and histogram.max == 0.3
+    assert 0.0005 < histogram.quantile(0.5) <= 0.001
+    assert 0.25 < histogram.quantile(0.99) <= 0.3
+    assert histogram.quantile(1.0) == 0.3
+
+
+def test_nested_phases_are_not_counted_twice(clock):
+    @metrics.timed("search")
+    def search():
+        clock[0] += 2.0
+
+    @metrics.timed("persistence")
+    def save():
+        clock[0] += 1.0
+        search()
+        # the same phase nested in itself counts once
+        flush()
+
+    @metrics.timed("persistence")
+    def flush():
+        clock[0] += 0.5
+
+    metrics.run_command("save", save)
+    assert metrics.registry.phases == {("save", "persistence"): 1.5, ("save", "search"): 2.0}
+    assert metrics.registry.commands["save"].total == 3.5
+
+
+def test_generators_are_timed_while_they_produce(clock):
+    @metrics.timed("search")
+    def results():
+        for i in range(3):
+            clock[0] += 1.0
+            yield i
+
+    def command():
+        return results()
+
+    items = metrics.run_command("show all", command)
+    for _ in items:
+        # printing is not part of the command
+        clock[0] += 10.0
+    assert metrics.registry.commands["show all"].total == 3.0
+    assert metrics.registry.phases == {("show all", "search"): 3.0}
+
+
+def test_errors_are_counted_per_command_and_type(clock):
+    def failing():
+        raise KeyError("ann")
+
+    with pytest.raises(KeyError):
+        metrics.run_command("get contact", failing)
+    metrics.run_command("get contact", metrics.error, ValueError())
+    assert metrics.registry.errors == {("get contact", "KeyError"): 1, ("get contact", "ValueError"): 1}
+    assert metrics.registry.commands["get contact"].count == 2
+
+
+def test_disabled_metrics_record_nothing(clock, monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", False)
+    metrics.timed("search")(lambda: None)()
+    metrics.error(KeyError())
+    assert metrics.registry.phases == {} and metrics.registry.errors == {}
+
+
+def test_prometheus_export(clock, tmp_path):
+    for seconds in (0.0002, 0.003, 20.0):
+        metrics.registry.observe('say "hi"', seconds)
+    metrics.registry.error('say "hi"', "KeyError")
+    metrics.registry.spent('say "hi"', "search", 0.5)
+    filename = tmp_path / "metrics.prom"
+    metrics.export(str(filename))
+    lines = filename.read_text().splitlines()
+    assert not (tmp_path / "metrics.prom.tmp").exists()
+    label = 'command="say \\"hi\\""'
+    assert f'addressbook_command_seconds_bucket{{{label},le="0.00025"}} 1' in lines
+    assert f'addressbook_command_seconds_bucket{{{label},le="0.005"}} 2' in lines
+    assert f'addressbook_command_seconds_bucket{{{label},le="10.0"}} 2' in lines
+    assert f'addressbook_command_seconds_bucket{{{label},le="+Inf"}} 3' in lines
+    assert f"addressbook_command_seconds_count{{{label}}} 3" in lines
+    assert f'addressbook_errors_total{{{label},type="KeyError"}} 1' in lines
+    assert f'addressbook_phase_seconds_total{{{label},phase="search"}} 0.5' in lines
@@ -0,0 +1,160 @@
+import pytest
+
+import notes
+from notes import NoteIndex, NoteRecord, NoteStore, TagIndex
+
+
+@pytest.fixture
+def note_module(tmp_path, monkeypatch):
+    '''
+    notes module with its globals restored after the test
+    '''
+    for name in ("notes_lst", "notes_by_id", "note_index", "tag_index", "next_id", "note_store", "_unloaded"):
+        monkeypatch.setattr(notes, name, getattr(notes, name))
+    monkeypatch.setattr(notes, "note_store", None)
+    filename = str(tmp_path / "notes.bin")
+    notes.load_notes(filename)
+    yield filename
+    notes.note_store.close()
+
+
+def make_note(text, *tags):
+    record = NoteRecord(text)
+    record.tags = dict.fromkeys(tags)
+    return record
+
+
+def test_note_index_phrases_prefixes_and_alternatives():
+    index = NoteIndex()
+    texts = {1: "buy fresh milk and bread", 2: "milk the cow, then bread", 3: "call the bank about the loan"}
+    for note_id, text in texts.items():
+        index.add(note_id, text)
+    # equal scores are ordered by id
+    assert index.search("milk bread", 3) == [1, 2]
+    assert index.search('"fresh milk"', 3) == [1]
+    assert index.search('"milk fresh"', 3) == []
+    assert sorted(index.search("ban*", 3)) == [3]
+    assert sorted(index.search("cow OR loan", 3)) == [2, 3]
+    assert sorted(index.search("cow | bank", 3)) == [2, 3]
+    index.remove(2, texts[2])
+    assert index.search("milk", 3) == [1]
+    assert "cow" not in index.postings
+
+
+def test_tag_index_and_or_not():
+    index = TagIndex()
+    tags = {1: ["work", "urgent"], 2: ["work", "done"], 3: ["home"], 4: []}
+    for note_id, note_tags in tags.items():
+        for tag in note_tags:
+            index.add(note_id, tag)
+    all_ids = set(tags)
+    assert index.search("work", all_ids) == {1, 2}
+    assert index.search("work AND urgent", all_ids) == {1}
+    assert index.search("work NOT done", all_ids) == {1}
+    assert index.search("urgent OR home", all_ids) == {1, 3}
+    assert index.search("NOT work", all_ids) == {3, 4}
+    index.remove(1, "urgent")
+    assert index.search("urgent", all_ids) == set()
+
+
+def test_store_keeps_latest_versions_across_reopen(tmp_path):
+    filename = str(tmp_path / "notes.bin")
+    store = NoteStore(filename)
+    assert store.open() is None
+    for note_id, text in enumerate(["first", "second", "third"], 1):
+        record = make_note(text)
+        record.id = note_id
+        store.put(record)
+    record.note = "third, edited"
+    store.put(record)
+    store.delete(1)
+    store.close()
+
+    store = NoteStore(filename)
+    assert store.open() is None
+    assert sorted(store.offsets) == [2, 3]
+    assert store.get(3).note == "third, edited"
+    assert store.garbage > 0
+    store.compact()
+    assert store.garbage == 0
+    store.close()
+
+    store = NoteStore(filename)
+    store.open()
+    assert {note_id: store.get(note_id).note for note_id in store.offsets} == {2: "second", 3: "third, edited"}
+    store.close()
+
+
+def test_store_drops_a_torn_last_frame(tmp_path):
+    filename = str(tmp_path / "notes.bin")
+    store = NoteStore(filename)
+    store.open()
+    for note_id in (1, 2):
+        record = make_note(f"note {note_id}")
+        record.id = note_id
+        store.put(record)
+    store.close()
+    with open(filename, "r+b") as fh:
+        fh.truncate(fh.seek(0, 2) - 3)
+
+    store = NoteStore(filename)
+    store.open()
+    assert list(store.offsets) == [1]
+    record = make_note("after the crash")
+    record.id = 3
+    store.put(record)
+    store.close()
+
+    store = NoteStore(filename)
+    store.open()
+    assert {note_id: store.get(note_id).note for note_id in store.offsets} == {1: "note 1", 3: "after the crash"}
+    store.close()
+
+
+def test_batch_defers_frames_until_commit(tmp_path):
+    filename = str(tmp_path / "notes.bin")
+    store = NoteStore(filename)
+    store.open()
+    store.defer()
+    record = make_note("deferred")
+    record.id = 1
+    store.put(record)
+    with open(filename, "rb") as fh:
+        assert fh.read() == notes.NOTES_MAGIC
+    # reading a deferred note writes the pending frames first
+    assert store.get(1).note == "deferred"
+    store.commit()
+    store.close()
+
+
+def test_module_searches_follow_changes_and_reload(note_module):
+    work = make_note("quarterly report draft", "work", "urgent")
+    home = make_note("fix the kitchen tap", "home")
+    with notes.batch():
+        notes.add_record(work)
+        notes.add_record(home)
+    assert notes.find_by_note("report") == [work]
+    assert notes.find_by_tag("work OR home") == [work, home]
+    work.del_tags(["urgent"])
+    notes.delete_note(home)
+    notes.save_notes(note_module)
+
+    notes.load_notes(note_module, lazy=True)
+    assert [record.note for record in notes.find_by_tag("work")] == ["quarterly report draft"]
+    assert notes.find_by_tag("urgent") == []
+    assert notes.find_by_note("kitchen") == []
+
+
+def test_tag_query_quotes_and_operator_case():
+    assert notes.parse_tag_query('"my tag" OR work') == [(["my tag"], []), (["work"], [])]
+    assert notes.parse_tag_query("work and urgent not done") == [(["work", "urgent"], ["done"])]
+    assert notes.parse_tag_query('work AND "and"') == [(["work", "and"], [])]
+
+
+def test_tags_with_spaces_are_found(note_module):
+    record = make_note("plan the trip")
+    notes.add_record(record)
+    record.add_tags(["my tag", "work"])
+    assert notes.find_by_tag('"my tag"') == [record]
+    assert notes.find_by_tag('"MY TAG" and work') == [record]
+    assert notes.find_by_tag("my tag") == []
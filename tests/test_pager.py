@@ -0,0 +1,55 @@
+from classes import AddressBook, Record
+
+
+def make_book(tmp_path, size=10):
+    book = AddressBook()
+    book.load(str(tmp_path / "book.dat"))
+    for i in range(size):
+        record = Record(f"name {i:02d}")
+        record.add_phone(f"{i:010d}")
+        book.add_record(record)
+    return book
+
+
+def names(records):
+    return [record.name.value for record in records]
+
+
+def test_page_validates_size_and_order(tmp_path):
+    book = make_book(tmp_path)
+    records, cursor = book.page(0, "nonsense")
+    assert names(records) == ["name 00", "name 01"]
+    records, _ = book.page("3", "name", cursor)
+    assert names(records) == ["name 02", "name 03", "name 04"]
+
+
+def test_pages_cover_the_book_once(tmp_path):
+    book = make_book(tmp_path)
+    book.compact(str(tmp_path / "book.dat"))
+    book.delete("name 03")
+    book.add_record(Record("late"))
+    for order in ("added", "name"):
+        seen, cursor = [], None
+        while True:
+            records, cursor = book.page(3, order, cursor)
+            seen.extend(names(records))
+            if cursor is None:
+                break
+        assert sorted(seen) == sorted(list(book.data))
+        assert len(seen) == 10
+
+
+def test_resuming_an_added_cursor_does_not_read_earlier_records(tmp_path):
+    book = make_book(tmp_path, 50)
+    book.compact(str(tmp_path / "book.dat"))
+    book.close()
+    book = AddressBook()
+    book.load(str(tmp_path / "book.dat"))
+    _, cursor = book.page(2, "added", ("added", 40))
+    starts = []
+    items = book.data.store.items
+    book.data.store.items = lambda start=0: starts.append(start) or items(start)
+    records, _ = book.page(2, "added", cursor)
+    assert names(records) == ["name 42", "name 43"]
+    # the store is entered at the cursor, not walked from the first record
+    assert starts == [42]
@@ -0,0 +1,61 @@
+from record_store import RecordMap, RecordStore, write_store
+
+
+def test_store_finds_names_and_keeps_the_added_order(tmp_path):
+    filename = str(tmp_path / "store")
+    items = [(name, name.upper().encode()) for name in ("zoe", "anna", "Ölga", "bob")]
+    write_store(filename, items, generation=7)
+    assert RecordStore.is_store(filename)
+    store = RecordStore(filename)
+    assert store.generation == 7 and len(store) == 4
+    assert list(store.items()) == items
+    assert list(store.items(2)) == items[2:]
+    assert store.get("Ölga") == "ÖLGA".encode()
+    assert store.get("carl") is None
+    store.close()
+
+
+def test_record_map_layers_changes_over_the_store(tmp_path):
+    filename = str(tmp_path / "store")
+    write_store(filename, [("a", b"1"), ("b", b"2"), ("c", b"3")], generation=1)
+    records = RecordMap(RecordStore(filename), decode=lambda raw: int(raw))
+    del records["b"]
+    records["d"] = 4
+    records["a"] = 10
+    assert len(records) == 3
+    assert "b" not in records and "d" in records
+    assert list(records.items()) == [("a", 10), ("c", 3), ("d", 4)]
+    assert list(records.walk(1)) == [(3, 3), (4, 4)]
+    records.close()
+
+
+def test_listings_and_searches_do_not_keep_records(tmp_path):
+    from classes import AddressBook, Record
+    filename = str(tmp_path / "book.dat")
+    book = AddressBook()
+    book.load(filename)
+    for i in range(500):
+        record = Record(f"name{i:04}")
+        record.add_phone(f"05{i:08}")
+        record.add_birthday(f"{i % 28 + 1:02}.{i % 12 + 1:02}.1990")
+        book.add_record(record)
+    book.compact(filename)
+    book.close()
+
+    book = AddressBook()
+    book.load(filename)
+    assert sum(1 for _ in book.iterator(50, "name")) == 10
+    assert sum(1 for _ in book.iterator(50, "birthday")) == 10
+    assert len(list(book.bd_in_xx_days(400))) == 500
+    assert len(book.search_phones("00001")) == sum("00001" in f"05{i:08}" for i in range(500))
+    assert len(book.search_names("name0")) == 500
+    assert book.data.loaded == {}
+    # a record found by a search is kept once it changes
+    record = book.search_phones("0500000007")[0]
+    record.add_email("seven@example.com")
+    assert list(book.data.loaded) == ["name0007"]
+    book.close()
+    book = AddressBook()
+    book.load(filename)
+    assert book.find("name0007").emails[0].value == "seven@example.com"
+    book.close()
@@ -0,0 +1,36 @@
+import pytest
+
+import main
+from router import CommandRouter
+
+
+def test_longest_command_wins_and_the_rest_are_arguments():
+    router = CommandRouter({"add": "add", "add phone": "add_phone", "add phone now": "now"})
+    assert router.route("add phone ann 0123456789") == ("add_phone", ["ann", "0123456789"])
+    assert router.route("add ann") == ("add", ["ann"])
+    assert router.route("add phone now") == ("now", [])
+    assert router.route("  add   phone  ") == ("add_phone", [])
+
+
+def test_unknown_commands_and_prefixes_route_nowhere():
+    router = CommandRouter({"show all": "show_all"})
+    assert router.route("show") == (None, ["show"])
+    assert router.route("hide all") == (None, ["hide", "all"])
+    assert router.route("") == (None, [])
+
+
+def test_aliases_share_the_handler_and_keep_its_name():
+    router = CommandRouter({"get contact": "get", "show all": "show_all"}, {"get": "get contact", "all": "show all"})
+    assert router.route("get ann") == ("get", ["ann"])
+    assert router.names == ["get contact", "show all", "get", "all"]
+    # metrics label a command by the name it was registered under first
+    assert router.commands["get"] == "get contact"
+    with pytest.raises(KeyError):
+        router.alias("nope", "missing command")
+
+
+def test_every_alias_of_main_routes_to_its_command():
+    for alias, name in main.ALIASES.items():
+        assert main.router.route(alias)[0] is main.router.route(name)[0] is not None
+    func, params = main.router.route("add phone ann 0123456789")
+    assert func is main.OPERATIONS["add phone"] and params == ["ann", "0123456789"]
@@ -0,0 +1,89 @@
+import pytest
+
+import main
+import notes
+from sqlite_store import NOTES_SCHEMA, Database, SQLiteBook, SQLiteNoteStore
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "address_book", main.address_book)
+    monkeypatch.setattr(main, "file_name", main.file_name)
+    monkeypatch.setattr(main.loader, "db", None)
+    monkeypatch.setattr(notes, "note_store", None)
+    filename = str(tmp_path / "book.db")
+    main.use_database(filename)
+    main.loader.start()
+    yield filename
+    main.address_book.db.close()
+
+
+def test_save_inside_batch_keeps_the_batch(database, tmp_path):
+    lines = ["add alice 0123456789", "save", "add note", "hello world", "work",
+             "add bob 0987654321", "save"]
+    main.run_batch(lines, quiet=True)
+    book = SQLiteBook()
+    book.load(database)
+    assert book.find("alice").phones[0].value == "0123456789"
+    assert book.find("bob").phones[0].value == "0987654321"
+    assert [record.note for record in notes.find_by_note("hello")] == ["hello world"]
+    book.db.close()
+
+
+def test_save_as_inside_batch_copies_after_commit(database, tmp_path):
+    copy = str(tmp_path / "copy.db")
+    with main.address_book.batch():
+        main.address_book.add_record(main.Record("carol"))
+        main.address_book.save(copy)
+    book = SQLiteBook()
+    book.load(copy)
+    assert "carol" in book.data
+    book.db.close()
+
+
+def make_books(tmp_path):
+    from classes import AddressBook, Record
+    memory, book = AddressBook(), SQLiteBook()
+    book.load(str(tmp_path / "grams.db"))
+    contacts = [("Anna Oleh 1", "0501234567"), ("Ivan Annat 2", "0671239999"), ("Olena 3", "0931111111"),
+                ("maria 4", "0500000123")]
+    for target in (memory, book):
+        for name, phone in contacts:
+            record = Record(name)
+            record.add_phone(phone)
+            target.add_record(record)
+    return memory, book
+
+
+def test_substring_search_matches_the_memory_book(tmp_path):
+    memory, book = make_books(tmp_path)
+    book.delete("Olena 3")
+    memory.delete("Olena 3")
+    for query in ("123", "12", "0931", "1111"):
+        assert sorted(r.name.value for r in book.search_phones(query)) == \
+               sorted(r.name.value for r in memory.search_phones(query))
+    for query in ("ann", "an", "oleh", "lena", "ria 4"):
+        assert [r.name.value for r in book.search_names(query)] == \
+               [r.name.value for r in memory.search_names(query)]
+    plan = book.db.execute("EXPLAIN QUERY PLAN SELECT rowid FROM contacts_grams WHERE phones MATCH '\"123\"'")
+    assert any("VIRTUAL TABLE INDEX" in row[-1] for row in plan)
+    book.db.close()
+
+
+def test_trigram_table_is_filled_for_an_older_database(tmp_path):
+    _, book = make_books(tmp_path)
+    book.db.execute("DROP TABLE contacts_grams")
+    book.db.close()
+    book = SQLiteBook()
+    book.load(str(tmp_path / "grams.db"))
+    assert [r.name.value for r in book.search_phones("0000")] == ["maria 4"]
+    book.db.close()
+
+
+def test_note_text_index_is_filled_for_existing_notes(tmp_path):
+    db = Database(str(tmp_path / "notes.db"))
+    db.conn.executescript(NOTES_SCHEMA)
+    db.execute("INSERT INTO notes (id, note) VALUES (1, 'water the plants'), (2, 'call mom')")
+    store = SQLiteNoteStore(db)
+    assert [record.note for record in store.find_by_note("plants")] == ["water the plants"]
+    db.close()